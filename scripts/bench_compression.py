@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Weighs bytes on the wire saved by pre-encryption compression against the
+CPU it costs.
+
+Compresses each file with every codec and with the adaptive choice (which
+includes sampling the file) and reports, per codec, the bytes that would be
+uploaded, how much smaller that is than the cleartext, the CPU seconds spent,
+and the megabytes saved per CPU second. Without arguments it makes a small
+corpus of logs, CSV, mixed binary and random data.
+
+Usage:
+  PYTHONPATH=src python scripts/bench_compression.py [path ...]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lockbox.compression import CompressingReader, choose_codec, CODECS
+
+_ADAPTIVE = 'adaptive'
+_CORPUS_FILE_SIZE = 4 << 20
+
+
+def make_corpus(directory):
+  def write(name, data):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as fh:
+      fh.write(data[:_CORPUS_FILE_SIZE])
+    return path
+
+  lines = _CORPUS_FILE_SIZE // 40 + 1
+  return [
+    write('server.log', ''.join(
+          '2012-03-04 12:%02d:%02d INFO GET /item/%d 200\n' %
+          (i // 60 % 60, i % 60, i * 7 % 1000) for i in range(lines))),
+    write('table.csv', ''.join(
+          '%d,%d,%.4f,%s\n' % (i, i * 31 % 977, i / 7., 'abc'[i % 3] * 5)
+          for i in range(lines))),
+    write('mixed.bin', ''.join(os.urandom(24) + '\0' * 8
+                               for _ in range(_CORPUS_FILE_SIZE // 32))),
+    write('photo.jpg', os.urandom(_CORPUS_FILE_SIZE)),
+    ]
+
+
+def compressed_size(path, codec):
+  with open(path, 'rb') as cleartext_file:
+    reader = CompressingReader(cleartext_file, codec)
+    size = 0
+    while True:
+      data = reader.read(1 << 20)
+      if not data:
+        return size
+      size += len(data)
+
+
+def bench(paths, codec):
+  num_in = num_out = 0
+  start = time.clock()
+  for path in paths:
+    num_in += os.path.getsize(path)
+    num_out += compressed_size(
+      path, choose_codec(path) if codec == _ADAPTIVE else codec)
+  return num_in, num_out, time.clock() - start
+
+
+def main(argv):
+  directory = None
+  paths = argv[1:]
+  if not paths:
+    directory = tempfile.mkdtemp()
+    paths = make_corpus(directory)
+  try:
+    if directory:
+      for path in paths:
+        print '%-12s %s' % (os.path.basename(path), choose_codec(path))
+      print
+    print '%10s %12s %12s %8s %10s %14s' % (
+      'codec', 'bytes in', 'bytes out', 'saved', 'cpu s', 'MB saved/cpu s')
+    for codec in CODECS + [_ADAPTIVE]:
+      num_in, num_out, cpu_seconds = bench(paths, codec)
+      saved = num_in - num_out
+      print '%10s %12d %12d %7.1f%% %10.3f %14.1f' % (
+        codec, num_in, num_out, 100. * saved / max(num_in, 1), cpu_seconds,
+        saved / 1e6 / max(cpu_seconds, 1e-6))
+  finally:
+    if directory:
+      shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Compares the subprocess and gpgme GPG engines on many files.
+
+Encrypts each file and its path, as FileUpdateCrypto does for a new file, and
+reports the mean time per file for each engine. Files are small by default;
+give a file_size of several MB to time streaming big files through gpgme.
+Needs a public key for the recipient in the default (or given) keyring, and
+the pyme bindings for the gpgme engine. gnupg.GPG passes recipients through
+a shell, so give a key id or fingerprint rather than a uid with spaces.
+
+Usage:
+  PYTHONPATH=src python scripts/bench_gpg_engines.py recipient \
+      [num_files [file_size [gnupghome]]]
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lockbox import gnupg
+from lockbox.crypto_util import HashingWriter
+from lockbox.gpgme_engine import new_engine, ENGINES
+
+_DEFAULT_NUM_FILES = 200
+_DEFAULT_FILE_SIZE = 4096
+
+
+def bench(gpg, recipient, paths):
+  start = time.time()
+  for path in paths:
+    with open(path, 'rb') as cleartext_file:
+      with tempfile.NamedTemporaryFile() as encrypted_blob_file:
+        result = gpg.encrypt_file(cleartext_file, [recipient],
+                                  always_trust=True, armor=False,
+                                  output_stream=HashingWriter(
+                                    encrypted_blob_file))
+    if not result:
+      raise ValueError('Encryption failed: %s' % result.stderr)
+    gpg.encrypt(path, [recipient], always_trust=True, armor=False)
+  return (time.time() - start) / len(paths)
+
+
+def main(argv):
+  logging.getLogger().setLevel(logging.WARNING)
+  recipient = argv[1]
+  num_files = int(argv[2]) if len(argv) > 2 else _DEFAULT_NUM_FILES
+  file_size = int(argv[3]) if len(argv) > 3 else _DEFAULT_FILE_SIZE
+  gnupghome = argv[4] if len(argv) > 4 else None
+
+  directory = tempfile.mkdtemp()
+  try:
+    paths = list()
+    for i in range(num_files):
+      path = os.path.join(directory, 'file-%05d' % i)
+      with open(path, 'wb') as fh:
+        fh.write(os.urandom(file_size))
+      paths.append(path)
+
+    print '%12s %16s %12s' % ('engine', 'ms per file', 'files/s')
+    for engine in ENGINES:
+      try:
+        gpg = new_engine(engine, gnupg.GPG(gnupghome=gnupghome))
+      except ValueError, e:
+        print '%12s %16s (%s)' % (engine, '-', e)
+        continue
+      per_file = bench(gpg, recipient, paths)
+      print '%12s %16.2f %12.1f' % (engine, per_file * 1000, 1 / per_file)
+  finally:
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Measures how fast gnupg.GPG.encrypt_file() moves data through gpg.
+
+Encrypts a file of random data to a throwaway key in a temporary GnuPG home,
+streaming the ciphertext to a sink, and reports MB/s of cleartext. With
+--passthrough, the gpg binary is replaced by `cat`, so that the number is the
+wrapper's own I/O overhead rather than gpg's.
+
+Usage:
+  PYTHONPATH=src/lockbox python scripts/bench_gpg_io.py [--passthrough] [MB]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import gnupg
+
+_RECIPIENT = 'bench@example.com'
+_DEFAULT_MB = 256
+_RUNS = 3
+
+
+class Sink(object):
+  def __init__(self):
+    self.size = 0
+
+  def write(self, data):
+    self.size += len(data)
+
+
+def make_home(directory, passthrough):
+  home = os.path.join(directory, 'gnupg')
+  os.mkdir(home, 0700)
+  if passthrough:
+    binary = os.path.join(directory, 'cat-gpg')
+    with open(binary, 'w') as fh:
+      # GPG() runs `gpg --version` without closing its stdin.
+      fh.write('#!/bin/sh\ncase "$*" in *--version*) exit 0;; esac\n'
+               'exec cat\n')
+    os.chmod(binary, 0755)
+    return gnupg.GPG(gpgbinary=binary, gnupghome=home)
+  subprocess.check_call(
+    ['gpg', '--batch', '--quiet', '--homedir', home, '--passphrase', '',
+     '--quick-gen-key', _RECIPIENT, 'default', 'default', 'never'])
+  return gnupg.GPG(gnupghome=home)
+
+
+def bench(gpg, path):
+  best = None
+  for _ in range(_RUNS):
+    sink = Sink()
+    start = time.time()
+    with open(path, 'rb') as cleartext:
+      gpg.encrypt_file(cleartext, [_RECIPIENT], always_trust=True,
+                       armor=False, output_stream=sink)
+    elapsed = time.time() - start
+    if not sink.size:
+      raise RuntimeError('gpg produced no output.')
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def main(argv):
+  passthrough = '--passthrough' in argv
+  args = [arg for arg in argv[1:] if arg != '--passthrough']
+  size = int(args[0] if args else _DEFAULT_MB) << 20
+  directory = tempfile.mkdtemp()
+  try:
+    gpg = make_home(directory, passthrough)
+    path = os.path.join(directory, 'cleartext')
+    with open(path, 'wb') as fh:
+      for _ in range(size >> 20):
+        fh.write(os.urandom(1 << 20))
+    seconds = bench(gpg, path)
+    print '%s: %d MB in %.2f s, %.1f MB/s' % (
+      'passthrough' if passthrough else 'gpg', size >> 20, seconds,
+      (size >> 20) / seconds)
+  finally:
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Measures RemoteLocalMediator dispatch latency against queue depth.
+
+Fills the queue table with prepared rows and times repeated _dispatch() calls
+against a set of always-ready fake shepherds. With the indexed claim query the
+per-dispatch time should stay flat as the backlog grows.
+
+Usage:
+  PYTHONPATH=src python scripts/bench_mediator_dispatch.py [depth ...]
+"""
+
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from lockbox.local_file_shepherd import SHEPHERD_STATE_READY
+from lockbox.master_db_connection import MasterDBConnection
+from lockbox.remote_local_mediator import RemoteLocalMediator
+
+_DEFAULT_DEPTHS = [1000, 10000, 100000, 500000]
+_NUM_SHEPHERDS = 8
+_NUM_DISPATCHES = 200
+
+
+class _ReadyShepherd(object):
+  def __init__(self, ident):
+    self.ident = ident
+
+  def get_state(self):
+    return SHEPHERD_STATE_READY
+
+  def assign(self, status_id, timestamp, state, event_type, src_path,
+             dest_path):
+    return True
+
+
+def _fill_queue(mediator, depth):
+  now = time.time() - 60
+  with MasterDBConnection(mediator.database_path) as cursor:
+    cursor.executemany(
+      'INSERT INTO queue(timestamp, state, event_type, src_path, dest_path) '
+      'VALUES (?, "prepare", "modified", ?, "")',
+      ((now + i * 1e-6, '/lockbox/file-%08d' % i) for i in xrange(depth)))
+
+
+def bench(depth):
+  database_directory = tempfile.mkdtemp()
+  try:
+    mediator = RemoteLocalMediator(None, None, None, database_directory,
+                                   'bench.db', settle_window=0)
+    mediator._initialize_queue()
+    _fill_queue(mediator, depth)
+    mediator.shepherds = [_ReadyShepherd(i) for i in range(_NUM_SHEPHERDS)]
+
+    timings = list()
+    for _ in xrange(_NUM_DISPATCHES):
+      start = time.time()
+      mediator._dispatch()
+      timings.append(time.time() - start)
+      # Release the leases so the next pass claims a fresh batch.
+      with MasterDBConnection(mediator.database_path) as cursor:
+        cursor.execute('DELETE FROM leases')
+    timings.sort()
+    return timings[len(timings) / 2], timings[int(len(timings) * 0.99)]
+  finally:
+    shutil.rmtree(database_directory)
+
+
+def main(argv):
+  logging.getLogger().setLevel(logging.WARNING)
+  depths = [int(arg) for arg in argv[1:]] or _DEFAULT_DEPTHS
+  print '%10s %12s %12s' % ('depth', 'p50 (ms)', 'p99 (ms)')
+  for depth in depths:
+    p50, p99 = bench(depth)
+    print '%10d %12.3f %12.3f' % (depth, p50 * 1000, p99 * 1000)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
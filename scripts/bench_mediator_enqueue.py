@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Measures RemoteLocalMediator enqueue throughput for a burst of events.
+
+Simulates a checkout that creates and then writes num_files files, i.e. two
+watchdog events per file, and reports how fast the observer thread can hand
+them off and how long until all of them are committed to the queue table.
+
+Usage:
+  PYTHONPATH=src python scripts/bench_mediator_enqueue.py [num_files]
+"""
+
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from lockbox.remote_local_mediator import RemoteLocalMediator
+from watchdog.events import FileCreatedEvent, FileModifiedEvent
+
+_DEFAULT_NUM_FILES = 50000
+
+
+def main(argv):
+  logging.getLogger().setLevel(logging.WARNING)
+  num_files = int(argv[1]) if len(argv) > 1 else _DEFAULT_NUM_FILES
+  events = list()
+  for i in xrange(num_files):
+    src_path = '/lockbox/checkout/file-%08d' % i
+    events.append(FileCreatedEvent(src_path))
+    events.append(FileModifiedEvent(src_path))
+
+  database_directory = tempfile.mkdtemp()
+  try:
+    mediator = RemoteLocalMediator(None, None, None, database_directory,
+                                   'bench.db')
+    mediator._initialize_queue()
+    mediator._event_buffer.start()
+
+    start = time.time()
+    for event in events:
+      mediator.enqueue(event)
+    handed_off = time.time() - start
+    mediator._event_buffer.stop()
+    mediator._event_buffer.join()
+    committed = time.time() - start
+
+    print '%d events, %d queue rows' % (len(events),
+                                         len(mediator._list_queue()))
+    print 'hand-off: %10.0f events/sec' % (len(events) / handed_off)
+    print 'commit:   %10.0f events/sec' % (len(events) / committed)
+  finally:
+    shutil.rmtree(database_directory)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
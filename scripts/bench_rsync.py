@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Times the pure-Python rsync engine (lockbox.rsync) on a large file and an
+edited copy of it.
+
+The edited copy has small insertions scattered through it and a run of
+blocks moved from the end to the front, so that the delta needs blocks out
+of order as well as rolling through the changed regions. Reports the time to
+sign the old file, to compute the delta, and how much literal data the delta
+carries, and checks that the delta patches the old file into the new one.
+
+Usage:
+  PYTHONPATH=src python scripts/bench_rsync.py [MB] [edits]
+"""
+
+import os
+import random
+import sys
+import time
+from StringIO import StringIO
+
+from lockbox.rsync import blockchecksums, rsyncdelta, patchstream
+
+_DEFAULT_MB = 100
+_DEFAULT_EDITS = 32
+_BLOCKSIZE = 4096
+# Blocks moved from the end of the file to the front.
+_MOVED_BLOCKS = 16
+
+
+def edit(old, num_edits):
+  rand = random.Random(0)
+  moved = _MOVED_BLOCKS * _BLOCKSIZE
+  new = old[-moved:] + old[:-moved]
+  offsets = sorted(rand.randrange(len(new)) for _ in range(num_edits))
+  parts = list()
+  last = 0
+  for offset in offsets:
+    parts.append(new[last:offset])
+    parts.append(os.urandom(rand.randrange(1, 64)))
+    last = offset
+  parts.append(new[last:])
+  return ''.join(parts)
+
+
+def main(argv):
+  size = int(argv[1] if len(argv) > 1 else _DEFAULT_MB) << 20
+  num_edits = int(argv[2] if len(argv) > 2 else _DEFAULT_EDITS)
+  old = os.urandom(size)
+  new = edit(old, num_edits)
+
+  start = time.time()
+  signatures = blockchecksums(StringIO(old), _BLOCKSIZE)
+  signed = time.time() - start
+
+  start = time.time()
+  delta = rsyncdelta(StringIO(new), signatures, _BLOCKSIZE)
+  elapsed = time.time() - start
+
+  patched = StringIO()
+  patchstream(StringIO(old), patched, delta)
+  if patched.getvalue() != new:
+    raise RuntimeError('Delta does not reproduce the new file.')
+  literal = sum(len(element) for element in delta[1:]
+                if not isinstance(element, int))
+  print ('%d MB, %d edits: signatures %.1f s, delta %.1f s (%.2f MB/s), '
+         '%d literal bytes' % (size >> 20, num_edits, signed, elapsed,
+                               (len(new) >> 20) / elapsed, literal))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
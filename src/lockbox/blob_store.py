@@ -63,4 +63,21 @@ class BlobStore(object):
   def put_filename(self, hash_file, filename):
     with open(filename) as fp:
       self.put_file(hash_file, fp)
+
+
+  def get_size(self, hash_file):
+    key = self.bucket.get_key(hash_file)
+    if not key:
+      return None
+    return key.size
+
+
+  def get_range(self, hash_file, offset, length):
+    '''Returns up to length bytes of a blob from offset with a ranged GET, e.g.,
+    to read part of a seekable blob (see seekable_crypto).'''
+    if length <= 0:
+      return ''
+    key = self.bucket.new_key(hash_file)
+    return key.get_contents_as_string(
+      headers={'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
       
\ No newline at end of file
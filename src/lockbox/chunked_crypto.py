@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""Chunked blob layout for very large files, encrypted in parallel.
+
+Encrypting a multi-gigabyte file as one blob keeps one core busy and nothing
+can be uploaded until the last byte is encrypted. A chunked blob instead cuts
+the file into fixed-size chunks that worker processes encrypt independently
+under the file version's data key (hybrid_crypto.encrypt_chunk()), each
+stored as its own object:
+
+  <blob id>.<index>
+
+The blob itself is a small manifest, a hybrid blob under the same data key,
+whose cleartext is
+
+  'LBXM' + JSON {version, blob_id, size, chunk_size, num_chunks, codec}
+
+The manifest only depends on the file's size, so it is written (and its hash,
+the blob's name, is known) before any chunk is done. Its key header also
+carries the file's path (see hybrid_crypto.read_path()). Each chunk is
+authenticated along with the blob id, its index and the number of chunks.
+
+The caller reads the file once and hands each piece to update(); whole
+chunks go to the pool as they fill up, so the chunks hold exactly the bytes
+that the caller hashed and signed. With an on_encrypted callback, each chunk
+is handed to it, in order, as soon as it is encrypted, while the file is
+still being read, so the caller can upload early chunks while later ones
+encrypt. Only max_in_flight chunks are queued, being encrypted, or encrypted
+and not yet handed out at a time; update() waits for the oldest before
+queueing more. A file whose size changed since the manifest was written
+makes finish() raise FileChangedError.
+
+The pool is forked by start_pool(), which has to run at startup before any
+threads are started.
+
+Usage:
+  start_pool()  # In main(), first thing.
+
+  encryptor = ChunkedEncryptor(gpg, recipients, path,
+                               on_encrypted=upload_and_remove)
+  encryptor.write_manifest(manifest_file)
+  while ...:
+    encryptor.update(data)
+  encryptor.finish()
+
+  decrypt_chunked(gpg, manifest_file, read_chunk, cleartext_file)
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import json
+import logging
+import multiprocessing
+import os
+import struct
+from StringIO import StringIO
+from compression import compress, decompress
+from crypto_util import get_random_uuid
+from exception import EncryptedBlobError, FileChangedError
+from hybrid_crypto import new_data_key, encrypt_stream, decrypt_stream, \
+    encrypt_chunk, decrypt_chunk
+from staging import new_file
+
+MANIFEST_MAGIC = 'LBXM'
+_MANIFEST_VERSION = 1
+
+# Files at least this big are chunked.
+CHUNKED_THRESHOLD = 64 << 20
+_CHUNK_SIZE = 8 << 20
+_CONTEXT = struct.Struct('!II')
+
+_NUM_CPUS = multiprocessing.cpu_count()
+# Chunks queued on or being encrypted by the pool, per encryptor.
+_MAX_IN_FLIGHT = 2 * _NUM_CPUS
+
+_pool = None
+
+
+def start_pool(processes=None):
+  """Forks the process pool that encrypts chunks. Forking copies only the
+  calling thread, along with whatever locks other threads hold at that
+  moment, so this has to run before any other thread starts.
+
+  Args:
+    processes: Worker processes; one per CPU by default.
+  """
+  global _pool
+  if _pool is None:
+    _pool = multiprocessing.Pool(processes or _NUM_CPUS)
+  return _pool
+
+
+def shared_pool():
+  """The process pool that start_pool() forked.
+
+  Raises:
+    ValueError: start_pool() was not called.
+  """
+  if _pool is None:
+    raise ValueError('Chunked encryption needs chunked_crypto.start_pool() '
+                     'at startup.')
+  return _pool
+
+
+def chunk_key(blob_id, index):
+  return '%s.%d' % (blob_id, index)
+
+
+def _context(blob_id, index, num_chunks):
+  return str(blob_id) + _CONTEXT.pack(index, num_chunks)
+
+
+def _encrypt_chunk(data, data_key, context, codec, directory):
+  """Runs in a pool process: encrypts one chunk into a temporary file in
+  directory.
+
+  Returns:
+    The temporary file's path.
+  """
+  if codec:
+    data = compress(data, codec)
+  with new_file(directory) as chunk_file:
+    chunk_file.write(encrypt_chunk(data_key, context, data))
+  return chunk_file.name
+
+
+class ChunkedEncryptor(object):
+  def __init__(self, gpg, recipients, path, codec='', chunk_size=None,
+               pool=None, directory=None, max_in_flight=None,
+               on_encrypted=None):
+    """
+    Args:
+      codec: compression codec to compress each chunk with, if any.
+      chunk_size: Cleartext bytes per chunk; defaults to 8 MB.
+      pool: multiprocessing.Pool to encrypt chunks on; defaults to
+        shared_pool().
+      directory: Where encrypted chunks are written; see staging.new_file().
+      max_in_flight: Chunks queued on or being encrypted by the pool, or
+        encrypted and waiting for on_encrypted, at a time; two per CPU by
+        default.
+      on_encrypted: Called with the index and temporary file of each chunk,
+        in order, once it is encrypted; the chunk no longer counts against
+        max_in_flight when it returns, so it should be done with the file.
+        Without it, the chunks are kept for wait().
+    """
+    self.gpg = gpg
+    self.recipients = recipients
+    self.path = path
+    self.codec = codec
+    self.chunk_size = chunk_size or _CHUNK_SIZE
+    self.pool = pool
+    self.directory = directory
+    self.max_in_flight = max_in_flight or _MAX_IN_FLIGHT
+    self.on_encrypted = on_encrypted
+
+    self.data_key = new_data_key()
+    self.blob_id = get_random_uuid()
+    self.size = os.path.getsize(path)
+    self.num_chunks = max(1, -(-self.size // self.chunk_size))
+    self._results = list()
+    # Chunks handed to on_encrypted so far.
+    self._num_handed_out = 0
+    # Cleartext of the chunk being filled.
+    self._pending = list()
+    self._pending_size = 0
+    self._num_read = 0
+
+
+  def chunk_key(self, index):
+    return chunk_key(self.blob_id, index)
+
+
+  def write_manifest(self, manifest_file):
+    manifest = MANIFEST_MAGIC + json.dumps({
+        'version': _MANIFEST_VERSION,
+        'blob_id': self.blob_id,
+        'size': self.size,
+        'chunk_size': self.chunk_size,
+        'num_chunks': self.num_chunks,
+        'codec': self.codec,
+        }, sort_keys=True)
+    encrypt_stream(self.gpg, self.recipients, StringIO(manifest),
+                   manifest_file, self.data_key, path=self.path)
+
+
+  def update(self, data):
+    """Takes the next piece of the file's cleartext, queueing each chunk
+    that it completes; waits while max_in_flight chunks are queued."""
+    self._num_read += len(data)
+    while data:
+      piece = data[:self.chunk_size - self._pending_size]
+      data = data[len(piece):]
+      self._pending.append(piece)
+      self._pending_size += len(piece)
+      if self._pending_size == self.chunk_size:
+        self._queue_pending()
+
+
+  def finish(self):
+    """Queues the last chunk once the whole file has gone to update() and,
+    with on_encrypted, waits to hand out the rest of the chunks.
+
+    Raises:
+      FileChangedError: The file was not the size the manifest says; the
+        chunks cannot be used.
+    """
+    if self._pending_size or not self._results:
+      self._queue_pending()
+    if self._num_read != self.size:
+      raise FileChangedError('(%s) changed size from %d to %d bytes while '
+                             'it was encrypted.' %
+                             (self.path, self.size, self._num_read))
+    if self.on_encrypted:
+      self._hand_out(len(self._results))
+
+
+  def _hand_out(self, count):
+    """Hands the chunks that are encrypted to on_encrypted, waiting for the
+    first count of them."""
+    while self._num_handed_out < len(self._results):
+      index = self._num_handed_out
+      if index >= count and not self._results[index].ready():
+        return
+      self.on_encrypted(index, self.wait(index))
+      self._num_handed_out += 1
+
+
+  def _queue_pending(self):
+    index = len(self._results)
+    if index >= self.max_in_flight:
+      oldest = index - self.max_in_flight
+      if self.on_encrypted:
+        self._hand_out(oldest + 1)
+      else:
+        self._results[oldest].wait()
+    if index == 0:
+      logging.info('Encrypting (%s) as %d chunk(s).' %
+                   (self.path, self.num_chunks))
+    data = ''.join(self._pending)
+    self._pending = list()
+    self._pending_size = 0
+    pool = self.pool or shared_pool()
+    self._results.append(pool.apply_async(_encrypt_chunk, (
+          data, self.data_key, _context(self.blob_id, index, self.num_chunks),
+          self.codec, self.directory)))
+    if self.on_encrypted:
+      self._hand_out(0)
+
+
+  def wait(self, index):
+    """Blocks until chunk index is encrypted.
+
+    Returns:
+      Path of the temporary file holding the encrypted chunk.
+    """
+    return self._results[index].get()
+
+
+  def discard(self):
+    """Waits for the chunks still being encrypted and removes the files of
+    those not handed out."""
+    for result in self._results[self._num_handed_out:]:
+      try:
+        path = result.get()
+      except Exception, e:
+        logging.error('Chunk encryption failed: %s' % e)
+        continue
+      if os.path.exists(path):
+        os.remove(path)
+    self._results = list()
+
+
+def is_manifest(cleartext):
+  return cleartext[:len(MANIFEST_MAGIC)] == MANIFEST_MAGIC
+
+
+def decrypt_chunked(gpg, manifest_file, read_chunk, outfile, passphrase=None):
+  """Writes the cleartext of a chunked blob.
+
+  Args:
+    manifest_file: File-like object holding the (encrypted) blob.
+    read_chunk: Returns the stored contents of the chunk with a given key.
+    outfile: File-like object to write() the cleartext to.
+
+  Raises:
+    EncryptedBlobError: The manifest or a chunk is corrupt, or the blob is not
+      chunked.
+  """
+  manifest = StringIO()
+  data_key = decrypt_stream(gpg, manifest_file, manifest,
+                            passphrase=passphrase)
+  manifest = manifest.getvalue()
+  if not is_manifest(manifest):
+    raise EncryptedBlobError('Not a chunked blob.')
+  manifest = json.loads(manifest[len(MANIFEST_MAGIC):])
+  if manifest['version'] != _MANIFEST_VERSION:
+    raise EncryptedBlobError('Unknown manifest version (%s).' %
+                             manifest['version'])
+  blob_id = manifest['blob_id']
+  num_chunks = manifest['num_chunks']
+  size = 0
+  for index in range(num_chunks):
+    data = decrypt_chunk(data_key, _context(blob_id, index, num_chunks),
+                         read_chunk(chunk_key(blob_id, index)))
+    if manifest['codec']:
+      data = decompress(data, manifest['codec'])
+    size += len(data)
+    outfile.write(data)
+  if size != manifest['size']:
+    raise EncryptedBlobError('Chunked blob has %d bytes; expected %d.' %
+                             (size, manifest['size']))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Adaptive compression of cleartext on its way to encryption.
+
+Ciphertext does not compress, so anything we want to save on the wire has to
+be saved before encryption. choose_codec() picks a codec per file: files whose
+extension says they are already compressed (images, video, archives, ...) are
+stored as they are, and the rest are judged by the byte entropy of a sample of
+their leading blocks:
+
+  entropy >= 7.5 bits/byte  store  (random-looking; compression would not pay)
+  entropy >= 5.0 bits/byte  zlib   (fast, good on mixed data)
+  below                     bz2    (slower, but much smaller on text and logs)
+
+Compressed streams start with a header naming the codec, which is encrypted
+along with the data:
+
+  magic    'LBXC'
+  version  1 byte
+  codec    1 byte
+
+Usage:
+  codec = choose_codec(path)
+  reader = CompressingReader(open(path, 'rb'), codec)
+  gpg.encrypt_file(reader, ...)
+
+  decompress_stream(decrypted_file, cleartext_file)
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import bz2
+import math
+import os
+import struct
+import zlib
+
+COMPRESSION_OFF = 'off'
+COMPRESSION_ADAPTIVE = 'adaptive'
+COMPRESSION_MODES = [COMPRESSION_OFF, COMPRESSION_ADAPTIVE]
+
+CODEC_STORE = 'store'
+CODEC_ZLIB = 'zlib'
+CODEC_BZ2 = 'bz2'
+CODECS = [CODEC_STORE, CODEC_ZLIB, CODEC_BZ2]
+
+MAGIC = 'LBXC'
+_VERSION = 1
+_HEADER = struct.Struct('!4sBB')
+
+_SAMPLE_BLOCK_SIZE = 16 << 10
+_SAMPLE_BLOCKS = 4
+# Bytes choose_codec() looks at.
+SAMPLE_SIZE = _SAMPLE_BLOCKS * _SAMPLE_BLOCK_SIZE
+_STORE_ENTROPY = 7.5
+_ZLIB_ENTROPY = 5.0
+_ZLIB_LEVEL = 6
+_BZ2_LEVEL = 9
+
+_CHUNK_SIZE = 1 << 20
+
+# Formats that are compressed already.
+_COMPRESSED_EXTENSIONS = frozenset([
+  '.7z', '.aac', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.jar',
+  '.jpeg', '.jpg', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4', '.ogg',
+  '.pdf', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp', '.xlsx', '.xz',
+  '.zip',
+  ])
+
+
+def sample_entropy(data):
+  """Shannon entropy of data, in bits per byte (0 to 8)."""
+  if not data:
+    return 0.
+  total = float(len(data))
+  entropy = 0.
+  for byte in range(256):
+    count = data.count(chr(byte))
+    if count:
+      p = count / total
+      entropy -= p * math.log(p, 2)
+  return entropy
+
+
+def _read_sample(path):
+  """Up to _SAMPLE_BLOCKS leading blocks of path."""
+  with open(path, 'rb') as sample_file:
+    return sample_file.read(SAMPLE_SIZE)
+
+
+def choose_codec(path, sample=None):
+  """
+  Args:
+    path: The file to compress.
+    sample: Its leading bytes, if they are at hand (e.g., for data that is
+      not in a file yet); read from path otherwise.
+  """
+  if os.path.splitext(path)[1].lower() in _COMPRESSED_EXTENSIONS:
+    return CODEC_STORE
+  if sample is None:
+    sample = _read_sample(path)
+  entropy = sample_entropy(sample[:SAMPLE_SIZE])
+  if entropy >= _STORE_ENTROPY:
+    return CODEC_STORE
+  if entropy >= _ZLIB_ENTROPY:
+    return CODEC_ZLIB
+  return CODEC_BZ2
+
+
+class _Store(object):
+  def compress(self, data):
+    return data
+
+  def flush(self):
+    return ''
+
+
+def _compressor(codec):
+  if codec == CODEC_STORE:
+    return _Store()
+  if codec == CODEC_ZLIB:
+    return zlib.compressobj(_ZLIB_LEVEL)
+  if codec == CODEC_BZ2:
+    return bz2.BZ2Compressor(_BZ2_LEVEL)
+  raise ValueError('Unknown codec (%s).' % codec)
+
+
+def _decompressor(codec):
+  if codec == CODEC_STORE:
+    return lambda data: data
+  if codec == CODEC_ZLIB:
+    return zlib.decompressobj().decompress
+  if codec == CODEC_BZ2:
+    return bz2.BZ2Decompressor().decompress
+  raise ValueError('Unknown codec (%s).' % codec)
+
+
+def compress(data, codec):
+  """Compresses data on its own, without a header."""
+  compressor = _compressor(codec)
+  return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, codec):
+  return _decompressor(codec)(data)
+
+
+class CompressingReader(object):
+  """File-like reader that returns the header and then infile compressed
+  with codec."""
+  def __init__(self, infile, codec):
+    self.infile = infile
+    self.codec = codec
+    self._compressor = _compressor(codec)
+    # Compressed bytes not yet returned start at _pending[_offset:]. Callers
+    # (e.g., gnupg) read small chunks, so we hand out slices of _pending
+    # rather than copying what is left of it on every read.
+    self._pending = _HEADER.pack(MAGIC, _VERSION, CODECS.index(codec))
+    self._offset = 0
+    self._eof = False
+
+
+  def _fill(self, size):
+    chunks = [self._pending[self._offset:]]
+    available = len(chunks[0])
+    while not self._eof and (size < 0 or available < size):
+      data = self.infile.read(_CHUNK_SIZE)
+      if data:
+        data = self._compressor.compress(data)
+      else:
+        data = self._compressor.flush()
+        self._eof = True
+      chunks.append(data)
+      available += len(data)
+    self._pending = ''.join(chunks)
+    self._offset = 0
+
+
+  def read(self, size=-1):
+    if size < 0 or len(self._pending) - self._offset < size:
+      self._fill(size)
+    if size < 0:
+      size = len(self._pending) - self._offset
+    data = self._pending[self._offset:self._offset + size]
+    self._offset += len(data)
+    return data
+
+
+  def close(self):
+    self.infile.close()
+
+
+def is_compressed(prefix):
+  return prefix[:len(MAGIC)] == MAGIC
+
+
+def decompress_stream(infile, outfile):
+  """Writes the cleartext of a stream that CompressingReader produced.
+
+  Returns:
+    The codec it was compressed with.
+  """
+  header = infile.read(_HEADER.size)
+  if len(header) != _HEADER.size:
+    raise ValueError('Compressed stream is truncated.')
+  magic, version, codec_index = _HEADER.unpack(header)
+  if magic != MAGIC or version != _VERSION or codec_index >= len(CODECS):
+    raise ValueError('Not a version %d compressed stream.' % _VERSION)
+  codec = CODECS[codec_index]
+  decompress = _decompressor(codec)
+  while True:
+    data = infile.read(_CHUNK_SIZE)
+    if not data:
+      break
+    outfile.write(decompress(data))
+  return codec
@@ -1,10 +1,23 @@
 #!/usr/bin/env python
 
 import logging
+import mmap
 import os
+import threading
 from hashlib import sha1
 from uuid import uuid4
 
+# Bytes hashed per read. Peak memory for hashing a file is one such buffer per
+# thread, whatever the size of the file.
+_HASH_CHUNK_SIZE = 1 << 20
+# Files at least this big are hashed through mmap instead of read buffers.
+_MMAP_THRESHOLD = 64 << 20
+# Bytes mapped at a time. Must be a multiple of mmap.ALLOCATIONGRANULARITY.
+_MMAP_WINDOW_SIZE = 16 << 20
+
+# Holds each thread's reusable read buffer.
+_thread_local = threading.local()
+
 def get_random_uuid():
   return unicode(uuid4().hex)
 
@@ -22,8 +35,16 @@ def hash_string(string):
   return h.hexdigest()
 
 
+def _read_buffer():
+  buf = getattr(_thread_local, 'read_buffer', None)
+  if buf is None:
+    buf = _thread_local.read_buffer = bytearray(_HASH_CHUNK_SIZE)
+  return buf
+
+
 def hash_file(file_handle):
-  """Hashes an opened file handle.
+  """Hashes an opened file handle, from its current position to the end, in
+  fixed-size chunks read into a reusable per-thread buffer.
 
   Args:
     file_handle: An open file (callable seek(), read(), etc. methods).
@@ -32,16 +53,81 @@ def hash_file(file_handle):
     SHA1 of string.
   """
   assert isinstance(file_handle, file)
-  return hash_string(file_handle.read())
+  h = sha1()
+  buf = _read_buffer()
+  view = memoryview(buf)
+  while True:
+    num_read = file_handle.readinto(buf)
+    if not num_read:
+      break
+    h.update(view[:num_read])
+  return h.hexdigest()
+
+
+def hash_mmap(file_handle):
+  """Hashes a whole file by mapping it a window at a time rather than copying
+  it through a read buffer. Each window is unmapped before the next is mapped,
+  so at most _MMAP_WINDOW_SIZE bytes of the file are resident on its account.
+
+  Args:
+    file_handle: An open file.
+
+  Returns:
+    SHA1 of the file's contents.
+  """
+  h = sha1()
+  size = os.fstat(file_handle.fileno()).st_size
+  for window_offset in xrange(0, size, _MMAP_WINDOW_SIZE):
+    window_size = min(_MMAP_WINDOW_SIZE, size - window_offset)
+    mapped = mmap.mmap(file_handle.fileno(), window_size,
+                       access=mmap.ACCESS_READ, offset=window_offset)
+    try:
+      for offset in xrange(0, window_size, _HASH_CHUNK_SIZE):
+        h.update(buffer(mapped, offset, _HASH_CHUNK_SIZE))
+    finally:
+      mapped.close()
+  return h.hexdigest()
 
 
-def hash_filename(filename):
+def hash_filename(filename, use_mmap=None):
+  """Hashes the file at filename in constant memory.
+
+  Args:
+    filename: Path to the file.
+    use_mmap: Whether to hash through mmap. By default, only files of at least
+      _MMAP_THRESHOLD bytes are.
+
+  Returns:
+    SHA1 of the file's contents, or False if there is no such file.
+  """
   if not os.path.exists(filename):
     return False
 
-  with open(filename) as fh:
+  with open(filename, 'rb') as fh:
+    size = os.fstat(fh.fileno()).st_size
+    if use_mmap is None:
+      use_mmap = size >= _MMAP_THRESHOLD
+    if use_mmap:
+      return hash_mmap(fh)
     return hash_file(fh)
 
 
+class HashingWriter(object):
+  """Writes through to a file while hashing what passes, so that output can
+  be hashed without being read back."""
+  def __init__(self, outfile):
+    self.outfile = outfile
+    self._sha1 = sha1()
+
+
+  def write(self, data):
+    self._sha1.update(data)
+    self.outfile.write(data)
+
+
+  def hexdigest(self):
+    return self._sha1.hexdigest()
+
+
 def lock_name(object_hash):
   return '%s-lock-%s' % (object_hash, get_random_uuid())
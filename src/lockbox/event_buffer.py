@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Group-commit buffer that sits between the watchdog thread and the queue
+table.
+
+Usage:
+  event_buffer = EventBuffer(write_events)
+  event_buffer.start()
+
+  event_buffer.put(item)  # Cheap; never touches the database.
+
+  event_buffer.stop()     # Writes out whatever is still buffered.
+  event_buffer.join()
+
+write_events is called with a list of buffered items, oldest first, either
+once flush_count items have piled up or flush_interval seconds after the last
+write, whichever comes first. Calls never overlap, so writes happen in the
+order the items were put.
+
+If write_events raises, its items go back to the head of the buffer and are
+written again, ahead of newer ones, after a delay that doubles with each
+failure in a row; nothing is dropped.
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import logging
+import threading
+from collections import deque
+
+_FLUSH_COUNT = 512
+_FLUSH_INTERVAL_SECONDS = 0.05
+# Producers block once this many items are waiting to be written.
+_CAPACITY = 65536
+# Delay before the first retry of a failed write, and the most it grows to.
+_RETRY_SECONDS = 0.1
+_MAX_RETRY_SECONDS = 30.
+
+
+class EventBuffer(threading.Thread):
+  def __init__(self, write_events, flush_count=_FLUSH_COUNT,
+               flush_interval=_FLUSH_INTERVAL_SECONDS, capacity=_CAPACITY):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.write_events = write_events
+    self.flush_count = flush_count
+    self.flush_interval = flush_interval
+    self.capacity = capacity
+
+    self._items = deque()
+    self._not_full = threading.Condition()
+    self._flush_needed = threading.Event()
+    self._flush_lock = threading.Lock()
+    self._stop = threading.Event()
+
+
+  def put(self, item):
+    with self._not_full:
+      while len(self._items) >= self.capacity and self.is_alive():
+        self._not_full.wait(self.flush_interval)
+      self._items.append(item)
+      pending = len(self._items)
+
+    if self._stop.is_set():
+      # Nobody is left to flush for us.
+      self.flush()
+    elif pending >= self.flush_count:
+      self._flush_needed.set()
+
+
+  def flush(self):
+    """Writes out everything buffered so far on the calling thread.
+
+    Returns:
+      Number of items written.
+
+    Raises:
+      Whatever write_events raised; the items are back in the buffer.
+    """
+    with self._flush_lock:
+      with self._not_full:
+        items = list(self._items)
+        self._items.clear()
+        self._not_full.notify_all()
+      if items:
+        try:
+          self.write_events(items)
+        except Exception:
+          with self._not_full:
+            self._items.extendleft(reversed(items))
+          raise
+    return len(items)
+
+
+  def pending(self):
+    """Number of items not yet written."""
+    return len(self._items)
+
+
+  def stop(self):
+    self._stop.set()
+    self._flush_needed.set()
+
+
+  def run(self):
+    retry_delay = 0
+    while not self._stop.is_set():
+      if retry_delay:
+        self._stop.wait(retry_delay)
+      else:
+        self._flush_needed.wait(self.flush_interval)
+        self._flush_needed.clear()
+      try:
+        self.flush()
+        retry_delay = 0
+      except Exception, e:
+        retry_delay = min(2 * retry_delay or _RETRY_SECONDS,
+                          _MAX_RETRY_SECONDS)
+        logging.error('Writing %d buffered event(s) failed; retrying in '
+                      '%.1f s: %s' % (self.pending(), retry_delay, e))
+
+    try:
+      logging.info('EventBuffer shutting down; flushed %d event(s).' %
+                   self.flush())
+    except Exception, e:
+      logging.error('EventBuffer shutting down with %d event(s) not '
+                    'written: %s' % (self.pending(), e))
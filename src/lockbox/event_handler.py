@@ -55,9 +55,10 @@ class LockboxEventHandler(FileSystemEventHandler):
     else:
       log_statement += '.'
 
-    logging.info(log_statement)
+    # Runs once per event on the observer thread, so keep it quiet.
+    logging.debug(log_statement)
     if event.is_directory:
-      logging.info('Do NOT work with directories alone.')
+      logging.debug('Do NOT work with directories alone.')
       return
 
     if not self.mediator.enqueue(event):
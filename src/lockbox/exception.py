@@ -7,3 +7,9 @@ class VersioningError(StandardError): pass
 class AlreadyWatchedDirectoryError(StandardError): pass
 
 class AlreadyEncapsulatedDirectoryError(StandardError): pass
+
+class EncryptedBlobError(StandardError): pass
+
+class GpgCancelledError(StandardError): pass
+
+class FileChangedError(StandardError): pass
@@ -18,6 +18,41 @@ STATUS_UPLOADING = 'uploading'
 STATUS_FAILED = 'failed'
 STATUS_COMPLETED = 'completed'
 
+
+def coalesce_event_types(pending_event_type, event_type):
+  """Folds a new event into one that is still waiting to be processed for the
+  same path.
+
+  Args:
+    pending_event_type: Event type of the queued, not yet dispatched, event.
+    event_type: Event type of the event that just arrived.
+
+  Returns:
+    The event type that covers both events, None if the two cancel out (the
+    file came and went before we looked at it), or False if the events cannot
+    be merged and must be queued separately.
+  """
+  if EVENT_TYPE_MOVED in (pending_event_type, event_type):
+    return False
+
+  if pending_event_type == EVENT_TYPE_CREATED:
+    if event_type == EVENT_TYPE_DELETED:
+      return None
+    return EVENT_TYPE_CREATED
+
+  if pending_event_type == EVENT_TYPE_MODIFIED:
+    if event_type == EVENT_TYPE_DELETED:
+      return EVENT_TYPE_DELETED
+    return EVENT_TYPE_MODIFIED
+
+  if pending_event_type == EVENT_TYPE_DELETED:
+    if event_type == EVENT_TYPE_DELETED:
+      return EVENT_TYPE_DELETED
+    # Deleted and then recreated: the remote copy just needs new contents.
+    return EVENT_TYPE_MODIFIED
+
+  return False
+
 class FileChangeStatus(object):
   def __init__(self, timestamp, event, state = STATUS_PREPARE):
     assert isinstance(timestamp, float)
@@ -4,9 +4,40 @@
 import logging
 import os
 from binascii import b2a_base64, a2b_base64
-from crypto_util import hash_string, hash_filename
-from librsync import SigFile, DeltaFile
-from tempfile import NamedTemporaryFile
+from hashlib import sha1
+from chunked_crypto import CHUNKED_THRESHOLD, ChunkedEncryptor, chunk_key
+from compression import COMPRESSION_OFF, SAMPLE_SIZE, CompressingReader, \
+    choose_codec
+from crypto_util import hash_string, HashingWriter
+from hybrid_crypto import BULK_CIPHER_GPG, BULK_CIPHER_AES, \
+    BULK_CIPHER_SEEKABLE, PATH_HEADER_PREFIX, encrypt_stream, \
+    header_reference
+from librsync import SigFile, DeltaFile, SigGenerator
+import seekable_crypto
+from spool import Spool
+
+# Bytes read at a time when only signing and hashing.
+_READ_SIZE = 1 << 20
+
+
+class _TeeReader(object):
+  """File-like reader that also hands every chunk it reads to callbacks, so
+  that other consumers see the data without another read."""
+  def __init__(self, infile, *callbacks):
+    self.infile = infile
+    self.callbacks = callbacks
+
+
+  def read(self, size=-1):
+    data = self.infile.read(size)
+    if data:
+      for callback in self.callbacks:
+        callback(data)
+    return data
+
+
+  def close(self):
+    self.infile.close()
 
 
 class FileUpdateCrypto(object):
@@ -20,28 +51,148 @@ class FileUpdateCrypto(object):
     file_path: Path to file.
     recipients: List of recipients. Should correspond to GPG uids or keyids or
       fingerprints that have ALREADY BEEN VALIDATED before being passed in.
+    bulk_cipher: hybrid_crypto.BULK_CIPHER_GPG to pipe blobs through gpg,
+      BULK_CIPHER_AES to encrypt them with AES under a gpg-wrapped key, or
+      BULK_CIPHER_SEEKABLE to do so in segments that can be read back by
+      range (see seekable_crypto).
+    compression: compression.COMPRESSION_OFF, or COMPRESSION_ADAPTIVE to
+      compress what is encrypted with a codec chosen per file.
+    staging_dir: Where temporary files go (see staging); the system's
+      temporary directory if None.
+    codec: The codec the blob was compressed with, if any.
+    blob_id: For chunked blobs (see chunked_crypto), the id their chunks are
+      stored under; the blob itself is the chunk manifest.
+    chunk_paths: For chunked blobs, each chunk's encrypted temporary file;
+      None until it is encrypted and '' once it is uploaded.
+    hash_of_cleartext: SHA1 of the file's contents, as read for signing.
     hash_of_encrypted_blob: SHA1 of the PGP-encrypted file.
     raw_data_of_encrypted_blob_path: Raw data of the PGP-encrypted blob path.
-    path_to_encrypted_blob:
+    encrypted_blob: spool.Spool holding the encrypted file (or delta).
+    path_to_encrypted_blob: Its temporary file; '' while it is in memory.
+    delta: spool.Spool holding the cleartext delta, for modifications.
+    delta_file_path: Its temporary file; '' while it is in memory.
     hash_of_raw_data_of_encrypted_blob_path: This is the key in S3 for the
-      decryptable raw data of the blob path.
+      decryptable raw data of the blob path; for new files under the AES and
+      seekable bulk ciphers, a reference to the blob, whose key header holds
+      the path (see hybrid_crypto.header_reference()).
   """
-  def __init__(self, gpg, file_path, recipients):
+  def __init__(self, gpg, file_path, recipients, bulk_cipher=BULK_CIPHER_GPG,
+               compression=COMPRESSION_OFF, staging_dir=None):
     self.gpg = gpg
     self.file_path = file_path
     self.recipients = recipients
+    self.bulk_cipher = bulk_cipher
+    self.compression = compression
+    self.staging_dir = staging_dir
+    self.codec = ''
+    self.blob_id = ''
+    self.chunk_paths = list()
+    self._chunked_encryptor = None
+    # Set on restore if the checkpoint had outputs that were only in memory.
+    self._lost_in_memory = False
     self.hash_of_file_path = ''
+    self.hash_of_cleartext = ''
     self.hash_of_encrypted_blob = ''
+    self.encrypted_blob = None
     self.path_to_encrypted_blob = ''
     self.hash_of_raw_data_of_encrypted_blob_path = ''
     self.raw_data_of_encrypted_blob_path = ''
+    self.delta = None
     self.delta_file_path = ''
+    self.ascii_signature = ''
+
+
+  def checkpoint(self):
+    """Returns what has been computed so far as a JSON-friendly dict that
+    restore() accepts."""
+    return {
+      'file_path': self.file_path,
+      'recipients': self.recipients,
+      'bulk_cipher': self.bulk_cipher,
+      'compression': self.compression,
+      'staging_dir': self.staging_dir,
+      'codec': self.codec,
+      'blob_id': self.blob_id,
+      'chunk_paths': self.chunk_paths,
+      'in_memory': any(spool.in_memory() for spool in
+                       [self.delta, self.encrypted_blob] if spool),
+      'hash_of_file_path': self.hash_of_file_path,
+      'hash_of_cleartext': self.hash_of_cleartext,
+      'hash_of_encrypted_blob': self.hash_of_encrypted_blob,
+      'path_to_encrypted_blob': self.path_to_encrypted_blob,
+      'hash_of_raw_data_of_encrypted_blob_path':
+        self.hash_of_raw_data_of_encrypted_blob_path,
+      'raw_data_of_encrypted_blob_path':
+        b2a_base64(self.raw_data_of_encrypted_blob_path),
+      'delta_file_path': self.delta_file_path,
+      'ascii_signature': self.ascii_signature,
+      }
+
+
+  @staticmethod
+  def restore(gpg, checkpoint):
+    crypto = FileUpdateCrypto(gpg, checkpoint['file_path'],
+                              checkpoint['recipients'],
+                              checkpoint.get('bulk_cipher', BULK_CIPHER_GPG),
+                              checkpoint.get('compression', COMPRESSION_OFF),
+                              checkpoint.get('staging_dir'))
+    crypto.codec = checkpoint.get('codec', '')
+    crypto.blob_id = checkpoint.get('blob_id', '')
+    crypto.chunk_paths = checkpoint.get('chunk_paths', list())
+    crypto.hash_of_file_path = checkpoint['hash_of_file_path']
+    crypto.hash_of_cleartext = checkpoint.get('hash_of_cleartext', '')
+    crypto.hash_of_encrypted_blob = checkpoint['hash_of_encrypted_blob']
+    crypto.path_to_encrypted_blob = checkpoint['path_to_encrypted_blob']
+    if crypto.path_to_encrypted_blob:
+      crypto.encrypted_blob = Spool.from_path(crypto.path_to_encrypted_blob)
+    crypto.hash_of_raw_data_of_encrypted_blob_path = \
+        checkpoint['hash_of_raw_data_of_encrypted_blob_path']
+    crypto.raw_data_of_encrypted_blob_path = \
+        a2b_base64(checkpoint['raw_data_of_encrypted_blob_path'])
+    crypto.delta_file_path = checkpoint['delta_file_path']
+    if crypto.delta_file_path:
+      crypto.delta = Spool.from_path(crypto.delta_file_path)
+    crypto.ascii_signature = checkpoint['ascii_signature']
+    crypto._lost_in_memory = checkpoint.get('in_memory', False)
+    return crypto
+
+
+  def temp_files(self):
+    """Paths of the temporary files made so far."""
+    return [path for path in [self.delta_file_path,
+                              self.path_to_encrypted_blob] + self.chunk_paths
+            if path]
+
+
+  def resumable(self):
+    """Whether a restored copy can carry on: outputs that were in memory, and
+    chunks that were still being encrypted, when this was checkpointed are
+    lost."""
+    return not self._lost_in_memory and None not in self.chunk_paths
+
+
+  def path_in_header(self):
+    """Whether the path went out in the blob's key header, so it needs no
+    gpg call or blob of its own."""
+    return self.hash_of_raw_data_of_encrypted_blob_path.startswith(
+      PATH_HEADER_PREFIX)
+
+
+  def _set_path_in_header(self):
+    self.raw_data_of_encrypted_blob_path = ''
+    self.hash_of_raw_data_of_encrypted_blob_path = \
+        header_reference(self.hash_of_encrypted_blob)
+
+
+  def encrypted_blob_size(self):
+    if self.encrypted_blob:
+      return self.encrypted_blob.size
+    return os.path.getsize(self.path_to_encrypted_blob)
 
 
   def run(self):
     self.hash_file_path()
-    self.rsync_signature()
-    self.encrypt()
+    self.sign_and_encrypt()
 
 
   def hash_file_path(self):
@@ -64,36 +215,86 @@ class FileUpdateCrypto(object):
 
 
   def compute_cleartext_delta(self, prev_signature, latest_filename):
-    with NamedTemporaryFile(delete=False) as cleartext_delta_file:
-      with open(latest_filename) as latest_file:
-        delta_file = DeltaFile(a2b_base64(prev_signature), latest_file)
-        delta = b2a_base64(delta_file.read())
-      cleartext_delta_file.write(delta)
-      self.delta_file_path = cleartext_delta_file.name
-      return cleartext_delta_file.name
+    """Computes the delta from prev_signature to latest_filename and, from
+    the same read of the file, its new rsync signature.
+
+    Returns:
+      The Spool holding the delta.
+    """
+    sig_generator = SigGenerator()
+    cleartext_hash = sha1()
+    self.delta = Spool(directory=self.staging_dir)
+    with open(latest_filename, 'rb') as latest_file:
+      delta_file = DeltaFile(a2b_base64(prev_signature),
+                             _TeeReader(latest_file, sig_generator.update,
+                                        cleartext_hash.update))
+      self.delta.write(b2a_base64(delta_file.read()))
+    self.delta.close()
+    self.delta_file_path = self.delta.path
+    self.ascii_signature = b2a_base64(sig_generator.getsig())
+    self.hash_of_cleartext = cleartext_hash.hexdigest()
+    return self.delta
 
 
   def encrypt_delta_file(self):
-    assert os.path.exists(self.delta_file_path)
-    self.encrypt_file(self.delta_file_path)
+    assert self.delta is not None
+    # The delta is base64 text whatever the file's type, so only its
+    # contents matter for the codec.
+    codec = self._choose_codec('', self.delta.head(SAMPLE_SIZE))
+    with self.delta.open() as delta_file:
+      self._encrypt_stream(delta_file, codec)
+
+
+  def _choose_codec(self, path, sample=None):
+    # Offsets in a seekable blob are cleartext offsets only if it is not
+    # compressed.
+    if self.compression == COMPRESSION_OFF or \
+          self.bulk_cipher == BULK_CIPHER_SEEKABLE:
+      return ''
+    codec = choose_codec(path, sample)
+    logging.debug('Compressing (%s) with %s.' % (path, codec))
+    return codec
+
+
+  def _encrypt_stream(self, cleartext_file, codec, path=None):
+    """Encrypts cleartext_file into a Spool with the bulk cipher, compressing
+    it first with codec, if any, and hashing the ciphertext as it is
+    written.
+
+    Args:
+      path: The file's path, to put in the key header under the AES and
+        seekable bulk ciphers.
+    """
+    self.codec = codec
+    if codec:
+      cleartext_file = CompressingReader(cleartext_file, codec)
+    self.encrypted_blob = Spool(directory=self.staging_dir)
+    hashing_writer = HashingWriter(self.encrypted_blob)
+    if self.bulk_cipher == BULK_CIPHER_AES:
+      encrypt_stream(self.gpg, self.recipients, cleartext_file, hashing_writer,
+                     path=path)
+    elif self.bulk_cipher == BULK_CIPHER_SEEKABLE:
+      seekable_crypto.encrypt_stream(self.gpg, self.recipients, cleartext_file,
+                                     hashing_writer, path=path)
+    else:
+      self.gpg.encrypt_file(cleartext_file, self.recipients,
+                            always_trust=True, armor=False,
+                            output_stream=hashing_writer)
+    self.encrypted_blob.close()
+    self.path_to_encrypted_blob = self.encrypted_blob.path
+    self.hash_of_encrypted_blob = hashing_writer.hexdigest()
+    if path is not None and self.bulk_cipher != BULK_CIPHER_GPG:
+      self._set_path_in_header()
 
 
   def encrypt_file(self, file_path):
     # GPG-encrypt and hash the file, filepath.
-    with open(file_path) as cleartext_file:
-      with NamedTemporaryFile(delete=False) as encrypted_blob_file:
-        self.path_to_encrypted_blob = encrypted_blob_file.name
-        self.gpg.encrypt_file(cleartext_file, self.recipients,
-                              always_trust=True, armor=False,
-                              output=self.path_to_encrypted_blob)
-    self.hash_of_encrypted_blob = hash_filename(self.path_to_encrypted_blob)
+    with open(file_path, 'rb') as cleartext_file:
+      self._encrypt_stream(cleartext_file, self._choose_codec(file_path),
+                           self.file_path)
 
 
-  def encrypt(self):
-    self.encrypt_file(self.file_path)
-    self.hash_of_encrypted_blob = hash_filename(self.path_to_encrypted_blob)
-
-    # File path encryption.
+  def encrypt_path(self):
     encrypted_blob_path = self.gpg.encrypt(self.file_path, self.recipients,
                                            always_trust=True, armor=False)
     self.raw_data_of_encrypted_blob_path = encrypted_blob_path.data
@@ -101,9 +302,122 @@ class FileUpdateCrypto(object):
       hash_string(self.raw_data_of_encrypted_blob_path)
 
 
+  def encrypt(self):
+    self.encrypt_file(self.file_path)
+    # File path encryption.
+    if not self.path_in_header():
+      self.encrypt_path()
+
+
+  def _chunked(self):
+    return self.bulk_cipher == BULK_CIPHER_AES and \
+        os.path.getsize(self.file_path) >= CHUNKED_THRESHOLD
+
+
+  def _start_chunked_encryption(self, upload_chunk=None):
+    """Writes the chunk manifest as the blob; the chunks are encrypted in
+    the background as the file is read (ChunkedEncryptor.update())."""
+    self.codec = self._choose_codec(self.file_path)
+
+    def chunk_encrypted(index, path):
+      self.chunk_paths[index] = path
+      upload_chunk(index, chunk_key(self.blob_id, index), path)
+
+    encryptor = ChunkedEncryptor(
+      self.gpg, self.recipients, self.file_path, self.codec,
+      directory=self.staging_dir,
+      on_encrypted=chunk_encrypted if upload_chunk else None)
+    self.encrypted_blob = Spool(directory=self.staging_dir)
+    hashing_writer = HashingWriter(self.encrypted_blob)
+    encryptor.write_manifest(hashing_writer)
+    self.encrypted_blob.close()
+    self.path_to_encrypted_blob = self.encrypted_blob.path
+    self.hash_of_encrypted_blob = hashing_writer.hexdigest()
+    self._set_path_in_header()
+    self.blob_id = encryptor.blob_id
+    self.chunk_paths = [None] * encryptor.num_chunks
+    self._chunked_encryptor = encryptor
+
+
+  def encrypted_chunks(self):
+    """Yields (index, blob store key, temporary file) for each chunk not yet
+    uploaded, in order."""
+    for index, path in enumerate(self.chunk_paths):
+      if path:
+        yield index, chunk_key(self.blob_id, index), path
+
+
+  def chunk_uploaded(self, index):
+    os.remove(self.chunk_paths[index])
+    self.chunk_paths[index] = ''
+
+
+  def sign_and_encrypt(self, with_path=True, upload_chunk=None):
+    """Does the work of rsync_signature() and encrypt() with a single read of
+    the file: every chunk sent to gpg also goes to the signature and the
+    cleartext hash.
+
+    Large files under the AES bulk cipher are chunked instead: the chunks
+    read for the signature and the hash are encrypted by a process pool.
+
+    Raises:
+      FileChangedError: A chunked file changed size while it was read.
+
+    Under the AES and seekable bulk ciphers the path goes in the blob's key
+    header, with no gpg call of its own.
+
+    Args:
+      with_path: Whether to also encrypt the file path on its own when it is
+        not in the key header. Leave it out when the path is published in a
+        batch (see path_manifest).
+      upload_chunk: Called with (index, blob store key, temporary file) for
+        each chunk, in order, as soon as it is encrypted, while the file is
+        still being read; it has to call chunk_uploaded(). Reading waits
+        while the encryptor's max_in_flight chunks are not yet uploaded.
+        Without it, the chunks are left for encrypted_chunks().
+    """
+    sig_generator = SigGenerator()
+    cleartext_hash = sha1()
+    chunked = self._chunked()
+    if chunked:
+      self._start_chunked_encryption(upload_chunk)
+    with open(self.file_path, 'rb') as cleartext_file:
+      if chunked:
+        reader = _TeeReader(cleartext_file, sig_generator.update,
+                            cleartext_hash.update,
+                            self._chunked_encryptor.update)
+        while reader.read(_READ_SIZE):
+          pass
+        self._chunked_encryptor.finish()
+        for index, path in enumerate(self.chunk_paths):
+          if path is None:
+            self.chunk_paths[index] = self._chunked_encryptor.wait(index)
+      else:
+        reader = _TeeReader(cleartext_file, sig_generator.update,
+                            cleartext_hash.update)
+        self._encrypt_stream(reader, self._choose_codec(self.file_path),
+                             self.file_path)
+    self.ascii_signature = b2a_base64(sig_generator.getsig())
+    self.hash_of_cleartext = cleartext_hash.hexdigest()
+    logging.info('File (%s) signature: (%s).' %
+                 (self.file_path, self.ascii_signature))
+    if with_path and not self.path_in_header():
+      self.encrypt_path()
+
+
   def cleanup(self):
-    if not os.path.exists(self.path_to_encrypted_blob):
-      logging.error('Temporary encrypted file disappeared; original file %s.' %
-                    self.file_path)
-    os.remove(self.path_to_encrypted_blob)
+    for path in self.temp_files():
+      if not os.path.exists(path):
+        logging.error('Temporary file (%s) disappeared; original file %s.' %
+                      (path, self.file_path))
+        continue
+      os.remove(path)
+    for spool in [self.delta, self.encrypted_blob]:
+      if spool:
+        spool.discard()
+    if self._chunked_encryptor:
+      self._chunked_encryptor.discard()
+      self._chunked_encryptor = None
+    # Set on restore if the checkpoint had outputs that were only in memory.
+    self._lost_in_memory = False
 
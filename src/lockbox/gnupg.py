@@ -42,15 +42,22 @@ except ImportError:
     from cStringIO import StringIO
 
 import codecs
+import errno
 import locale
 import logging
 import os
+import select
 import socket
 from subprocess import Popen
 from subprocess import PIPE
 import sys
 import threading
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     import logging.NullHandler as NullHandler
 except ImportError:
@@ -67,6 +74,13 @@ logger = logging.getLogger(__name__)
 if not logger.handlers:
     logger.addHandler(NullHandler())
 
+# Bytes moved to or from gpg per read or write.
+_CHUNK_SIZE = 1 << 16
+
+# Whether GPG._pump() can multiplex gpg's pipes from one thread; if not (e.g.,
+# on Windows), each pipe gets a thread of its own.
+_CAN_POLL = hasattr(select, 'poll') and fcntl is not None
+
 def _copy_data(instream, outstream):
     # Copy one stream to another
     sent = 0
@@ -75,11 +89,10 @@ def _copy_data(instream, outstream):
     else:
         enc = 'ascii'
     while True:
-        data = instream.read(1024)
+        data = instream.read(_CHUNK_SIZE)
         if len(data) == 0:
             break
         sent += len(data)
-        logger.debug("sending chunk (%d): %r", sent, data[:256])
         try:
             outstream.write(data)
         except UnicodeError:
@@ -186,44 +199,57 @@ class GPG(object):
             if len(line) == 0:
                 break
             lines.append(line)
-            line = line.rstrip()
-            if self.verbose:
-                print(line)
-            logger.debug("%s", line)
-            if line[0:9] == '[GNUPG:] ':
-                # Chop off the prefix
-                line = line[9:]
-                L = line.split(None, 1)
-                keyword = L[0]
-                if len(L) > 1:
-                    value = L[1]
-                else:
-                    value = ""
-                result.handle_status(keyword, value)
+            self._handle_response_line(line, result)
         result.stderr = ''.join(lines)
 
-    def _read_data(self, stream, result):
-        # Read the contents of the file from GPG's stdout
+    def _handle_response_line(self, line, result):
+        # Internal method: hands one line of GPG's stderr to the response
+        # object if it is a status line.
+        line = line.rstrip()
+        if self.verbose:
+            print(line)
+        logger.debug("%s", line)
+        if line[0:9] == '[GNUPG:] ':
+            # Chop off the prefix
+            line = line[9:]
+            L = line.split(None, 1)
+            keyword = L[0]
+            if len(L) > 1:
+                value = L[1]
+            else:
+                value = ""
+            result.handle_status(keyword, value)
+
+    def _read_data(self, stream, result, output_stream=None):
+        # Read the contents of the file from GPG's stdout. If output_stream
+        # is given, write the data through to it instead of keeping it.
         chunks = []
         while True:
-            data = stream.read(1024)
+            data = stream.read(_CHUNK_SIZE)
             if len(data) == 0:
                 break
-            logger.debug("chunk: %r" % data[:256])
-            chunks.append(data)
+            if output_stream is not None:
+                output_stream.write(data)
+            else:
+                chunks.append(data)
         if _py3k:
             # Join using b'' or '', as appropriate
             result.data = type(data)().join(chunks)
         else:
             result.data = ''.join(chunks)
 
-    def _collect_output(self, process, result, writer=None, stdin=None):
+    def _collect_output(self, process, result, writer=None, stdin=None,
+                        output_stream=None):
         """
         Drain the subprocesses output streams, writing the collected output
         to the result. If a writer thread (writing to the subprocess) is given,
         make sure it's joined before returning. If a stdin stream is given,
-        close it before returning.
+        close it before returning. If an output_stream is given, stdout is
+        written to it rather than to the result.
         """
+        if _CAN_POLL and writer is None:
+            self._pump(process, result, output_stream=output_stream)
+            return
         stderr = codecs.getreader(self.encoding)(process.stderr)
         rr = threading.Thread(target=self._read_response, args=(stderr, result))
         rr.setDaemon(True)
@@ -231,7 +257,8 @@ class GPG(object):
         rr.start()
 
         stdout = process.stdout
-        dr = threading.Thread(target=self._read_data, args=(stdout, result))
+        dr = threading.Thread(target=self._read_data,
+                              args=(stdout, result, output_stream))
         dr.setDaemon(True)
         logger.debug('stdout reader: %r', dr)
         dr.start()
@@ -249,11 +276,125 @@ class GPG(object):
         stderr.close()
         stdout.close()
 
-    def _handle_io(self, args, file, result, passphrase=None, binary=False):
+    def _pump(self, process, result, file=None, prefix=b'',
+              output_stream=None):
+        """
+        Feed prefix and then the file-like object file (if any) to the
+        subprocess's stdin while draining its stdout and stderr, all from
+        this thread with poll(), and wait for it to exit. stdout goes to
+        output_stream if one is given, or else to the result's data; stderr
+        is parsed for status lines as it arrives.
+
+        Data moves in _CHUNK_SIZE pieces straight between the pipes' file
+        descriptors and the caller's buffers: the input is read into one
+        reused buffer where the file supports readinto(), and a partial write
+        to gpg sends the rest of the same memoryview rather than a copy. If
+        gpg stops reading early (e.g., a bad passphrase), the rest of the
+        input is dropped.
+        """
+        poller = select.poll()
+        stdin_fd = None
+        if file is None:
+            process.stdin.close()
+        else:
+            stdin_fd = process.stdin.fileno()
+            flags = fcntl.fcntl(stdin_fd, fcntl.F_GETFL)
+            fcntl.fcntl(stdin_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            poller.register(stdin_fd, select.POLLOUT)
+        stdout_fd = process.stdout.fileno()
+        stderr_fd = process.stderr.fileno()
+        poller.register(stdout_fd, select.POLLIN)
+        poller.register(stderr_fd, select.POLLIN)
+        open_readers = 2
+
+        readinto = getattr(file, 'readinto', None)
+        buf = bytearray(_CHUNK_SIZE) if readinto is not None else None
+        pending = memoryview(prefix)
+        chunks = []
+        lines = []
+        partial_line = b''
+        sent = received = 0
+
+        while stdin_fd is not None or open_readers:
+            for fd, event in poller.poll():
+                if fd == stdin_fd:
+                    if not len(pending):
+                        if readinto is not None:
+                            n = readinto(buf)
+                            pending = memoryview(buf)[:n or 0]
+                        else:
+                            data = file.read(_CHUNK_SIZE)
+                            if type(data) is not bytes:
+                                data = data.encode(self.encoding)
+                            pending = memoryview(data)
+                    n = 0
+                    if len(pending):
+                        try:
+                            n = os.write(stdin_fd, pending)
+                        except OSError as e:
+                            if e.errno == errno.EAGAIN:
+                                continue
+                            if e.errno != errno.EPIPE:
+                                raise
+                            logger.debug("gpg closed its input after %d "
+                                         "bytes", sent)
+                            pending = memoryview(b'')
+                    if n:
+                        sent += n
+                        pending = pending[n:]
+                    else:
+                        poller.unregister(stdin_fd)
+                        stdin_fd = None
+                        process.stdin.close()
+                    continue
+                data = os.read(fd, _CHUNK_SIZE)
+                if not data:
+                    poller.unregister(fd)
+                    open_readers -= 1
+                    if fd == stderr_fd and partial_line:
+                        self._pump_response_line(partial_line, result, lines)
+                elif fd == stdout_fd:
+                    received += len(data)
+                    if output_stream is not None:
+                        output_stream.write(data)
+                    else:
+                        chunks.append(data)
+                else:
+                    response = (partial_line + data).split(b'\n')
+                    partial_line = response.pop()
+                    for line in response:
+                        self._pump_response_line(line + b'\n', result, lines)
+
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+        result.data = b''.join(chunks)
+        result.stderr = ''.join(lines)
+        logger.debug("gpg exited (%s): %d bytes sent, %d received",
+                     process.returncode, sent, received)
+
+    def _pump_response_line(self, line, result, lines):
+        line = line.decode(self.encoding, 'replace')
+        lines.append(line)
+        try:
+            self._handle_response_line(line, result)
+        except ValueError:
+            # A status that this version of the module does not know;
+            # keep reading so that gpg is not left blocked on stderr.
+            logger.warning("Ignored: %s", line.rstrip())
+
+    def _handle_io(self, args, file, result, passphrase=None, binary=False,
+                   output_stream=None):
         "Handle a call to GPG - pass input data, collect output data"
         # Handle a basic data call - pass data to GPG, handle the output
         # including status information. Garbage In, Garbage Out :)
         p = self._open_subprocess(args, passphrase is not None)
+        if _CAN_POLL:
+            prefix = b''
+            if passphrase:
+                prefix = ('%s\n' % passphrase).encode(self.encoding)
+            self._pump(p, result, file, prefix, output_stream)
+            return result
         if not binary:
             stdin = codecs.getwriter(self.encoding)(p.stdin)
         else:
@@ -261,7 +402,7 @@ class GPG(object):
         if passphrase:
             _write_passphrase(stdin, passphrase, self.encoding)
         writer = _threaded_copy_data(file, stdin)
-        self._collect_output(p, result, writer, stdin)
+        self._collect_output(p, result, writer, stdin, output_stream)
         return result
 
     #
@@ -293,6 +434,10 @@ class GPG(object):
         result = Sign(self.encoding)
         #We could use _handle_io here except for the fact that if the
         #passphrase is bad, gpg bails and you can't write the message.
+        if _CAN_POLL:
+            # _pump() drops the message if gpg bails.
+            return self._handle_io(args, file, result, passphrase,
+                                   binary=True)
         p = self._open_subprocess(args, passphrase is not None)
         try:
             stdin = p.stdin
@@ -615,8 +760,12 @@ class GPG(object):
     #
     def encrypt_file(self, file, recipients, sign=None,
             always_trust=False, passphrase=None,
-            armor=True, output=None, symmetric=False):
-        "Encrypt the message read from the file-like object 'file'"
+            armor=True, output=None, symmetric=False, output_stream=None):
+        """Encrypt the message read from the file-like object 'file'.
+
+        The ciphertext goes to the file named output, or else is written to
+        the file-like object output_stream as gpg produces it, or else is
+        collected in the result's data."""
         args = ['--encrypt']
         if symmetric:
             args = ['--symmetric']
@@ -637,7 +786,8 @@ class GPG(object):
         if always_trust:
             args.append("--always-trust")
         result = Crypt(self.encoding)
-        self._handle_io(args, file, result, passphrase=passphrase, binary=True)
+        self._handle_io(args, file, result, passphrase=passphrase, binary=True,
+                        output_stream=output_stream)
         logger.debug('encrypt result: %r', result.data)
         return result
 
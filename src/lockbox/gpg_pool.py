@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""Caps how many gpg calls run at once, and runs them in the background.
+
+Shepherds, the encrypt stage, group operations and the frontend all share
+one GPG, and each call starts a gpg process; a burst of work can start far
+more of them than there are CPUs. GpgPool wraps a GPG (gnupg.GPG or
+gpgme_engine.GpgmeGPG) with the same interface, but lets at most max_workers
+calls into it at a time; the rest wait their turn.
+
+submit_encrypt(), submit_decrypt() and submit_verify() queue a call for the
+pool's own workers and return a GpgFuture right away, so that the caller can
+get on with other work and collect the result later. Queued calls can be
+cancelled until a worker picks them up. Direct and queued calls share the
+same max_workers slots.
+
+Usage:
+  gpg = GpgPool(gnupg.GPG(), max_workers=4)
+  future = gpg.submit_encrypt(open(path, 'rb'), recipients,
+                              always_trust=True, armor=False)
+  ...
+  result = future.result()
+
+  gpg.encrypt(data, recipients)  # Waits for a free slot.
+  logging.info('%d gpg calls queued.' % gpg.depth())
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import functools
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+from exception import GpgCancelledError
+from stage import Stage
+
+# GPG methods that start gpg (or gpgme) and so take a slot.
+_GPG_METHODS = frozenset([
+  'encrypt', 'encrypt_file', 'decrypt', 'decrypt_file', 'verify',
+  'verify_file', 'sign', 'sign_file', 'list_keys', 'uid_to_keyid',
+  'import_keys', 'export_keys', 'recv_keys', 'delete_keys', 'gen_key',
+  'show_session_key', 'show_session_key_file', 'override_session_key',
+  'override_session_key_file'])
+
+_PENDING = 'pending'
+_RUNNING = 'running'
+_CANCELLED = 'cancelled'
+_FINISHED = 'finished'
+
+
+class GpgFuture(object):
+  """The result of a gpg call queued on a GpgPool."""
+  def __init__(self, method, args, kwargs):
+    self.method = method
+    self.args = args
+    self.kwargs = kwargs
+    self._state = _PENDING
+    self._result = None
+    self._exc_info = None
+    self._callbacks = list()
+    self._condition = threading.Condition()
+
+
+  def __str__(self):
+    return 'GpgFuture(%s, %s)' % (self.method, self._state)
+
+
+  def cancel(self):
+    """Cancels the call if no worker has picked it up yet.
+
+    Returns:
+      Whether the call is cancelled.
+    """
+    with self._condition:
+      if self._state == _PENDING:
+        self._state = _CANCELLED
+        self._condition.notify_all()
+      elif self._state != _CANCELLED:
+        return False
+    self._run_callbacks()
+    return True
+
+
+  def cancelled(self):
+    return self._state == _CANCELLED
+
+
+  def running(self):
+    return self._state == _RUNNING
+
+
+  def done(self):
+    return self._state in (_CANCELLED, _FINISHED)
+
+
+  def _wait(self, timeout):
+    deadline = None if timeout is None else time.time() + timeout
+    with self._condition:
+      while not self.done():
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          break
+        self._condition.wait(remaining)
+      if self._state == _CANCELLED:
+        raise GpgCancelledError(str(self))
+      if self._state != _FINISHED:
+        raise RuntimeError('Timed out waiting for %s.' % self)
+
+
+  def result(self, timeout=None):
+    """The call's result, waiting up to timeout seconds (forever if None).
+
+    Raises:
+      GpgCancelledError: The call was cancelled.
+      RuntimeError: The call did not finish in time.
+      Whatever the call raised.
+    """
+    self._wait(timeout)
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+  def exception(self, timeout=None):
+    """What the call raised, or None; waits like result()."""
+    self._wait(timeout)
+    return self._exc_info[1] if self._exc_info else None
+
+
+  def add_done_callback(self, callback):
+    """Calls callback(future) once the call finishes or is cancelled; right
+    away if it already has."""
+    with self._condition:
+      if not self.done():
+        self._callbacks.append(callback)
+        return
+    callback(self)
+
+
+  def _start(self):
+    """Returns False if the call was cancelled."""
+    with self._condition:
+      if self._state == _CANCELLED:
+        return False
+      self._state = _RUNNING
+      return True
+
+
+  def _finish(self, result=None, exc_info=None):
+    with self._condition:
+      self._result = result
+      self._exc_info = exc_info
+      self._state = _FINISHED
+      self._condition.notify_all()
+    self._run_callbacks()
+
+
+  def _run_callbacks(self):
+    with self._condition:
+      callbacks, self._callbacks = self._callbacks, list()
+    for callback in callbacks:
+      try:
+        callback(self)
+      except Exception, e:
+        logging.exception('Callback for %s failed: %s' % (self, e))
+
+
+class GpgPool(object):
+  def __init__(self, gpg, max_workers=None):
+    """
+    Args:
+      gpg: GPG to wrap.
+      max_workers: gpg calls that may run at once; one per CPU by default.
+    """
+    self.gpg = gpg
+    self.max_workers = max_workers or multiprocessing.cpu_count()
+    self._slots = threading.Condition()
+    self._running = 0
+    self._waiting = 0
+    # Queued calls are unbounded: submitting never blocks.
+    self._stage = Stage('gpg', self._work, self.max_workers, queue_size=0)
+    self._stage.start()
+
+
+  def __getattr__(self, name):
+    if name == 'gpg':
+      raise AttributeError(name)
+    attr = getattr(self.gpg, name)
+    if name in _GPG_METHODS:
+      return functools.partial(self._call, attr)
+    return attr
+
+
+  def _call(self, method, *args, **kwargs):
+    with self._slots:
+      self._waiting += 1
+      while self._running >= self.max_workers:
+        self._slots.wait()
+      self._waiting -= 1
+      self._running += 1
+    try:
+      return method(*args, **kwargs)
+    finally:
+      with self._slots:
+        self._running -= 1
+        self._slots.notify()
+
+
+  def _work(self, future):
+    if not future._start():
+      return False
+    try:
+      result = self._call(getattr(self.gpg, future.method), *future.args,
+                          **future.kwargs)
+    except Exception:
+      future._finish(exc_info=sys.exc_info())
+    else:
+      future._finish(result)
+    return False
+
+
+  def submit(self, method, *args, **kwargs):
+    """Queues a call of one of GPG's methods (e.g., 'encrypt_file').
+
+    Returns:
+      GpgFuture for the call.
+    """
+    if method not in _GPG_METHODS:
+      raise ValueError('Not a gpg call (%s).' % method)
+    future = GpgFuture(method, args, kwargs)
+    self._stage.put(future)
+    return future
+
+
+  def submit_encrypt(self, data, recipients, **kwargs):
+    """Queues encrypt_file() if data is a file-like object, else encrypt()."""
+    method = 'encrypt_file' if hasattr(data, 'read') else 'encrypt'
+    return self.submit(method, data, recipients, **kwargs)
+
+
+  def submit_decrypt(self, data, **kwargs):
+    """Queues decrypt_file() if data is a file-like object, else decrypt()."""
+    method = 'decrypt_file' if hasattr(data, 'read') else 'decrypt'
+    return self.submit(method, data, **kwargs)
+
+
+  def submit_verify(self, data, **kwargs):
+    """Queues verify_file() if data is a file-like object, else verify()."""
+    method = 'verify_file' if hasattr(data, 'read') else 'verify'
+    return self.submit(method, data, **kwargs)
+
+
+  def depth(self):
+    """Queued calls that no worker has picked up yet (cancelled ones
+    included, until a worker drops them)."""
+    return self._stage.depth()
+
+
+  def running(self):
+    """gpg calls running now."""
+    return self._running
+
+
+  def waiting(self):
+    """Direct calls (not queued ones) waiting for a slot."""
+    return self._waiting
+
+
+  def shutdown(self, cancel_pending=False):
+    """Stops the workers once the queued calls are done, or cancels the ones
+    that have not started if cancel_pending."""
+    if cancel_pending:
+      with self._stage.queue.mutex:
+        queued = list(self._stage.queue.queue)
+      cancelled = len([future for future in queued if future.cancel()])
+      if cancelled:
+        logging.info('Cancelled %d queued gpg calls.' % cancelled)
+    self._stage.shutdown()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""GPG engine built on the vendored pyme (gpgme) bindings.
+
+gnupg.GPG runs `sh -c gpg ...` for every call and parses gpg's status output
+on helper threads, so that encrypting a small file and its path costs two
+shell and gpg start ups plus a keyring scan for each recipient. GpgmeGPG
+keeps one gpgme context per thread for the life of the process, resolves each
+recipient to a key once per context, and drives gpg through gpgme's own engine
+instead of a shell pipeline.
+
+GpgmeGPG offers encrypt_file() and encrypt() with the same arguments and
+results as gnupg.GPG, so FileUpdateCrypto takes either. Everything else (key
+listing, import, export, signing, symmetric encryption, ...) is passed
+through to the gnupg.GPG it wraps.
+
+encrypt_file() streams: a real file is handed to gpgme by its descriptor, so
+gpgme reads it as it encrypts rather than from a copy in memory. File-like
+objects without a descriptor are already in memory and are read in one go.
+The ciphertext of a small file is kept in gpgme's memory on its way to
+output_stream; that of a bigger one goes through an unlinked file in the
+staging area, counted against its quota. (pyme 0.8.1 cannot write to a
+Python object as gpgme produces the data: its bindings hold the GIL through
+op_encrypt() and lack gpgme_data_new_from_cbs().)
+
+Usage:
+  gpg = new_engine(ENGINE_GPGME, gnupg.GPG(), staging=staging)
+  gpg.encrypt_file(open(path, 'rb'), recipients, always_trust=True,
+                   armor=False, output_stream=out)
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import logging
+import os
+import tempfile
+import threading
+from keyring_index import KeyringIndex
+from staging import PREFIX
+try:
+  from pyme import core, errors, pygpgme
+  from pyme.constants import protocol
+except ImportError:
+  core = None
+
+ENGINE_SUBPROCESS = 'subprocess'
+ENGINE_GPGME = 'gpgme'
+ENGINES = [ENGINE_SUBPROCESS, ENGINE_GPGME]
+
+# GPGME_ENCRYPT_ALWAYS_TRUST.
+_ENCRYPT_ALWAYS_TRUST = 1
+_CHUNK_SIZE = 1 << 16
+# Ciphertext of files up to this size stays in memory, as in a spool.Spool.
+_MAX_IN_MEMORY = 2 << 20
+
+
+def new_engine(engine, gpg, keyring=None, staging=None):
+  """
+  Args:
+    engine: One of ENGINES.
+    gpg: gnupg.GPG to use, or to wrap.
+    keyring, staging: See GpgmeGPG.
+
+  Returns:
+    An object with gnupg.GPG's interface.
+  """
+  if engine == ENGINE_SUBPROCESS:
+    return gpg
+  if engine == ENGINE_GPGME:
+    return GpgmeGPG(gpg, keyring, staging)
+  raise ValueError('Unknown GPG engine (%s).' % engine)
+
+
+if core is not None:
+  class _FdData(core.Data):
+    """core.Data over a file's descriptor, which gpgme reads or writes
+    directly. The vendored Data.new_from_fd() hands gpgme a FILE* through a
+    name it never imported, so it is replaced here."""
+    def new_from_fd(self, file):
+      data_p = pygpgme.new_gpgme_data_t_p()
+      errors.errorcheck(pygpgme.gpgme_data_new_from_fd(data_p, file.fileno()))
+      self.wrapped = pygpgme.gpgme_data_t_p_value(data_p)
+      pygpgme.delete_gpgme_data_t_p(data_p)
+else:
+  _FdData = None
+
+
+class GpgmeResult(object):
+  """What gnupg.Crypt offers callers of encrypt() and encrypt_file()."""
+  def __init__(self):
+    self.data = ''
+    self.ok = False
+    self.status = None
+    self.stderr = ''
+
+
+  def __nonzero__(self):
+    return self.ok
+
+
+  __bool__ = __nonzero__
+
+
+  def __str__(self):
+    return self.data
+
+
+class GpgmeGPG(object):
+  def __init__(self, gpg, keyring=None, staging=None):
+    """
+    Args:
+      gpg: gnupg.GPG to wrap.
+      keyring: keyring_index.KeyringIndex whose changes invalidate the keys
+        looked up for recipients; one over gpg's keyring by default.
+      staging: staging.StagingArea for the ciphertext of big files; the
+        system's temporary directory, without a quota, if None.
+    """
+    if core is None:
+      raise ValueError('The gpgme engine needs the pyme bindings '
+                       '(src/extern/pyme-0.8.1).')
+    core.check_version(None)
+    self.gpg = gpg
+    self.keyring = keyring or KeyringIndex(gpg)
+    self.staging = staging
+    # Contexts are not thread-safe, so each thread gets its own.
+    self._local = threading.local()
+
+
+  def __getattr__(self, name):
+    if name == 'gpg':
+      raise AttributeError(name)
+    return getattr(self.gpg, name)
+
+
+  def _context(self):
+    context = getattr(self._local, 'context', None)
+    if context is None:
+      context = core.Context()
+      gnupghome = getattr(self.gpg, 'gnupghome', None)
+      if gnupghome:
+        gpgbinary = getattr(self.gpg, 'gpgbinary', None)
+        if not gpgbinary or not os.path.isabs(gpgbinary):
+          gpgbinary = None
+        context.set_engine_info(protocol.OpenPGP, gpgbinary, gnupghome)
+      self._local.context = context
+    return context
+
+
+  def _recipient_keys(self, context, recipients):
+    """Keys able to encrypt to each of recipients (uids, key ids or
+    fingerprints), looked up once per context until the keyring changes."""
+    if isinstance(recipients, basestring):
+      recipients = [recipients]
+    stat = self.keyring.stat_key()
+    if not hasattr(self._local, 'keys') or self._local.keys_stat != stat:
+      self._local.keys = dict()
+      self._local.keys_stat = stat
+    keys = list()
+    for recipient in recipients:
+      if recipient not in self._local.keys:
+        # gnupg.GPG passes recipients through a shell, so callers quote them.
+        pattern = recipient.strip('\'"')
+        self._local.keys[recipient] = [
+          key for key in context.op_keylist_all(pattern, 0)
+          if key.can_encrypt]
+      if not self._local.keys[recipient]:
+        raise ValueError('No usable key for recipient (%s).' % recipient)
+      keys.extend(self._local.keys[recipient])
+    return keys
+
+
+  def _encrypt_data(self, plaintext, recipients, always_trust, armor, output,
+                    output_stream, cipher_file=None):
+    """Encrypts the core.Data plaintext.
+
+    Args:
+      cipher_file: Temporary file for the ciphertext; it is kept in memory if
+        None.
+    """
+    result = GpgmeResult()
+    context = self._context()
+    context.set_armor(1 if armor else 0)
+    output_file = open(output, 'wb') if output else None
+    try:
+      if output_file:
+        cipher = _FdData(file=output_file)
+      elif cipher_file:
+        cipher = _FdData(file=cipher_file)
+      else:
+        cipher = core.Data()
+      flags = _ENCRYPT_ALWAYS_TRUST if always_trust else 0
+      try:
+        context.op_encrypt(self._recipient_keys(context, recipients), flags,
+                           plaintext, cipher)
+      except (errors.GPGMEError, ValueError), e:
+        logging.error('gpgme encryption failed: %s' % e)
+        result.status = 'encryption failed'
+        result.stderr = str(e)
+        return result
+    finally:
+      if output_file:
+        output_file.close()
+
+    if not output:
+      if cipher_file:
+        # gpgme wrote through the descriptor; nothing is buffered here.
+        cipher = cipher_file
+        cipher.seek(0)
+      else:
+        cipher.seek(0, 0)
+      if output_stream is not None:
+        self._copy(cipher, output_stream)
+      else:
+        result.data = cipher.read()
+    result.ok = True
+    result.status = 'encryption ok'
+    return result
+
+
+  @staticmethod
+  def _copy(cipher, outstream):
+    while True:
+      data = cipher.read(_CHUNK_SIZE)
+      if not data:
+        break
+      outstream.write(data)
+
+
+  def encrypt_file(self, file, recipients, sign=None, always_trust=False,
+                   passphrase=None, armor=True, output=None, symmetric=False,
+                   output_stream=None):
+    if sign or symmetric:
+      return self.gpg.encrypt_file(file, recipients, sign=sign,
+                                   always_trust=always_trust,
+                                   passphrase=passphrase, armor=armor,
+                                   output=output, symmetric=symmetric,
+                                   output_stream=output_stream)
+
+    try:
+      # gpgme reads from the descriptor's offset, which has to be moved back
+      # to the file's own position from past what Python has read ahead.
+      position = file.tell()
+      os.lseek(file.fileno(), position, os.SEEK_SET)
+      size = os.fstat(file.fileno()).st_size - position
+    except (AttributeError, IOError, OSError, ValueError):
+      return self._encrypt_data(core.Data(string=file.read()), recipients,
+                                always_trust, armor, output, output_stream)
+
+    plaintext = _FdData(file=file)
+    if output or size <= _MAX_IN_MEMORY:
+      return self._encrypt_data(plaintext, recipients, always_trust, armor,
+                                output, output_stream)
+    # The ciphertext is about the size of the file.
+    staged_bytes = 0
+    directory = None
+    if self.staging:
+      # Not waited for: the caller's job already holds a reservation, and
+      # waiting for more while holding it could deadlock the pipeline.
+      staged_bytes = self.staging.reserve(size, block=False)
+      directory = self.staging.directory
+    try:
+      with tempfile.TemporaryFile(dir=directory, prefix=PREFIX) as cipher_file:
+        return self._encrypt_data(plaintext, recipients, always_trust, armor,
+                                  output, output_stream, cipher_file)
+    finally:
+      if staged_bytes:
+        self.staging.release(staged_bytes)
+
+
+  def encrypt(self, data, recipients, **kwargs):
+    if kwargs.get('sign') or kwargs.get('symmetric') or \
+          kwargs.get('passphrase'):
+      return self.gpg.encrypt(data, recipients, **kwargs)
+    if isinstance(data, unicode):
+      data = data.encode(getattr(self.gpg, 'encoding', None) or 'utf-8')
+    return self._encrypt_data(core.Data(string=data), recipients,
+                              kwargs.get('always_trust', False),
+                              kwargs.get('armor', True),
+                              kwargs.get('output'), None)
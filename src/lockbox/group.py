@@ -2,6 +2,7 @@
 
 import gnupg
 import logging
+from keyring_index import KeyringIndex
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -12,12 +13,15 @@ def _is_sequence(instance):
 
 
 class Group(object):
-  def __init__(self, gpg, service_name_prefix):
+  def __init__(self, gpg, service_name_prefix, keyring=None):
     """
     Attributes:
       service_name_prefix: group0_data domain => group0
+      keyring: KeyringIndex to look members' keys up in; one for gpg by
+        default.
     """
     self.gpg = gpg
+    self.keyring = keyring or KeyringIndex(gpg)
     self.service_names_prefix = service_name_prefix
     self.member_uid_to_keyid = {}
     self.public_key_block = None
@@ -30,15 +34,14 @@ class Group(object):
 
 
   def _get_already_imported_keys(self):
-    return self.gpg.uid_to_keyid()
+    return self.keyring.uid_to_keyid()
 
 
   def _get_similar_already_imported_keys(self, name):
-    uid_to_fp = self._get_already_imported_keys()
-    logging.debug(str(uid_to_fp))
-    candidate_keys = [(uid, uid_to_fp.get(uid)) for uid in uid_to_fp
-                      if name.lower() in uid.lower()]
-    return candidate_keys
+    name = name.lower()
+    return [(uid, key.keyid)
+            for key in self.keyring.search(name, include_expired=True)
+            for uid in key.uids if name in uid.lower()]
 
 
   def _group_keyids(self):
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Remembers what each file looked like when it was last synced, so that
+events that did not change a file's bytes can be dropped cheaply.
+
+Entries are keyed by path and hold the file's stat key (device, inode, size,
+mtime and ctime in nanoseconds) at the time it was read, along with the SHA1
+of its cleartext. A file whose stat key still matches
+its entry is unchanged as far as the file system can tell, which costs one
+stat() to find out. A file whose stat key changed (e.g., touch, chmod) may
+still have the same bytes; hashing it is much cheaper than signing,
+encrypting and uploading it again.
+
+An entry only holds while its path does: the shepherd forgets the paths of
+deleted and moved files (and what a move overwrote), so that a file later
+created there is not taken for the one that was synced.
+
+Usage:
+  hash_cache = HashCache(database_path)
+  hash_cache.initialize()
+
+  key = stat_key(os.stat(path))
+  entry = hash_cache.lookup(path)
+  if entry and entry.stat_key == key:
+    ...  # Nothing to do.
+
+  hash_cache.store(path, key, cleartext_digest)
+  hash_cache.forget(deleted_path)
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import logging
+import os
+from collections import namedtuple
+from master_db_connection import MasterDBConnection
+
+HashCacheEntry = namedtuple('HashCacheEntry', ['stat_key', 'digest'])
+
+
+def _nanoseconds(seconds):
+  return int(round(seconds * 1e9))
+
+
+def stat_key(stat):
+  """(device, inode, size, mtime_ns, ctime_ns) of an os.stat() result."""
+  return (stat.st_dev, stat.st_ino, stat.st_size,
+          _nanoseconds(stat.st_mtime), _nanoseconds(stat.st_ctime))
+
+
+def path_stat_key(path):
+  """stat_key() of path, or None if it does not exist."""
+  try:
+    return stat_key(os.stat(path))
+  except OSError:
+    return None
+
+
+class HashCache(object):
+  def __init__(self, database_path):
+    self.database_path = database_path
+
+
+  def initialize(self):
+    with MasterDBConnection(self.database_path) as cursor:
+      cursor.execute(
+        'CREATE TABLE IF NOT EXISTS hash_cache('
+        'path text PRIMARY KEY, '
+        'device integer, '
+        'inode integer, '
+        'size integer, '
+        'mtime_ns integer, '
+        'ctime_ns integer, '
+        'digest text'
+        ')')
+
+
+  def lookup(self, path):
+    """
+    Returns:
+      The HashCacheEntry for path, or None if it has not been synced.
+    """
+    with MasterDBConnection(self.database_path) as cursor:
+      row = cursor.execute('SELECT device, inode, size, mtime_ns, ctime_ns, '
+                           'digest FROM hash_cache WHERE path = ?',
+                           (path,)).fetchone()
+    if not row:
+      return None
+    row = tuple(row)
+    return HashCacheEntry(row[:5], row[5])
+
+
+  def store(self, path, key, digest):
+    """Records that path, as of stat key key, has the given cleartext
+    digest."""
+    if key is None:
+      return
+    logging.debug('Caching (%s): %s.' % (path, digest))
+    with MasterDBConnection(self.database_path) as cursor:
+      cursor.execute('INSERT OR REPLACE INTO hash_cache(path, device, inode, '
+                     'size, mtime_ns, ctime_ns, digest) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (path,) + tuple(key) + (digest,))
+
+
+  def forget(self, path):
+    """Drops path's entry, e.g., once the file is deleted or moved away."""
+    with MasterDBConnection(self.database_path) as cursor:
+      cursor.execute('DELETE FROM hash_cache WHERE path = ?', (path,))
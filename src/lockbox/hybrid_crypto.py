@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""Hybrid blob format: the bulk data is encrypted in process with AES and a
+fresh key per version, and only that key goes through GPG.
+
+Piping a large file through gpg limits throughput to what gpg's symmetric
+layer and the pipe can do. Here gpg only ever sees a small key header (80
+bytes of keys, and the file's path), so its cost per file is constant and the
+data is encrypted with M2Crypto (OpenSSL) at memory speed.
+
+A hybrid blob is laid out as
+
+  magic          'LBXH'
+  version        1 byte
+  header_length  4 bytes, big-endian
+  header         gpg-encrypted (binary) version || aes_key || mac_key || iv
+                 || path
+  ciphertext     AES-256-CBC of the cleartext, PKCS#7 padded
+  tag            HMAC-SHA256 with mac_key of everything before it
+
+The blob is authenticated as a whole (encrypt-then-MAC), so a flipped bit
+anywhere, header included, makes decryption fail.
+
+The path (UTF-8; empty for a delta) rides in the same gpg-encrypted header
+as the keys, so a new file costs one gpg call rather than one for its key
+and another for its path. Its 'path' metadata then refers to the blob:
+
+  header:<blob key>
+
+and read_path() recovers the path from the blob's header alone. Version 1
+blobs have no path in the header and can still be read.
+
+The same data key can also seal separately stored chunks of a file (see
+chunked_crypto); each chunk is
+
+  iv | AES-256-CBC of the chunk | HMAC-SHA256 of context || iv || ciphertext
+
+where context names the chunk and its place in the file, so chunks cannot be
+swapped, reordered or dropped unnoticed.
+
+Usage:
+  with open(path, 'rb') as cleartext, open(blob_path, 'wb') as blob:
+    encrypt_stream(gpg, recipients, cleartext, blob, path=path)
+
+  with open(blob_path, 'rb') as blob, open(path, 'wb') as cleartext:
+    decrypt_stream(gpg, blob, cleartext)
+
+  with open(blob_path, 'rb') as blob:
+    path = read_path(gpg, blob)
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import hmac
+import os
+import struct
+from collections import namedtuple
+from hashlib import sha256
+from exception import EncryptedBlobError
+try:
+  import M2Crypto
+except ImportError:
+  M2Crypto = None
+
+# How a blob's bulk data is encrypted: piped through gpg, with AES under a
+# gpg-wrapped key, or the same in independently readable segments (see
+# seekable_crypto).
+BULK_CIPHER_GPG = 'gpg'
+BULK_CIPHER_AES = 'aes'
+BULK_CIPHER_SEEKABLE = 'seekable'
+BULK_CIPHERS = [BULK_CIPHER_GPG, BULK_CIPHER_AES, BULK_CIPHER_SEEKABLE]
+
+# A file version's secret: the AES key and the HMAC key.
+DataKey = namedtuple('DataKey', ['key', 'mac_key'])
+
+MAGIC = 'LBXH'
+_VERSION = 2
+# Whether each readable version's headers carry a path.
+_READABLE_VERSIONS = {1: False, 2: True}
+_PREAMBLE = struct.Struct('!4sBI')
+
+_CIPHER = 'aes_256_cbc'
+_KEY_SIZE = 32
+_MAC_KEY_SIZE = 32
+_IV_SIZE = 16
+_TAG_SIZE = sha256().digest_size
+# Bytes of a key header before its path.
+_SECRETS_SIZE = _KEY_SIZE + _MAC_KEY_SIZE + _IV_SIZE
+
+_CHUNK_SIZE = 1 << 20
+
+# What a file's 'path' metadata holds when the path is in its blob's header.
+PATH_HEADER_PREFIX = 'header:'
+
+# M2Crypto.EVP.Cipher ops.
+_DECODE = 0
+_ENCODE = 1
+
+
+def _check_available():
+  if M2Crypto is None:
+    raise ValueError('The %s bulk cipher needs M2Crypto.' % BULK_CIPHER_AES)
+
+
+def _cipher(key, iv, op):
+  return M2Crypto.EVP.Cipher(alg=_CIPHER, key=key, iv=iv, op=op)
+
+
+def new_data_key():
+  return DataKey(os.urandom(_KEY_SIZE), os.urandom(_MAC_KEY_SIZE))
+
+
+def header_reference(blob_key):
+  """The 'path' metadata of a file whose path is in the header of the blob
+  stored under blob_key."""
+  return PATH_HEADER_PREFIX + blob_key
+
+
+def parse_header_reference(reference):
+  """
+  Returns:
+    The key of the blob whose header holds the path that reference points
+    to, or None if it points elsewhere (see path_manifest).
+  """
+  if reference.startswith(PATH_HEADER_PREFIX):
+    return reference[len(PATH_HEADER_PREFIX):]
+  return None
+
+
+def wrap_header(gpg, recipients, version, secrets, path):
+  """gpg-encrypts a key header: version, then secrets, then path.
+
+  Raises:
+    EncryptedBlobError: gpg could not encrypt it.
+  """
+  if isinstance(path, unicode):
+    path = path.encode('utf-8')
+  wrapped = gpg.encrypt(chr(version) + secrets + (path or ''), recipients,
+                        always_trust=True, armor=False)
+  if not wrapped:
+    raise EncryptedBlobError('Could not wrap the key header: %s.' %
+                             wrapped.status)
+  return wrapped.data
+
+
+def unwrap_header(gpg, wrapped, versions, secrets_size, passphrase):
+  """Decrypts a key header that wrap_header() made.
+
+  Args:
+    versions: Dict of each readable version to whether its headers carry a
+      path.
+
+  Returns:
+    (version, secrets, path); path is None for versions without one.
+
+  Raises:
+    EncryptedBlobError: It cannot be decrypted with our keys or is malformed.
+  """
+  header = gpg.decrypt(wrapped, always_trust=True, passphrase=passphrase)
+  if not header or not header.data:
+    raise EncryptedBlobError('Could not unwrap the key header.')
+  version = ord(header.data[0])
+  size = len(header.data) - 1
+  if version not in versions or size < secrets_size or \
+        (not versions[version] and size != secrets_size):
+    raise EncryptedBlobError('Could not unwrap the key header.')
+  path = None
+  if versions[version]:
+    path = header.data[1 + secrets_size:].decode('utf-8')
+  return version, header.data[1:1 + secrets_size], path
+
+
+def is_hybrid(prefix):
+  """Whether a blob starting with prefix (at least len(MAGIC) bytes) is in
+  this format."""
+  return prefix[:len(MAGIC)] == MAGIC
+
+
+def encrypt_stream(gpg, recipients, infile, outfile, data_key=None,
+                   path=None):
+  """Encrypts infile, from its current position to the end, into outfile.
+
+  Args:
+    gpg: gnupg.GPG (or another engine) that wraps the key header.
+    recipients: GPG recipients that can decrypt the blob.
+    infile: File-like object to read() cleartext from.
+    outfile: File-like object to write() the blob to.
+    data_key: DataKey to use; a fresh one by default.
+    path: The file's path, to wrap along with the key; see read_path().
+
+  Returns:
+    Number of bytes written.
+  """
+  _check_available()
+  key, mac_key = data_key or new_data_key()
+  iv = os.urandom(_IV_SIZE)
+  wrapped = wrap_header(gpg, recipients, _VERSION, key + mac_key + iv, path)
+
+  mac = hmac.new(mac_key, digestmod=sha256)
+  def write(data):
+    if data:
+      mac.update(data)
+      outfile.write(data)
+
+  write(_PREAMBLE.pack(MAGIC, _VERSION, len(wrapped)) + wrapped)
+  cipher = _cipher(key, iv, _ENCODE)
+  num_written = _PREAMBLE.size + len(wrapped)
+  while True:
+    data = infile.read(_CHUNK_SIZE)
+    if not data:
+      break
+    encrypted = cipher.update(data)
+    write(encrypted)
+    num_written += len(encrypted)
+  encrypted = cipher.final()
+  write(encrypted)
+  outfile.write(mac.digest())
+  return num_written + len(encrypted) + _TAG_SIZE
+
+
+def _read_exactly(infile, size):
+  data = infile.read(size)
+  if len(data) != size:
+    raise EncryptedBlobError('Blob is truncated.')
+  return data
+
+
+def _open_header(gpg, infile, passphrase):
+  """Reads and unwraps the header of a blob that infile is at the start of.
+
+  Returns:
+    (preamble and wrapped header as stored, secrets, path).
+  """
+  preamble = _read_exactly(infile, _PREAMBLE.size)
+  magic, version, header_length = _PREAMBLE.unpack(preamble)
+  if magic != MAGIC or version not in _READABLE_VERSIONS:
+    raise EncryptedBlobError('Not a version %d hybrid blob.' % _VERSION)
+  wrapped = _read_exactly(infile, header_length)
+  header_version, secrets, path = unwrap_header(
+    gpg, wrapped, _READABLE_VERSIONS, _SECRETS_SIZE, passphrase)
+  if header_version != version:
+    raise EncryptedBlobError('Could not unwrap the key header.')
+  return preamble + wrapped, secrets, path
+
+
+def read_path(gpg, infile, passphrase=None):
+  """The path wrapped in the header of the blob that infile is at the start
+  of; only the header is read.
+
+  The header is only authenticated along with the rest of the blob, so this
+  trusts gpg's own integrity check.
+
+  Returns:
+    The path, or None if the blob's header has none.
+
+  Raises:
+    EncryptedBlobError: The blob is not in this format, is truncated or
+      cannot be decrypted with our keys.
+  """
+  _check_available()
+  return _open_header(gpg, infile, passphrase)[2] or None
+
+
+def decrypt_stream(gpg, infile, outfile, passphrase=None):
+  """Decrypts a blob that encrypt_stream() wrote.
+
+  Cleartext is written as it is decrypted and the tag can only be checked at
+  the end, so callers must discard outfile if this raises.
+
+  Returns:
+    The blob's DataKey.
+
+  Raises:
+    EncryptedBlobError: The blob is not in this format, is truncated, cannot
+      be decrypted with our keys, or fails authentication.
+  """
+  _check_available()
+  stored_header, secrets, _ = _open_header(gpg, infile, passphrase)
+  key = secrets[:_KEY_SIZE]
+  mac_key = secrets[_KEY_SIZE:_KEY_SIZE + _MAC_KEY_SIZE]
+  iv = secrets[_KEY_SIZE + _MAC_KEY_SIZE:]
+
+  mac = hmac.new(mac_key, stored_header, digestmod=sha256)
+  cipher = _cipher(key, iv, _DECODE)
+  # The last _TAG_SIZE bytes read so far; they may be the tag.
+  pending = ''
+  while True:
+    data = infile.read(_CHUNK_SIZE)
+    if not data:
+      break
+    pending += data
+    encrypted, pending = pending[:-_TAG_SIZE], pending[-_TAG_SIZE:]
+    if encrypted:
+      mac.update(encrypted)
+      outfile.write(cipher.update(encrypted))
+  if len(pending) != _TAG_SIZE:
+    raise EncryptedBlobError('Blob is truncated.')
+  if not hmac.compare_digest(mac.digest(), pending):
+    raise EncryptedBlobError('Blob failed authentication.')
+  outfile.write(cipher.final())
+  return DataKey(key, mac_key)
+
+
+def encrypt_chunk(data_key, context, data):
+  """Seals data, one chunk of a file, under data_key.
+
+  Args:
+    context: Identifies the chunk (e.g., blob id, index and count); the same
+      context must be given to decrypt_chunk().
+  """
+  _check_available()
+  iv = os.urandom(_IV_SIZE)
+  cipher = _cipher(data_key.key, iv, _ENCODE)
+  sealed = iv + cipher.update(data) + cipher.final()
+  return sealed + hmac.new(data_key.mac_key, context + sealed,
+                           digestmod=sha256).digest()
+
+
+def decrypt_chunk(data_key, context, chunk):
+  """Opens a chunk that encrypt_chunk() sealed with the same key and context.
+
+  Raises:
+    EncryptedBlobError: The chunk is truncated or fails authentication.
+  """
+  _check_available()
+  if len(chunk) < _IV_SIZE + _TAG_SIZE:
+    raise EncryptedBlobError('Chunk is truncated.')
+  sealed, tag = chunk[:-_TAG_SIZE], chunk[-_TAG_SIZE:]
+  if not hmac.compare_digest(
+      hmac.new(data_key.mac_key, context + sealed, digestmod=sha256).digest(),
+      tag):
+    raise EncryptedBlobError('Chunk failed authentication.')
+  cipher = _cipher(data_key.key, sealed[:_IV_SIZE], _DECODE)
+  return cipher.update(sealed[_IV_SIZE:]) + cipher.final()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""In-memory index of the public keyring, refreshed when the keyring changes.
+
+gnupg.GPG.list_keys() and uid_to_keyid() start gpg and parse the whole
+keyring on every call, which is too slow to do for each file that needs its
+recipients resolved. KeyringIndex lists the keys once and answers lookups
+from dicts until the public keyring file's stat (mtime, size, inode) changes,
+e.g., after a key is imported or deleted.
+
+Usage:
+  keyring = KeyringIndex(gpg)
+  key = keyring.lookup('Matt Tierney <tierney@cs.nyu.edu>')
+  keys = keyring.search('tierney')
+  recipients = [key.fingerprint for key in keys]
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from hash_cache import path_stat_key
+
+# Newer gpg keeps public keys in a keybox; older ones in a keyring.
+_PUBRINGS = ['pubring.kbx', 'pubring.gpg']
+
+# One public key. expires is seconds since the epoch, or None if it does not
+# expire.
+KeyInfo = namedtuple('KeyInfo', ['keyid', 'fingerprint', 'uids', 'date',
+                                 'expires'])
+
+
+def _expires(value):
+  return int(value) if value else None
+
+
+class KeyringIndex(object):
+  def __init__(self, gpg, pubring_path=None):
+    """
+    Args:
+      gpg: gnupg.GPG whose keyring to index.
+      pubring_path: The public keyring file to watch; found from gpg's
+        keyring or home directory by default.
+    """
+    self.gpg = gpg
+    self.pubring_path = pubring_path or self._find_pubring()
+    self._lock = threading.Lock()
+    # hash_cache.stat_key() of the keyring when it was last listed; the index
+    # is empty until then.
+    self._stat = None
+    self._listed = False
+    self._keys = list()
+    self._by_uid = dict()
+
+
+  def _find_pubring(self):
+    home = getattr(self.gpg, 'gnupghome', None) or \
+        os.environ.get('GNUPGHOME') or os.path.expanduser('~/.gnupg')
+    keyring = getattr(self.gpg, 'keyring', None)
+    if keyring:
+      return os.path.join(home, os.path.expanduser(keyring))
+    for name in _PUBRINGS:
+      path = os.path.join(home, name)
+      if os.path.exists(path):
+        return path
+    return os.path.join(home, _PUBRINGS[-1])
+
+
+  def stat_key(self):
+    """hash_cache.stat_key() of the public keyring as it is now; it changes
+    whenever keys are imported or deleted."""
+    return path_stat_key(self.pubring_path)
+
+
+  def _refresh(self):
+    """Lists the keys again if the keyring changed since the last time."""
+    stat = self.stat_key()
+    with self._lock:
+      if self._listed and stat == self._stat:
+        return
+      logging.info('Indexing keyring (%s).' % self.pubring_path)
+      keys = [KeyInfo(key['keyid'], key.get('fingerprint', ''),
+                      list(key['uids']), key['date'],
+                      _expires(key['expires']))
+              for key in self.gpg.list_keys()]
+      by_uid = dict()
+      for key in keys:
+        for uid in key.uids:
+          by_uid.setdefault(uid.lower(), key)
+      self._keys = keys
+      self._by_uid = by_uid
+      self._stat = stat
+      self._listed = True
+
+
+  def keys(self):
+    """All public keys, as KeyInfos."""
+    self._refresh()
+    return list(self._keys)
+
+
+  def uid_to_keyid(self):
+    """The same as gnupg.GPG.uid_to_keyid(), without starting gpg."""
+    self._refresh()
+    return dict((uid, key.keyid) for key in self._keys for uid in key.uids)
+
+
+  def lookup(self, uid, include_expired=False):
+    """The key with exactly this uid (ignoring case), or None."""
+    self._refresh()
+    key = self._by_uid.get(uid.lower())
+    if key and (include_expired or not self._expired(key)):
+      return key
+    return None
+
+
+  def search(self, text, include_expired=False):
+    """Keys with a uid containing text (ignoring case), in keyring order."""
+    self._refresh()
+    text = text.lower()
+    return [key for key in self._keys
+            if any(text in uid.lower() for uid in key.uids) and
+            (include_expired or not self._expired(key))]
+
+
+  @staticmethod
+  def _expired(key):
+    return key.expires is not None and key.expires < time.time()
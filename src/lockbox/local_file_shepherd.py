@@ -1,12 +1,52 @@
 #!/usr/bin/env python
+"""Moves a local file change from the mediator's queue to the cloud.
+
+The work is split into stages so that CPU-bound and network-bound steps
+overlap:
+
+  LocalFileShepherd  scan/hash: crypto setup, path hash, previous version.
+  signature          rsync delta and signature, for modifications.
+  encrypt            Encryption of the file or delta, through gpg or with
+                     AES under a gpg-wrapped key (hybrid_crypto), optionally
+                     compressed first (compression). New files are signed
+                     and encrypted in one read. Large files are chunked
+                     (chunked_crypto), and each chunk is uploaded as soon as
+                     it is encrypted, while later ones are read and
+                     encrypted; only a few chunks are on disk at a time.
+  upload             Blob (and encrypted path) upload. With batched paths,
+                     new files' paths are instead handed to a PathPublisher,
+                     which passes the job on to commit once the manifest
+                     holding its path is stored.
+  commit             Metadata update and queue bookkeeping.
+
+The mediator assigns rows to the shepherds. Each shepherd wraps its row in a
+ShepherdJob and puts it on the ShepherdPipeline, whose stages each have their
+own pool of workers and a bounded queue in front of them (see stage.py).
+
+After every stage (and every uploaded part) the job's outputs are
+checkpointed in the mediator's database, so that after a crash a row picks up
+after its last completed stage instead of starting over.
+
+With a StagingArea (see staging.py), a job reserves room for its temporary
+files before the first stage that writes them (signature for modifications,
+encrypt for new files) and gives it back when it finishes, so those stages
+wait while the staging area is full.
+"""
 
 import logging
+import multiprocessing
+import os
 import threading
-import time
-from crypto_util import hash_string
+from collections import namedtuple
+from crypto_util import hash_string, hash_filename
 from file_update_crypto import FileUpdateCrypto
+from hash_cache import path_stat_key
+from master_db_connection import close_pooled_connections
+from path_manifest import PathPublisher
+from stage import Stage
 from update_cloud_file import UpdateCloudFile
 from random import randint
+from Queue import Queue
 from util import enum
 from exception import VersioningError
 from file_change_status import STATUS_PREPARE, STATUS_CANCELED, \
@@ -18,174 +58,592 @@ from watchdog.events import EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, \
 
 SHEPHERD_STATE_READY = 'ready'
 SHEPHERD_STATE_ASSIGNED = 'assigned'
-_SHEPHERD_STATE_ASSIGNED_AND_READY = 'assigned_and_ready'
 SHEPHERD_STATE_ENCRYPTING = 'encrypting'
 SHEPHERD_STATE_UPLOADING = 'uploading'
 SHEPHERD_STATE_SHUTDOWN = 'shutdown'
 
-
-class LocalFileShepherd(threading.Thread):
-  def __init__(self, mediator, gpg, blob_store, metadata_store):
-    threading.Thread.__init__(self)
+_NUM_CPUS = multiprocessing.cpu_count()
+
+# Workers per pipeline stage. Signatures and encryption are CPU-bound; uploads
+# mostly wait on the network.
+DEFAULT_POOL_SIZES = {
+  'signature': _NUM_CPUS,
+  'encrypt': _NUM_CPUS,
+  'upload': 4,
+  'commit': 1,
+  }
+# Jobs that may wait in front of each stage before the one feeding it blocks.
+_DEFAULT_QUEUE_SIZE = 4
+
+# Stage names in pipeline order, as recorded in checkpoints.
+STAGE_SCAN = 'scan'
+STAGE_SIGNATURE = 'signature'
+STAGE_ENCRYPT = 'encrypt'
+STAGE_UPLOAD = 'upload'
+STAGE_COMMIT = 'commit'
+
+# The uid of the key files are encrypted to, until recipients come from the
+# group's members.
+_RECIPIENT = 'Matt Tierney <tierney@cs.nyu.edu>'
+
+# Parts of a file that the upload stage sends.
+_PART_PATH = 'path'
+_PART_BLOB = 'blob'
+
+
+# A row handed from the mediator to a shepherd. Immutable, so the two threads
+# never share mutable state.
+ShepherdTask = namedtuple('ShepherdTask', ['status_id', 'timestamp',
+                                           'event_type', 'src_path',
+                                           'dest_path'])
+
+# Put on a shepherd's task queue to make it exit.
+_SHUTDOWN = object()
+
+
+class ShepherdJob(object):
+  """A queue row on its way through the pipeline, along with whatever the
+  stages have worked out about it so far."""
+  def __init__(self, status_id, timestamp, event_type, src_path, dest_path):
+    self.status_id = status_id
+    self.timestamp = timestamp
+    self.event_type = event_type
+    self.src_path = src_path
+    self.dest_path = dest_path
+    self.crypto = None
+    self.previous = None
+    self.updater = None
+    # hash_cache.stat_key() of src_path when it was scanned.
+    self.source_stat = None
+    self.uploaded_parts = set()
+    # Bytes reserved in the pipeline's StagingArea.
+    self.staged_bytes = 0
+
+
+  def record_source(self):
+    """Notes the source's stat key, or None if it does not exist (e.g., for
+    deletions)."""
+    self.source_stat = path_stat_key(self.src_path)
+
+
+  def checkpoint(self):
+    return {
+      'crypto': self.crypto.checkpoint(),
+      'previous': self.previous,
+      'source_stat': self.source_stat,
+      'uploaded_parts': sorted(self.uploaded_parts),
+      }
+
+
+  @staticmethod
+  def restore(gpg, status_id, timestamp, event_type, src_path, dest_path,
+              checkpoint):
+    """Rebuilds a job from its checkpoint.
+
+    Returns:
+      The job, or None if the checkpoint can no longer be trusted because the
+      source file changed or a temp file is gone. In that case the remaining
+      temp files are removed.
+    """
+    job = ShepherdJob(status_id, timestamp, event_type, src_path, dest_path)
+    job.crypto = FileUpdateCrypto.restore(gpg, checkpoint['crypto'])
+    job.previous = checkpoint['previous']
+    job.uploaded_parts = set(checkpoint['uploaded_parts'])
+
+    recorded_stat = checkpoint['source_stat']
+    if recorded_stat is not None:
+      recorded_stat = tuple(recorded_stat)
+    job.record_source()
+    stale = recorded_stat != job.source_stat or \
+        not job.crypto.resumable() or \
+        not all(os.path.exists(path) for path in job.crypto.temp_files())
+
+    if stale:
+      logging.info('Discarding checkpoint for (%s).' % src_path)
+      job.crypto.cleanup()
+      return None
+    return job
+
+
+  def __repr__(self):
+    return '(%d, %f, %s, %s, %s)' % (self.status_id, self.timestamp,
+                                     self.event_type, self.src_path,
+                                     self.dest_path)
+
+
+class ShepherdPipeline(object):
+  """The stages after scan/hash, chained signature -> encrypt -> upload ->
+  commit."""
+  def __init__(self, mediator, gpg, blob_store, metadata_store,
+               pool_sizes=None, queue_size=_DEFAULT_QUEUE_SIZE,
+               batch_paths=False, staging=None):
+    """
+    Args:
+      batch_paths: Whether to publish new files' paths in batched manifests
+        (see path_manifest) rather than as a blob each.
+      staging: staging.StagingArea whose quota jobs' temporary files count
+        against; unlimited if None.
+    """
     self.mediator = mediator
     self.gpg = gpg
     self.blob_store = blob_store
     self.metadata_store = metadata_store
-    self.state = SHEPHERD_STATE_READY
+    self.staging = staging
+    self.pool_sizes = dict(DEFAULT_POOL_SIZES)
+    self.pool_sizes.update(pool_sizes or dict())
+
+    # The commit stage is not checkpointed: finishing a job forgets it.
+    self.commit = Stage(STAGE_COMMIT, self._commit,
+                        self.pool_sizes[STAGE_COMMIT], queue_size,
+                        failure_callback=self.fail)
+    self.upload = Stage(STAGE_UPLOAD,
+                        self._checkpointed(STAGE_UPLOAD, self._upload),
+                        self.pool_sizes[STAGE_UPLOAD], queue_size,
+                        next_stage=self.commit, failure_callback=self.fail)
+    self.encrypt = Stage(STAGE_ENCRYPT,
+                         self._checkpointed(STAGE_ENCRYPT, self._encrypt),
+                         self.pool_sizes[STAGE_ENCRYPT], queue_size,
+                         next_stage=self.upload, failure_callback=self.fail)
+    self.signature = Stage(STAGE_SIGNATURE,
+                           self._checkpointed(STAGE_SIGNATURE, self._signature),
+                           self.pool_sizes[STAGE_SIGNATURE], queue_size,
+                           next_stage=self.encrypt, failure_callback=self.fail)
+    self.stages = [self.signature, self.encrypt, self.upload, self.commit]
+    self.path_publisher = None
+    if batch_paths:
+      self.path_publisher = PathPublisher(gpg, blob_store,
+                                          self._path_published, self.fail)
+
+    # Running total of encrypted bytes sent to the blob store.
+    self.uploaded_bytes = 0
+    self._uploaded_bytes_lock = threading.Lock()
+
+
+  def start(self):
+    for stage in reversed(self.stages):
+      stage.start()
+      if stage is self.commit and self.path_publisher:
+        self.path_publisher.start()
+
+
+  def put(self, job):
+    """Blocks until the staging area has room for job, then while the
+    signature stage is backed up.
+
+    Room is reserved here, before any stage holds the job, and kept until it
+    finishes: a job that waited for room inside a stage would hold that
+    stage's worker, which the jobs ahead of it that hold the room may need.
+    """
+    self._reserve_staging(job)
+    self.signature.put(job)
+
+
+  def resume(self, job, completed_stage):
+    """Puts a restored job on the stage after completed_stage."""
+    if self.staging:
+      # Its files are already on disk; count them without waiting.
+      job.staged_bytes = self.staging.reserve(
+        sum(os.path.getsize(path) for path in job.crypto.temp_files()),
+        block=False)
+    stage_names = [STAGE_SCAN] + [stage.name for stage in self.stages]
+    next_index = stage_names.index(completed_stage)
+    if next_index >= len(self.stages):
+      self._finish(job, STATUS_COMPLETED)
+      return
+    logging.info('Resuming %s at %s.' % (job, self.stages[next_index].name))
+    self.stages[next_index].put(job)
+
+
+  def _checkpointed(self, name, work):
+    def checkpointed_work(job):
+      carry_on = work(job)
+      if carry_on:
+        self.mediator.checkpoint(job.status_id, name, job.checkpoint())
+      return carry_on
+    return checkpointed_work
 
 
   def shutdown(self):
-    # TODO(tierney): Call the MultiPartUpload cancel.
-    logging.info('Shutdown not fully implemented.')
-    self.state = SHEPHERD_STATE_SHUTDOWN
+    """Drains the stages front to back."""
+    for stage in self.stages:
+      if stage is self.commit and self.path_publisher:
+        self.path_publisher.stop()
+        self.path_publisher.join()
+      stage.shutdown()
 
 
-  def _lookup_previous(self):
-    logging.info('Looking up local view of previous (%s).' %
-                 self.crypto.hash_of_file_path)
-    self.previous = self.metadata_store.local_view_of_previous(
-      self.crypto.hash_of_file_path)
-    logging.info('Previous set to (%s).' % self.previous)
+  def _reserve_staging(self, job):
+    """Blocks until the staging area has room for what job will stage: its
+    encrypted blob and, for modifications, its delta, each taken to be about
+    the size of the file."""
+    if not self.staging or job.staged_bytes or \
+          job.event_type not in (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED):
+      return
+    try:
+      size = os.path.getsize(job.src_path)
+    except OSError:
+      return
+    if job.event_type == EVENT_TYPE_MODIFIED:
+      size *= 2
+    job.staged_bytes = self.staging.reserve(size)
 
 
-  def _lookup_recipients(self):
-    logging.warning('_lookup_recipients not implemented yet.')
-    logging.warning('Must escape recipients.')
-    self.escaped_recipients = ['\"Matt Tierney\"']
+  def _release_staging(self, job):
+    if job.staged_bytes:
+      self.staging.release(job.staged_bytes)
+      job.staged_bytes = 0
 
 
-  def _get_crypto_info(self):
-    self._lookup_recipients()
-    self.crypto = FileUpdateCrypto(
-      self.gpg, self.src_path, self.escaped_recipients)
-    self.crypto.hash_file_path()
+  def _finish(self, job, state):
+    if job.crypto:
+      job.crypto.cleanup()
+    self._release_staging(job)
+    self.mediator.update(job.status_id, state)
+    self.mediator.done(job.src_path, job.status_id)
 
 
-  def _run_encryption(self):
-    self.crypto.run()
-    self.metadata_store.set_signature(self.crypto.hash_of_encrypted_blob,
-                                      self.crypto.ascii_signature)
+  def fail(self, job, error):
+    self._finish(job, STATUS_FAILED)
 
 
-  def _update_cloud_file(self):
-    """Should already have set self.crypto."""
-    self.updater = UpdateCloudFile(self.blob_store, self.metadata_store,
-                                   self.crypto, self.previous)
+  def skip(self, job):
+    """Finishes a job whose file has not changed since it was last synced."""
+    logging.info('(%s) is unchanged; nothing to sync.' % job.src_path)
+    self._finish(job, STATUS_COMPLETED)
 
-    logging.info('Sending metadata.')
-    if not self.updater.update_metadata():
-      logging.warning('Could not update the metadata.')
-      return False
-    logging.info('Updated metadata.')
 
-    logging.info('Sending blobdata.')
-    if self.event_type == EVENT_TYPE_CREATED:
-      self.updater.update_path()
-    self.updater.update_blob()
-    logging.info('Updated blobdata.')
+  def requeue(self, job):
+    """Puts a job that lost its worker back in the mediator's queue."""
+    if job.crypto:
+      job.crypto.cleanup()
+    self._release_staging(job)
+    self.mediator.requeue(job.status_id, job.src_path)
 
 
-  def assign(self, status_id, timestamp, state, event_type, src_path,
-             dest_path):
-    self.state = SHEPHERD_STATE_ASSIGNED
-    self.status_id = status_id
-    self.timestamp = timestamp
-    self.state = state
-    self.event_type = event_type
-    self.src_path = src_path
-    self.dest_path = dest_path
-    self.state = _SHEPHERD_STATE_ASSIGNED_AND_READY
+  def heal(self):
+    """Replaces dead stage workers and requeues the jobs they held."""
+    for stage in self.stages:
+      for job in stage.heal():
+        self.requeue(job)
 
 
-  def get_state(self):
-    return self.state
+  def _signature(self, job):
+    if job.event_type == EVENT_TYPE_CREATED:
+      # The encrypt stage signs new files in the same pass (sign_and_encrypt).
+      return True
 
+    if job.event_type == EVENT_TYPE_MODIFIED:
+      return self._delta(job)
 
-  def _clear(self):
-    del self.status_id, self.timestamp, self.state, self.event_type, \
-        self.src_path, self.dest_path, self.crypto, self.previous
+    logging.warning('%s not implemented yet; skipping (%s).' %
+                    (job.event_type, job.src_path))
+    self._finish(job, STATUS_COMPLETED)
+    return False
 
 
-  def _modified(self):
+  def _delta(self, job):
     # Look up the signature of the previous whole file (from the src_path index?)
     logging.info('Getting local view of previous.')
     latest = self.metadata_store.local_view_of_previous(
-      hash_string(self.src_path))
+      hash_string(job.src_path))
     if not latest:
       logging.error('Have not seen this file before (%s), yet '
-                    'we are shepherding a modification.' % self.src_path)
+                    'we are shepherding a modification.' % job.src_path)
+      self._finish(job, STATUS_FAILED)
       return False
 
     logging.info('Getting signature of hash_of_blob (%s).' % latest)
     latest_signature = self.metadata_store.lookup_signature(latest)
     if not latest_signature:
       logging.error('We do not have the latest signature.')
+      self._finish(job, STATUS_FAILED)
       return False
 
     logging.info('Computing the delta.')
-    # compute_cleartext_delta(prev_sig, latest_filename)
-    delta_file_name = self.crypto.compute_cleartext_delta(
-      latest_signature, self.src_path)
-    logging.info('Updating crypto file path to delta file (%s).' %
-                 delta_file_name)
+    delta = job.crypto.compute_cleartext_delta(latest_signature, job.src_path)
+    logging.info('Computed delta (%d bytes).' % delta.size)
+    return True
+
+
+  def _encrypt(self, job):
+    self.mediator.update(job.status_id, STATUS_ENCRYPTING)
+    logging.info('Encrypting (%s).' % job.src_path)
+    if job.event_type == EVENT_TYPE_CREATED:
+      job.crypto.sign_and_encrypt(
+        with_path=self.path_publisher is None,
+        upload_chunk=lambda index, key, path:
+            self._upload_chunk(job, index, key, path))
+      # Made for the chunks, before the blob was hashed and signed.
+      job.updater = None
+      if job.crypto.path_in_header():
+        # The blob carries the path; there is nothing else to send for it.
+        job.uploaded_parts.add(_PART_PATH)
+    else:
+      # encrypt delta (get back the hash_of_encrypted_blob)
+      job.crypto.encrypt_delta_file()
+
+    # Locally store: hash(gpg(blob or delta)) -> signature(file)
+    logging.info('Setting new signature (%s) : (%s).' %
+                 (job.crypto.hash_of_encrypted_blob,
+                  job.crypto.ascii_signature))
+    self.metadata_store.set_signature(job.crypto.hash_of_encrypted_blob,
+                                      job.crypto.ascii_signature)
+    return True
 
 
-    logging.info('Encrypting.')
-    # encrypt delta (get back the hash_of_encrypted_blob)
-    self.crypto.rsync_signature()
-    self.crypto.encrypt_delta_file()
+  def _updater(self, job):
+    if not job.updater:
+      job.updater = UpdateCloudFile(self.blob_store, self.metadata_store,
+                                    job.crypto, job.previous)
+    return job.updater
 
-    # Locally store: hash(gpg(delta)) -> signature(file)
-    logging.info('Setting new signature (%s) : (%s).' %
-                 (self.crypto.hash_of_encrypted_blob,
-                  self.crypto.ascii_signature))
-    self.metadata_store.set_signature(self.crypto.hash_of_encrypted_blob,
-                                      self.crypto.ascii_signature)
 
+  def _upload(self, job):
+    """Sends the parts that a previous attempt did not get to."""
+    self.mediator.update(job.status_id, STATUS_UPLOADING)
+    updater = self._updater(job)
+
+    logging.info('Sending blobdata.')
+    path_pending = job.event_type == EVENT_TYPE_CREATED and \
+        _PART_PATH not in job.uploaded_parts
+    if path_pending and not self.path_publisher:
+      if not job.crypto.hash_of_raw_data_of_encrypted_blob_path:
+        # Checkpointed while paths were being batched.
+        job.crypto.encrypt_path()
+        job.updater = None
+        updater = self._updater(job)
+      updater.update_path()
+      job.uploaded_parts.add(_PART_PATH)
+      path_pending = False
+      self.mediator.checkpoint(job.status_id, STAGE_ENCRYPT, job.checkpoint())
+    # Chunks left over from the encrypt stage go before the manifest that
+    # names them.
+    for index, key, path in job.crypto.encrypted_chunks():
+      self._upload_chunk(job, index, key, path)
+      self.mediator.checkpoint(job.status_id, STAGE_ENCRYPT, job.checkpoint())
+    if _PART_BLOB not in job.uploaded_parts:
+      updater.update_blob()
+      job.uploaded_parts.add(_PART_BLOB)
+      with self._uploaded_bytes_lock:
+        self.uploaded_bytes += job.crypto.encrypted_blob_size()
+    logging.info('Updated blobdata.')
+
+    if path_pending:
+      # The publisher puts the job on the commit stage once its path is out.
+      self.mediator.checkpoint(job.status_id, STAGE_ENCRYPT, job.checkpoint())
+      self.path_publisher.put(job)
+      return False
+    return True
+
+
+  def _upload_chunk(self, job, index, key, path):
+    """Sends one encrypted chunk and removes its temporary file."""
+    self._updater(job).update_chunk(key, path)
+    size = os.path.getsize(path)
+    job.crypto.chunk_uploaded(index)
+    with self._uploaded_bytes_lock:
+      self.uploaded_bytes += size
+
+
+  def _path_published(self, job, reference):
+    job.crypto.hash_of_raw_data_of_encrypted_blob_path = reference
+    job.uploaded_parts.add(_PART_PATH)
+    # Rebuilt from the crypto state, now with the path reference.
+    job.updater = None
+    self.mediator.checkpoint(job.status_id, STAGE_UPLOAD, job.checkpoint())
+    self.commit.put(job)
+
+
+  def _commit(self, job):
+    """Points the metadata at the uploaded blob only once it is in place."""
+    logging.info('Sending metadata.')
+    try:
+      if not self._updater(job).update_metadata():
+        logging.warning('Could not update the metadata.')
+        self._finish(job, STATUS_FAILED)
+        return False
+    except VersioningError:
+      logging.error('Got a VersioningError so did not commit (%s).' %
+                    job.src_path)
+      self._finish(job, STATUS_FAILED)
+      return False
+
+    logging.info('Updated metadata.')
+    self.mediator.hash_cache.store(job.src_path, job.source_stat,
+                                   job.crypto.hash_of_cleartext)
+    self._finish(job, STATUS_COMPLETED)
+    return True
+
+
+class LocalFileShepherd(threading.Thread):
+  """Scan/hash stage. Takes rows from the mediator, prepares their crypto
+  state and feeds them to the pipeline.
+
+  The mediator hands rows over with assign(), which puts an immutable
+  ShepherdTask on the shepherd's own queue; the shepherd blocks on that queue
+  while it is idle. State changes happen under a lock so that assign(),
+  retire() and the shepherd itself agree on whether it is free.
+  """
+  def __init__(self, mediator, pipeline, gpg, metadata_store):
+    threading.Thread.__init__(self)
+    self.mediator = mediator
+    self.pipeline = pipeline
+    self.gpg = gpg
+    self.metadata_store = metadata_store
+    self.state = SHEPHERD_STATE_READY
+    self._state_lock = threading.Lock()
+    # Holds at most one task (assign() only accepts work when we are ready),
+    # plus _SHUTDOWN.
+    self._tasks = Queue()
+    # (status_id, src_path) of the row we hold until it is in the pipeline.
+    self._claimed = None
+
+
+  def claimed(self):
+    return self._claimed
+
+
+  def shutdown(self):
+    """Exits once any task already handed over has gone into the pipeline."""
+    # TODO(tierney): Call the MultiPartUpload cancel.
+    with self._state_lock:
+      self.state = SHEPHERD_STATE_SHUTDOWN
+    self._tasks.put(_SHUTDOWN)
+
+
+  def retire(self):
+    """Shuts the shepherd down if, and only if, it is idle.
+
+    Returns:
+      True if the shepherd is shutting down.
+    """
+    with self._state_lock:
+      if self.state != SHEPHERD_STATE_READY:
+        return False
+      self.state = SHEPHERD_STATE_SHUTDOWN
+    self._tasks.put(_SHUTDOWN)
+    return True
+
+
+  def _lookup_previous(self, job):
+    logging.info('Looking up local view of previous (%s).' %
+                 job.crypto.hash_of_file_path)
+    job.previous = self.metadata_store.local_view_of_previous(
+      job.crypto.hash_of_file_path)
+    logging.info('Previous set to (%s).' % job.previous)
 
-  def run(self):
-    while self.state is not SHEPHERD_STATE_SHUTDOWN:
-      if self.state is SHEPHERD_STATE_READY:
-        time.sleep(1)
-        continue
-
-      if self.state is _SHEPHERD_STATE_ASSIGNED_AND_READY:
-        logging.info('Got event (%d, %f, %s, %s, %s, %s).'
-                     % (self.status_id, self.timestamp, self.state,
-                        self.event_type, self.src_path, self.dest_path))
-        logging.info('Time to encrypt.')
-        self.mediator.update(self.status_id, STATUS_ENCRYPTING)
-        self.state = SHEPHERD_STATE_ENCRYPTING
-
-
-      if self.state is SHEPHERD_STATE_ENCRYPTING:
-        logging.info('Encrypting.')
-        self._get_crypto_info()
-        self._lookup_previous()
-        if self.event_type == EVENT_TYPE_CREATED:
-          self._run_encryption()
-        elif self.event_type == EVENT_TYPE_MODIFIED:
-          logging.warning('EVENT_TYPE_MODIFIED encryption not implemented yet.')
-          self._modified()
-
-        logging.info('Finished encrypting.')
-        self.mediator.update(self.status_id, STATUS_UPLOADING)
-        self.state = SHEPHERD_STATE_UPLOADING
-
-
-      if self.state is SHEPHERD_STATE_UPLOADING:
-        logging.info('Uploading.')
-        try:
-          self._update_cloud_file()
-        except VersioningError:
-          logging.error('Got a VersioningError so did not upload (%s).' %
-                        self.src_path)
-
-
-        logging.info('Done.')
-        self.mediator.update(self.status_id, STATUS_COMPLETED)
-        self.mediator.done(self.src_path, self.ident)
-        self._clear()
-
-        self.state = SHEPHERD_STATE_READY
 
+  def _lookup_recipients(self):
+    """Resolves the recipients to fingerprints by their exact uids in the
+    mediator's keyring index, without starting gpg."""
+    keyring = self.mediator.keyring
+    if keyring:
+      key = keyring.lookup(_RECIPIENT)
+      if key:
+        return [key.fingerprint]
+      logging.warning('No key for (%s) in the keyring.' % _RECIPIENT)
+    logging.warning('Must escape recipients.')
+    return ['\"%s\"' % _RECIPIENT]
+
+
+  def _get_crypto_info(self, job):
+    job.crypto = FileUpdateCrypto(
+      self.gpg, job.src_path, self._lookup_recipients(),
+      self.mediator.bulk_cipher, self.mediator.compression,
+      self.mediator.staging and self.mediator.staging.directory)
+    job.crypto.hash_file_path()
+
+
+  def assign(self, status_id, timestamp, state, event_type, src_path,
+             dest_path):
+    """Hands the shepherd a row.
+
+    Returns:
+      True if the shepherd took the row; False if it was not ready (e.g., it
+      has just been shut down), in which case the caller still owns the row.
+    """
+    with self._state_lock:
+      if self.state != SHEPHERD_STATE_READY:
+        return False
+      self.state = SHEPHERD_STATE_ASSIGNED
+      self._claimed = (status_id, src_path)
+    self._tasks.put(ShepherdTask(status_id, timestamp, event_type, src_path,
+                                 dest_path))
+    return True
+
+
+  def get_state(self):
+    return self.state
+
+
+  def _unchanged(self, job):
+    """Whether the file has the same bytes as when it was last synced,
+    according to the hash cache. Costs a stat() if its stat key has not
+    changed, and a read to hash it if it has."""
+    if job.event_type not in [EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED] or \
+          job.source_stat is None:
+      return False
+    hash_cache = self.mediator.hash_cache
+    entry = hash_cache.lookup(job.src_path)
+    if not entry:
+      return False
+    if entry.stat_key == job.source_stat:
+      return True
+
+    # E.g., touched or chmod'ed. Only the bytes matter.
+    if hash_filename(job.src_path) != entry.digest:
+      return False
+    hash_cache.store(job.src_path, job.source_stat, entry.digest)
+    return True
+
+
+  def _forget_synced(self, job):
+    """Drops the hash cache entries that a deletion or move leaves stale:
+    the source's, and for a move whatever the destination held before."""
+    if job.event_type == EVENT_TYPE_DELETED:
+      self.mediator.hash_cache.forget(job.src_path)
+    elif job.event_type == EVENT_TYPE_MOVED:
+      self.mediator.hash_cache.forget(job.src_path)
+      self.mediator.hash_cache.forget(job.dest_path)
+
+
+  def _scan(self, task):
+    job = ShepherdJob(*task)
+    logging.info('Got event %s.' % job)
+    try:
+      job.record_source()
+      self._forget_synced(job)
+      if self._unchanged(job):
+        self.pipeline.skip(job)
+        return
+      self._get_crypto_info(job)
+      self._lookup_previous(job)
+      self.mediator.checkpoint(job.status_id, STAGE_SCAN, job.checkpoint())
+    except Exception, e:
+      logging.exception('Scanning (%s) failed: %s' % (job.src_path, e))
+      self.pipeline.fail(job, e)
+    else:
+      # Blocks while the pipeline is backed up, which in turn keeps the
+      # mediator from handing us more work.
+      self.pipeline.put(job)
+
+
+  def run(self):
+    try:
+      while True:
+        task = self._tasks.get()
+        if task is _SHUTDOWN:
+          break
+
+        self._scan(task)
+
+        # Become ready before telling the mediator, which wakes up and
+        # immediately looks for free shepherds.
+        with self._state_lock:
+          self._claimed = None
+          if self.state != SHEPHERD_STATE_SHUTDOWN:
+            self.state = SHEPHERD_STATE_READY
+        self.mediator.wake()
+    finally:
+      close_pooled_connections()
+    logging.info('%s shutting down.' % self.name)
@@ -19,7 +19,14 @@ import boto
 import gflags
 import gnupg
 from event_handler import LockboxEventHandler
+from chunked_crypto import start_pool
+from gpgme_engine import new_engine, ENGINES, ENGINE_SUBPROCESS
+from gpg_pool import GpgPool
+from compression import COMPRESSION_MODES, COMPRESSION_OFF
+from hybrid_crypto import BULK_CIPHERS, BULK_CIPHER_GPG, BULK_CIPHER_AES
+from keyring_index import KeyringIndex
 from remote_local_mediator import RemoteLocalMediator
+from staging import StagingArea
 from metadata_store import MetadataStore
 from blob_store import BlobStore
 from lockbox import Lockbox
@@ -32,6 +39,31 @@ gflags.DEFINE_string('lock_domain_name', None, 'Lock domain name for a group.')
 gflags.DEFINE_string('data_domain_name', None, 'Data domain name for a group.')
 gflags.DEFINE_string('blob_bucket_name', None, 'Blob bucket name.')
 gflags.DEFINE_multistring('directory', None, 'Directory to monitoring.')
+gflags.DEFINE_enum('gpg_engine', ENGINE_SUBPROCESS, ENGINES,
+                   'How file contents and paths are encrypted: a gpg process '
+                   'per call, or through gpgme.')
+gflags.DEFINE_integer('gpg_workers', None,
+                      'gpg calls that may run at once across shepherds, '
+                      'group operations and the frontend; defaults to one '
+                      'per CPU.')
+gflags.DEFINE_enum('bulk_cipher', BULK_CIPHER_GPG, BULK_CIPHERS,
+                   'How file contents are encrypted: piped through gpg, '
+                   'with AES under a fresh gpg-wrapped key per version, or '
+                   'the same in segments that can be read back by range '
+                   '(not compressed).')
+gflags.DEFINE_enum('compression', COMPRESSION_OFF, COMPRESSION_MODES,
+                   'Whether to compress files before encrypting them, with '
+                   'a codec picked per file from a sample of its contents.')
+gflags.DEFINE_boolean('batch_paths', False,
+                      'Publish the encrypted paths of new files in batched '
+                      'manifests instead of one blob per file (for bulk '
+                      'imports).')
+gflags.DEFINE_string('staging_dir', None,
+                     'Directory for temporary blobs, deltas and chunks '
+                     '(e.g., on a tmpfs); defaults to ~/.lockbox/staging.')
+gflags.DEFINE_integer('staging_quota_mb', None,
+                      'Megabytes of temporary files that may be staged at '
+                      'once; encryption waits for uploads past that.')
 
 gflags.MarkFlagAsRequired('lock_domain_name')
 gflags.MarkFlagAsRequired('data_domain_name')
@@ -48,6 +80,11 @@ def main(argv):
   if FLAGS.debug:
     print 'non-flag arguments:', argv
 
+  # Large files are chunked under the AES bulk cipher; fork the pool that
+  # encrypts the chunks before anything starts a thread.
+  if FLAGS.bulk_cipher == BULK_CIPHER_AES:
+    start_pool()
+
   s3_connection = boto.connect_s3()
   sdb_connection = boto.connect_sdb()
   sns_connection = boto.connect_sns()
@@ -57,8 +94,18 @@ def main(argv):
   metadata_store = MetadataStore(
     sdb_connection, FLAGS.lock_domain_name, FLAGS.data_domain_name)
 
-  gpg = gnupg.GPG()
-  remote_local_mediator = RemoteLocalMediator(gpg, blob_store, metadata_store)
+  staging_quota = None
+  if FLAGS.staging_quota_mb is not None:
+    staging_quota = FLAGS.staging_quota_mb << 20
+  staging = StagingArea(FLAGS.staging_dir, staging_quota)
+
+  gpg = GpgPool(new_engine(FLAGS.gpg_engine, gnupg.GPG(), staging=staging),
+                FLAGS.gpg_workers)
+  remote_local_mediator = RemoteLocalMediator(
+    gpg, blob_store, metadata_store,
+    bulk_cipher=FLAGS.bulk_cipher, batch_paths=FLAGS.batch_paths,
+    compression=FLAGS.compression, staging=staging,
+    keyring=KeyringIndex(gpg))
 
   event_handler = LockboxEventHandler(remote_local_mediator)
 
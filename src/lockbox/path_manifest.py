@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Publishes the encrypted paths of new files in batches.
+
+On its own, every new file costs a gpg call to encrypt its path and a PUT to
+store that path as its own tiny blob. That doubles the work of a bulk import
+of small files. PathPublisher gathers the paths of new files and, once
+flush_count of them have piled up or flush_interval seconds have passed,
+encrypts them together as one manifest (a JSON object mapping each file's
+path hash to its path) and stores that in a single blob. Each file's 'path'
+metadata then refers to the manifest instead of a blob of its own:
+
+  manifest:<SHA1 of the encrypted manifest>
+
+and the file's entry is found in the manifest under its path hash. Paths
+with different recipients go in different manifests.
+
+Usage:
+  publisher = PathPublisher(gpg, blob_store, published, failed)
+  publisher.start()
+
+  publisher.put(job)  # published(job, reference) is called once it is stored.
+
+  publisher.stop()    # Publishes whatever is still pending.
+  publisher.join()
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import json
+import logging
+from binascii import b2a_base64
+from crypto_util import hash_string
+from event_buffer import EventBuffer
+
+PATH_MANIFEST_PREFIX = 'manifest:'
+
+_MANIFEST_VERSION = 1
+_FLUSH_COUNT = 1024
+_FLUSH_INTERVAL_SECONDS = 1.
+
+
+def manifest_reference(manifest_key):
+  """What a file's 'path' metadata holds when its path is in a manifest."""
+  return PATH_MANIFEST_PREFIX + manifest_key
+
+
+def parse_path_reference(reference):
+  """
+  Returns:
+    The blob key of the manifest that reference points to, or None if it
+    points to a path blob of its own.
+  """
+  if reference.startswith(PATH_MANIFEST_PREFIX):
+    return reference[len(PATH_MANIFEST_PREFIX):]
+  return None
+
+
+def build_manifest(paths):
+  """
+  Args:
+    paths: Dict of path hash to path.
+
+  Returns:
+    The cleartext manifest.
+  """
+  return json.dumps({'version': _MANIFEST_VERSION, 'paths': paths},
+                    sort_keys=True)
+
+
+def lookup_manifest(manifest, hash_of_file_path):
+  """Finds a path in a decrypted manifest.
+
+  Returns:
+    The path, or None if the manifest does not have it.
+  """
+  return json.loads(manifest)['paths'].get(hash_of_file_path)
+
+
+class PathPublisher(object):
+  def __init__(self, gpg, blob_store, published_callback, failure_callback,
+               flush_count=_FLUSH_COUNT,
+               flush_interval=_FLUSH_INTERVAL_SECONDS):
+    """
+    Args:
+      published_callback: Called with each job and its path reference once
+        the manifest holding its path is stored.
+      failure_callback: Called with each job and the error if its manifest
+        could not be encrypted or stored.
+    """
+    self.gpg = gpg
+    self.blob_store = blob_store
+    self.published_callback = published_callback
+    self.failure_callback = failure_callback
+    self._buffer = EventBuffer(self._publish, flush_count, flush_interval)
+
+
+  def start(self):
+    self._buffer.start()
+
+
+  def put(self, job):
+    """Queues job's path (job.crypto.file_path) for the next manifest."""
+    self._buffer.put(job)
+
+
+  def flush(self):
+    return self._buffer.flush()
+
+
+  def stop(self):
+    self._buffer.stop()
+
+
+  def join(self):
+    self._buffer.join()
+
+
+  def _publish(self, jobs):
+    # Recipients -> jobs whose paths they may read.
+    batches = dict()
+    for job in jobs:
+      batches.setdefault(tuple(job.crypto.recipients), list()).append(job)
+    for recipients, batch in batches.items():
+      try:
+        reference = self._store_manifest(list(recipients), batch)
+      except Exception, e:
+        logging.exception('Publishing %d path(s) failed: %s' % (len(batch), e))
+        for job in batch:
+          self._fail(job, e)
+        continue
+      for job in batch:
+        self._call_back(job, reference)
+
+
+  def _call_back(self, job, reference):
+    """Hands job on; a job that cannot be handed on is failed, so that every
+    job in a batch gets one callback and none is left leased. The buffer
+    retries whole batches, so nothing is raised from here."""
+    try:
+      self.published_callback(job, reference)
+    except Exception, e:
+      logging.exception('Passing on (%s) after publishing its path failed: '
+                        '%s' % (job, e))
+      self._fail(job, e)
+
+
+  def _fail(self, job, error):
+    try:
+      self.failure_callback(job, error)
+    except Exception, e:
+      logging.exception('Failing (%s) failed: %s' % (job, e))
+
+
+  def _store_manifest(self, recipients, jobs):
+    manifest = build_manifest(dict((job.crypto.hash_of_file_path,
+                                    job.crypto.file_path) for job in jobs))
+    encrypted = self.gpg.encrypt(manifest, recipients, always_trust=True,
+                                 armor=False)
+    if not encrypted:
+      raise ValueError('Could not encrypt the path manifest: %s.' %
+                       encrypted.status)
+    manifest_key = hash_string(encrypted.data)
+    logging.info('Path manifest (%s) for %d path(s).' %
+                 (manifest_key, len(jobs)))
+    self.blob_store.put_string(manifest_key, b2a_base64(encrypted.data))
+    return manifest_reference(manifest_key)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import json
 import os
 import logging
 import threading
@@ -9,15 +10,31 @@ import file_change_status
 import watchdog.events
 from watchdog.observers import Observer
 from watchdog.events import LoggingEventHandler
-from file_change_status import FileChangeStatus
-from local_file_shepherd import LocalFileShepherd, SHEPHERD_STATE_READY, \
-    SHEPHERD_STATE_ASSIGNED, SHEPHERD_STATE_ENCRYPTING, \
-    SHEPHERD_STATE_UPLOADING, SHEPHERD_STATE_SHUTDOWN
+from compression import COMPRESSION_OFF
+from constants import IDLE_WINDOW
+from event_buffer import EventBuffer
+from hash_cache import HashCache
+from hybrid_crypto import BULK_CIPHER_GPG
+from file_change_status import FileChangeStatus, coalesce_event_types, \
+    STATUS_PREPARE, STATUS_CANCELED, STATUS_FAILED, STATUS_COMPLETED
+from local_file_shepherd import LocalFileShepherd, ShepherdJob, \
+    ShepherdPipeline, SHEPHERD_STATE_READY, SHEPHERD_STATE_ASSIGNED, \
+    SHEPHERD_STATE_ENCRYPTING, SHEPHERD_STATE_UPLOADING, \
+    SHEPHERD_STATE_SHUTDOWN
 from master_db_connection import MasterDBConnection
+from scheduling import FairSharePolicy, QueuedRow, ShortestJobFirstPolicy
+from supervisor import PoolSupervisor
 from util import enum
 
 
 _DEFAULT_DATABASE_NAME = 'mediator.db'
+# Upper bound on how long the dispatcher sleeps without being signaled. Only
+# matters for rows that show up without an enqueue() (e.g., left over from a
+# previous run).
+_DISPATCH_TIMEOUT_SECONDS = 5
+# Oldest and smallest rows each considered per dispatch, at least. The policy
+# only ever sees this window, so a deep backlog does not slow dispatch down.
+_DISPATCH_CANDIDATES = 64
 _DEFAULT_DATABASE_DIRECTORY = os.path.join(os.path.expanduser('~'),
                                           '.lockbox')
 if not os.path.exists(_DEFAULT_DATABASE_DIRECTORY):
@@ -27,7 +44,40 @@ if not os.path.exists(_DEFAULT_DATABASE_DIRECTORY):
 class RemoteLocalMediator(threading.Thread):
   def __init__(self, gpg, blob_store, metadata_store,
                database_directory = _DEFAULT_DATABASE_DIRECTORY,
-               database_name = _DEFAULT_DATABASE_NAME):
+               database_name = _DEFAULT_DATABASE_NAME,
+               settle_window = IDLE_WINDOW,
+               pool_sizes = None,
+               pool_bounds = None,
+               scheduling_policy = None,
+               bulk_cipher = BULK_CIPHER_GPG,
+               batch_paths = False,
+               compression = COMPRESSION_OFF,
+               staging = None,
+               keyring = None):
+    """
+    Args:
+      settle_window: Seconds a path must go without new events before its
+        queued event is handed to a shepherd. Bursts of events on the same
+        path within the window are coalesced into a single row.
+      pool_sizes: Optional dict of pipeline stage name to number of workers,
+        overriding local_file_shepherd.DEFAULT_POOL_SIZES. These are only
+        starting points; the supervisor resizes the pools as it goes.
+      pool_bounds: Optional dict of pool name ('shepherd' or a stage name) to
+        (min, max) workers, overriding supervisor.DEFAULT_POOL_BOUNDS.
+      scheduling_policy: scheduling.SchedulingPolicy that orders prepared rows
+        for dispatch. Defaults to shortest job first, with aging, shared
+        fairly between the watched directories.
+      bulk_cipher: How new blobs are encrypted; see hybrid_crypto.
+      batch_paths: Whether new files' paths are published in batched
+        manifests (see path_manifest) instead of one blob each.
+      compression: Whether blobs are compressed before encryption; see
+        compression.
+      staging: staging.StagingArea that holds jobs' temporary files, limits
+        how much they may stage and is swept of orphans on startup. Without
+        one, temporary files go to the system's temporary directory.
+      keyring: keyring_index.KeyringIndex that shepherds resolve recipients
+        with.
+    """
     threading.Thread.__init__(self)
     self.gpg = gpg
     self.blob_store = blob_store
@@ -36,11 +86,32 @@ class RemoteLocalMediator(threading.Thread):
     self.database_name = database_name
     self.database_path = os.path.join(self.database_directory,
                                       self.database_name)
+    self.settle_window = settle_window
+    self.bulk_cipher = bulk_cipher
+    self.compression = compression
+    self.staging = staging
+    self.keyring = keyring
+    self.scheduling_policy = scheduling_policy or FairSharePolicy(
+      ShortestJobFirstPolicy(), group_key=self._share_group)
 
     self._stop = threading.Event()
+    # Set by enqueue() and by shepherds finishing so that run() only wakes up
+    # when there may be new work to hand out. Starts set so that the first pass
+    # picks up anything already sitting in the queue.
+    self._work_available = threading.Event()
+    self._work_available.set()
+    # enqueue() only appends to this buffer; its thread writes events to the
+    # queue table in batched transactions.
+    self._event_buffer = EventBuffer(self._write_events)
+    # What each file looked like when it was last synced; lets shepherds drop
+    # events that did not change a file's bytes.
+    self.hash_cache = HashCache(self.database_path)
     self.shepherds = list()
     self.num_shepherds = 2
-    self.file_to_shepherd = dict()
+    self.pipeline = ShepherdPipeline(self, gpg, blob_store, metadata_store,
+                                     pool_sizes, batch_paths=batch_paths,
+                                     staging=staging)
+    self.supervisor = PoolSupervisor(self, pool_bounds)
     self.observer = None
 
     # Directory to watchdog.observers.ObservedWatch object.
@@ -49,18 +120,54 @@ class RemoteLocalMediator(threading.Thread):
 
 
   def _initialize_queue(self):
+    """Creates the queue, leases and checkpoints tables.
+
+    queue holds one row per (coalesced) event, along with the size of its file
+    for the scheduling policy. leases holds one row per file
+    currently handed to a shepherd so that no two shepherds work on the same
+    path at once; it is keyed by src_path, so the dispatcher can skip in-flight
+    files with an index lookup instead of a per-file predicate. Leases only
+    mean something to a running mediator and are dropped at start up.
+    checkpoints holds the last completed pipeline stage of each in-flight row
+    and the job's outputs so far (JSON), so _resume() can continue from there.
+    """
     logging.info('Initializing the queue table.')
     try:
       with MasterDBConnection(self.database_path) as cursor:
         cursor.execute(
-          'CREATE TABLE queue('
+          'CREATE TABLE IF NOT EXISTS queue('
           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
           'timestamp float, '
           'state text, '
           'event_type text, '
           'src_path text, '
-          'dest_path text'
+          'dest_path text, '
+          'size integer DEFAULT 0'
           ')')
+        columns = [column[1] for column in
+                   cursor.execute('PRAGMA table_info(queue)')]
+        if 'size' not in columns:
+          cursor.execute('ALTER TABLE queue ADD COLUMN size integer DEFAULT 0')
+        cursor.execute('CREATE INDEX IF NOT EXISTS queue_state_timestamp '
+                       'ON queue(state, timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS queue_state_size '
+                       'ON queue(state, size)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS queue_src_path '
+                       'ON queue(src_path, state)')
+        cursor.execute(
+          'CREATE TABLE IF NOT EXISTS leases('
+          'src_path text PRIMARY KEY, '
+          'queue_id integer, '
+          'shepherd integer, '
+          'leased_at float'
+          ')')
+        cursor.execute(
+          'CREATE TABLE IF NOT EXISTS checkpoints('
+          'queue_id integer PRIMARY KEY, '
+          'stage text, '
+          'outputs text'
+          ')')
+        cursor.execute('DELETE FROM leases')
     except sqlite3.OperationalError, e:
       logging.info('SQLite error (%s).' % e)
 
@@ -94,32 +201,144 @@ class RemoteLocalMediator(threading.Thread):
     """Spawns the threads and puts them in a simple list that will act as our
     ThreadPool."""
     logging.info('Preparing shepherds.')
-    self.shepherds = [
-      LocalFileShepherd(self, self.gpg, self.blob_store, self.metadata_store)
-      for shepherd_num in range(self.num_shepherds)]
+    self.pipeline.start()
+    self.shepherds = list()
+    self.add_shepherds(self.num_shepherds)
+
+
+  def _new_shepherd(self):
+    shepherd = LocalFileShepherd(self, self.pipeline, self.gpg,
+                                 self.metadata_store)
+    shepherd.start()
+    return shepherd
+
+
+  def add_shepherds(self, count=1):
+    # Rebind rather than append; the dispatcher may be iterating the list.
+    self.shepherds = self.shepherds + [self._new_shepherd()
+                                       for _ in range(count)]
+    self.num_shepherds = len(self.shepherds)
+    self.wake()
+
+
+  def retire_shepherd(self):
+    """Shuts down one idle shepherd, keeping at least one.
+
+    Returns:
+      True if a shepherd was retired.
+    """
+    if len(self.shepherds) <= 1:
+      return False
     for shepherd in self.shepherds:
-      shepherd.start()
+      if shepherd.retire():
+        self.shepherds = [other for other in self.shepherds
+                          if other is not shepherd]
+        self.num_shepherds = len(self.shepherds)
+        return True
+    return False
+
+
+  def heal_shepherds(self):
+    """Replaces shepherds that died and requeues the rows they held.
+
+    Returns:
+      Number of shepherds replaced.
+    """
+    dead = [shepherd for shepherd in self.shepherds
+            if not shepherd.is_alive() and
+            shepherd.get_state() != SHEPHERD_STATE_SHUTDOWN]
+    if not dead:
+      return 0
+
+    for shepherd in dead:
+      logging.error('Shepherd %s died; replacing it.' % shepherd.name)
+      claimed = shepherd.claimed()
+      if claimed:
+        self.requeue(*claimed)
+    self.shepherds = [shepherd for shepherd in self.shepherds
+                      if shepherd not in dead]
+    self.add_shepherds(len(dead))
+    return len(dead)
 
 
   def enqueue(self, event):
-    # status = FileChangeStatus(time.time(), event)
-    logging.info('thread id: %s' % threading.current_thread())
-    dest_path = ''
-    if event.event_type == watchdog.events.EVENT_TYPE_MOVED:
-      dest_path = event.dest_path
+    """Buffers the event for the next group commit. Once written, it is folded
+    into a still pending event for the same path when possible (see
+    file_change_status.coalesce_event_types). Each fold restarts the path's
+    settle window."""
+    self._event_buffer.put((time.time(), event))
+    return True
+
+
+  def flush(self):
+    """Writes buffered events to the queue table on the calling thread."""
+    return self._event_buffer.flush()
+
 
+  @staticmethod
+  def _event_size(event):
+    """Bytes the event's file currently takes up, or 0 if it is gone."""
+    path = event.src_path
+    if event.event_type == watchdog.events.EVENT_TYPE_MOVED:
+      path = event.dest_path
     try:
-      with MasterDBConnection(self.database_path) as cursor:
+      return os.path.getsize(path)
+    except OSError:
+      return 0
+
+
+  def _write_events(self, timestamped_events):
+    with MasterDBConnection(self.database_path) as cursor:
+      for timestamp, event in timestamped_events:
+        size = self._event_size(event)
+        if self._coalesce(cursor, timestamp, event, size):
+          continue
+
+        dest_path = ''
+        if event.event_type == watchdog.events.EVENT_TYPE_MOVED:
+          dest_path = event.dest_path
         cursor.execute('INSERT INTO queue('
-                       'timestamp, state, event_type, src_path, dest_path) '
-                       'VALUES (?, ?, ?, ?, ?)',
-                       (time.time(), 'prepare', event.event_type,
-                        event.src_path, dest_path))
-      return True
-    except Exception, e:
-      logging.error('Enqueue error: %s' % e)
+                       'timestamp, state, event_type, src_path, dest_path, '
+                       'size) VALUES (?, ?, ?, ?, ?, ?)',
+                       (timestamp, 'prepare', event.event_type,
+                        event.src_path, dest_path, size))
+    logging.debug('Wrote %d event(s) to the queue.' % len(timestamped_events))
+    self._work_available.set()
+
+
+  def _coalesce(self, cursor, timestamp, event, size):
+    """Merges event into the newest prepared row for its path.
+
+    Returns:
+      True if the event was absorbed and no new row is needed.
+    """
+    row = cursor.execute('SELECT rowid, event_type FROM queue '
+                         'WHERE src_path == ? AND state == "prepare" '
+                         'ORDER BY rowid DESC LIMIT 1',
+                         (event.src_path,)).fetchone()
+    if not row:
       return False
 
+    rowid, pending_event_type = row
+    event_type = coalesce_event_types(pending_event_type, event.event_type)
+    if event_type is False:
+      return False
+
+    # The state check guards against the dispatcher claiming the row since we
+    # looked at it.
+    if event_type is None:
+      logging.debug('Dropping (%s): created and deleted while pending.' %
+                    event.src_path)
+      cursor.execute('DELETE FROM queue WHERE rowid == ? AND '
+                     'state == "prepare"', (rowid,))
+    else:
+      logging.debug('Coalescing %s into pending %s for (%s).' %
+                    (event.event_type, pending_event_type, event.src_path))
+      cursor.execute('UPDATE queue SET event_type = ?, timestamp = ?, '
+                     'size = ? WHERE rowid == ? AND state == "prepare"',
+                     (event_type, timestamp, size, rowid))
+    return cursor.rowcount == 1
+
 
   def _list_queue(self):
     with MasterDBConnection(self.database_path) as cursor:
@@ -128,79 +347,253 @@ class RemoteLocalMediator(threading.Thread):
     return results
 
 
+  def _list_leases(self):
+    with MasterDBConnection(self.database_path) as cursor:
+      rows = cursor.execute('SELECT * FROM leases')
+      results = rows.fetchall()
+    return results
+
+
   def update(self, status_id, state):
     logging.info('Updating row %(status_id)d with %(state)s.' % locals())
     with MasterDBConnection(self.database_path) as cursor:
-      cursor.execute('UPDATE queue SET state = "%s" WHERE rowid = %d' %
+      cursor.execute('UPDATE queue SET state = ? WHERE rowid = ?',
                      (state, status_id))
 
 
-  def done(self, src_path, ident):
-    assert self.file_to_shepherd[src_path] == ident
-    del self.file_to_shepherd[src_path]
+  def done(self, src_path, status_id):
+    """Releases the lease that queue row status_id holds on src_path and
+    forgets its checkpoint."""
+    with MasterDBConnection(self.database_path) as cursor:
+      cursor.execute('DELETE FROM leases WHERE src_path = ? AND queue_id = ?',
+                     (src_path, status_id))
+      assert cursor.rowcount == 1
+      cursor.execute('DELETE FROM checkpoints WHERE queue_id = ?',
+                     (status_id,))
+    self.wake()
+
+
+  def checkpoint(self, status_id, stage, outputs):
+    """Records that row status_id has completed stage with outputs."""
+    with MasterDBConnection(self.database_path) as cursor:
+      cursor.execute('INSERT OR REPLACE INTO checkpoints(queue_id, stage, '
+                     'outputs) VALUES (?, ?, ?)',
+                     (status_id, stage, json.dumps(outputs)))
+
+
+  def _resume(self):
+    """Picks up rows that a previous run claimed but did not finish. Rows
+    with a usable checkpoint continue after their last completed stage; the
+    rest go back to prepare. Staged files that no resumed row needs are
+    removed first, before resumed jobs can stage new ones.
+
+    Returns:
+      Number of rows resumed from a checkpoint.
+    """
+    with MasterDBConnection(self.database_path) as cursor:
+      rows = cursor.execute(
+        'SELECT queue.rowid, timestamp, event_type, src_path, dest_path, '
+        'stage, outputs FROM queue LEFT JOIN checkpoints '
+        'ON checkpoints.queue_id = queue.rowid '
+        'WHERE state NOT IN (?, ?, ?, ?)',
+        (STATUS_PREPARE, STATUS_COMPLETED, STATUS_FAILED,
+         STATUS_CANCELED)).fetchall()
+
+    resumed = list()
+    for rowid, timestamp, event_type, src_path, dest_path, stage, outputs \
+          in rows:
+      job = None
+      if stage:
+        job = ShepherdJob.restore(self.gpg, rowid, timestamp, event_type,
+                                  src_path, dest_path, json.loads(outputs))
+      if not job:
+        logging.info('Restarting row %d (%s) from scratch.' %
+                     (rowid, src_path))
+        with MasterDBConnection(self.database_path) as cursor:
+          cursor.execute('UPDATE queue SET state = ? WHERE rowid = ?',
+                         (STATUS_PREPARE, rowid))
+          cursor.execute('DELETE FROM checkpoints WHERE queue_id = ?',
+                         (rowid,))
+        continue
+
+      with MasterDBConnection(self.database_path) as cursor:
+        cursor.execute('INSERT INTO leases(src_path, queue_id, shepherd, '
+                       'leased_at) VALUES (?, ?, NULL, ?)',
+                       (src_path, rowid, time.time()))
+      resumed.append((job, stage))
+
+    if self.staging:
+      self.staging.sweep(keep=[path for job, _ in resumed
+                               for path in job.crypto.temp_files()])
+    for job, stage in resumed:
+      self.pipeline.resume(job, stage)
+    return len(resumed)
+
+
+  def requeue(self, status_id, src_path):
+    """Returns a claimed row to the queue, e.g., after its worker died."""
+    logging.warning('Requeueing row %d (%s).' % (status_id, src_path))
+    with MasterDBConnection(self.database_path) as cursor:
+      cursor.execute('UPDATE queue SET state = "prepare" WHERE rowid = ?',
+                     (status_id,))
+      cursor.execute('DELETE FROM leases WHERE src_path = ? AND queue_id = ?',
+                     (src_path, status_id))
+      cursor.execute('DELETE FROM checkpoints WHERE queue_id = ?',
+                     (status_id,))
+    self.wake()
+
+
+  def backlog(self):
+    """Number of rows waiting to be claimed."""
+    with MasterDBConnection(self.database_path) as cursor:
+      return cursor.execute('SELECT COUNT(*) FROM queue '
+                            'WHERE state == "prepare"').fetchone()[0]
+
+
+  def wake(self):
+    """Tells the dispatcher that there may be rows to claim or shepherds to
+    hand them to."""
+    self._work_available.set()
 
 
   def stop(self):
     self._stop.set()
+    self._work_available.set()
+
+
+  def _ready_shepherds(self):
+    return [shepherd for shepherd in self.shepherds
+            if SHEPHERD_STATE_READY == shepherd.get_state()]
+
+
+  def _share_group(self, src_path):
+    """The watched directory that src_path is under, for fair sharing."""
+    for directory in sorted(self.directories, key=len, reverse=True):
+      if src_path.startswith(os.path.join(directory, '')):
+        return directory
+    return os.path.dirname(src_path)
+
+
+  def _candidates(self, cursor, limit):
+    """Settled, prepared rows for files that are not in flight: the oldest and
+    the smallest limit of each, read off queue_state_timestamp and
+    queue_state_size.
+
+    Only each file's oldest prepared row is a candidate: a file's rows must
+    run in order (e.g., its created row before a later modified one), so the
+    policy may only reorder rows of different files.
+
+    Returns:
+      List of QueuedRow.
+    """
+    settled_before = time.time() - self.settle_window
+    candidates = dict()
+    # Left to itself, SQLite serves both orders from the timestamp range and
+    # sorts the whole backlog by size.
+    for index, order_by in [('queue_state_timestamp', 'timestamp'),
+                            ('queue_state_size', 'size')]:
+      rows = cursor.execute(
+        'SELECT rowid, timestamp, state, event_type, src_path, dest_path, size '
+        'FROM queue INDEXED BY %s '
+        'WHERE state == "prepare" AND timestamp <= ? '
+        'AND src_path NOT IN (SELECT src_path FROM leases) '
+        'AND rowid == (SELECT MIN(rowid) FROM queue AS q '
+        '              WHERE q.src_path == queue.src_path '
+        '              AND q.state == "prepare") '
+        'ORDER BY %s LIMIT ?' % (index, order_by), (settled_before, limit))
+      for row in rows:
+        candidates[row[0]] = QueuedRow(*row)
+    return candidates.values()
+
+
+  def _dispatch(self):
+    """Claims up to one prepared row per ready shepherd in a single transaction
+    and hands them out, in the order the scheduling policy puts them.
+
+    Returns:
+      Number of rows assigned to shepherds.
+    """
+    ready_shepherds = self._ready_shepherds()
+    if not ready_shepherds:
+      return 0
 
-
-  def _wip_files(self):
-    """Work in Progress files."""
-    files = self.file_to_shepherd.keys()
-    query = ''
-    for filename in files:
-      query += ' AND src_path != "%s"' % filename
-    logging.debug('WIP query: (%s).' % query)
-    return query
+    with MasterDBConnection(self.database_path) as cursor:
+      candidates = self._candidates(
+        cursor, max(_DISPATCH_CANDIDATES, 2 * len(ready_shepherds)))
+      in_flight_paths = [row[0] for row in
+                         cursor.execute('SELECT src_path FROM leases')]
+      ordered = self.scheduling_policy.order(candidates, time.time(),
+                                             in_flight_paths)
+
+      # Candidates hold one row per file, so the rows can go straight out.
+      assignments = zip(ready_shepherds, ordered)
+
+      now = time.time()
+      cursor.executemany('INSERT INTO leases(src_path, queue_id, shepherd, '
+                         'leased_at) VALUES (?, ?, ?, ?)',
+                         [(row.src_path, row.rowid, shepherd.ident, now)
+                          for shepherd, row in assignments])
+      cursor.executemany('UPDATE queue SET state = "assigned" '
+                         'WHERE rowid == ?',
+                         [(row.rowid,) for _, row in assignments])
+
+    # Only hand out rows once the claim has committed so that the shepherds'
+    # own state updates cannot be overwritten by it.
+    for shepherd, row in assignments:
+      logging.info('assigned row: (%d, %f, %s, %s, %s, %s, %d bytes).' %
+                   (row.rowid, row.timestamp, row.state, row.event_type,
+                    row.src_path, row.dest_path, row.size or 0))
+      if not shepherd.assign(row.rowid, row.timestamp, row.state,
+                             row.event_type, row.src_path, row.dest_path):
+        # Retired since we picked it.
+        self.requeue(row.rowid, row.src_path)
+
+    return len(assignments)
+
+
+  def _dispatch_timeout(self):
+    """Seconds until the next pending row leaves its settle window, capped at
+    _DISPATCH_TIMEOUT_SECONDS."""
+    now = time.time()
+    with MasterDBConnection(self.database_path) as cursor:
+      row = cursor.execute('SELECT MIN(timestamp) FROM queue '
+                           'WHERE state == "prepare" AND timestamp > ?',
+                           (now - self.settle_window,)).fetchone()
+    if not row or row[0] is None:
+      return _DISPATCH_TIMEOUT_SECONDS
+    return min(_DISPATCH_TIMEOUT_SECONDS, row[0] + self.settle_window - now)
 
 
   def run(self):
     self._initialize_queue()
+    self.hash_cache.initialize()
+    self._event_buffer.start()
     self._prepare_shepherds()
+    logging.info('Resumed %d row(s) from checkpoints.' % self._resume())
+    self.supervisor.start()
 
     while not self._stop.is_set():
-      # TODO(tierney): Add a facility that checks if a shepherd has died. If so,
-      # then we should restart a thread so that we can continue make progress.
+      # Clear before dispatching so that a signal raised while we work is not
+      # lost; it simply causes another pass.
+      self._work_available.wait(self._dispatch_timeout())
+      self._work_available.clear()
+      if self._stop.is_set():
+        break
 
-      _wip_files = self._wip_files()
-      with MasterDBConnection(self.database_path) as cursor:
-        query = 'SELECT rowid, timestamp, state, event_type, src_path, ' \
-            'dest_path FROM queue WHERE state == "prepare" %s LIMIT 1' \
-            % (_wip_files)
-        row = cursor.execute(query)
-        result = row.fetchone()
-        if not result:
-          time.sleep(1)
-          continue
+      self._dispatch()
 
-        [rowid, timestamp, state, event_type, src_path, dest_path] = result
-        logging.info('selected row: (%(rowid)d, %(timestamp)f, '
-                     '%(state)s, %(event_type)s, %(src_path)s, '
-                     '%(dest_path)s).' % locals())
-
-        # Assign to a thread.
-        _assigned = False
-        for shepherd in self.shepherds:
-          if SHEPHERD_STATE_READY == shepherd.get_state():
-            shepherd.assign(
-              rowid, timestamp, state, event_type, src_path, dest_path)
-            self.file_to_shepherd[src_path] = shepherd.ident
-            logging.info(self.file_to_shepherd)
-            _assigned = True
-            break
-
-        if not _assigned:
-          logging.info('Unable to assign row. Going to sleep and wait'
-                       'for an available thread.')
-          time.sleep(1)
-          continue
+    # Make sure every event we accepted reaches the queue table.
+    logging.info('Flushing buffered events.')
+    self._event_buffer.stop()
+    self._event_buffer.join()
 
-        cursor.execute('UPDATE queue SET state = "assigned" '
-                       'WHERE rowid == %d' % (rowid))
-        logging.info('updated row: (%(rowid)d, %(timestamp)f, '
-                     '%(state)s, %(event_type)s, %(src_path)s, '
-                     '%(dest_path)s).' % locals())
+    self.supervisor.stop()
+    self.supervisor.join()
 
     logging.info('Shutting down shepherds.')
     for shepherd in self.shepherds:
       shepherd.shutdown()
+    for shepherd in self.shepherds:
+      shepherd.join()
+    logging.info('Draining the pipeline.')
+    self.pipeline.shutdown()
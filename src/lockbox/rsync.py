@@ -97,8 +97,10 @@ def test_patchedfile1():
             print "list?:", len(delt), delt.__sizeof__()
 """
 
+import bisect
 import collections
 import hashlib
+import operator
 
 
 if not(hasattr(__builtins__, "bytes")) or str is bytes:
@@ -110,7 +112,20 @@ if not(hasattr(__builtins__, "bytes")) or str is bytes:
             return map(ord, var)
 
 __all__ = ["rollingchecksum", "weakchecksum", "patchstream", "rsyncdelta",
-    "blockchecksums"]
+    "blockchecksums", "signatureindex"]
+
+
+def signatureindex(remotesignatures):
+    """
+    Indexes the weak and strong hashes from blockchecksums() as
+    {weak: {strong: [block ids]}}, so that a window is checked against
+    every block sharing its weak checksum without scanning the lists.
+    Each list of block ids is in ascending order.
+    """
+    index = dict()
+    for blockid, (weak, strong) in enumerate(zip(*remotesignatures)):
+        index.setdefault(weak, dict()).setdefault(strong, []).append(blockid)
+    return index
 
 
 def rsyncdelta(datastream, remotesignatures, blocksize=4096):
@@ -120,7 +135,7 @@ def rsyncdelta(datastream, remotesignatures, blocksize=4096):
     up-to-date data. The blocksize must be the same as the value
     used to generate remotesignatures.
     """
-    remote_weak, remote_strong = remotesignatures
+    index = signatureindex(remotesignatures)
 
     match = True
     matchblock = -1
@@ -131,28 +146,41 @@ def rsyncdelta(datastream, remotesignatures, blocksize=4096):
             # Whenever there is a match or the loop is running for the first
             # time, populate the window using weakchecksum instead of rolling
             # through every single byte which takes at least twice as long.
-            window = collections.deque(bytes(datastream.read(blocksize)))
+            block = datastream.read(blocksize)
+            window = collections.deque(bytes(block))
             checksum, a, b = weakchecksum(window)
 
-        try:
-            # If there are two identical weak checksums in a file, and the
-            # matching strong hash does not occur at the first match, it will
-            # be missed and the data sent over. May fix eventually, but this
-            # problem arises very rarely.
-            matchblock = remote_weak.index(checksum, matchblock + 1)
-            stronghash = hashlib.md5(bytes(window)).hexdigest()
-            matchblock = remote_strong.index(stronghash, matchblock)
+        # Every block whose weak checksum matches is a candidate, so a block
+        # sharing its weak checksum with an earlier one is still found.
+        blockids = None
+        strongblocks = index.get(checksum)
+        if strongblocks is not None:
+            if block is None:
+                block = bytes(window)
+            blockids = strongblocks.get(hashlib.md5(block).hexdigest())
+
+        if blockids:
+            # Prefer the block after the last match, so that repeated blocks
+            # are referenced in order. A zero-filled file has every block in
+            # one list, so it is bisected rather than scanned.
+            nextblock = bisect.bisect_left(blockids, matchblock + 1)
+            if nextblock < len(blockids) and \
+                    blockids[nextblock] == matchblock + 1:
+                matchblock += 1
+            else:
+                matchblock = blockids[0]
 
             match = True
             deltaqueue.append(matchblock)
 
-            if datastream.closed:
+            # A match after the end of the data takes in the rest of it.
+            if datastream is None or datastream.closed:
                 break
             continue
-
-        except ValueError:
-            # The weakchecksum did not match
+        else:
+            # No block matches the window
             match = False
+            block = None
             try:
                 if datastream:
                     # Get the next byte and affix to the window
@@ -247,10 +275,8 @@ def weakchecksum(data):
     """
     Generates a weak checksum from an iterable set of bytes.
     """
-    a = b = 0
     l = len(data)
-    for i in range(l):
-        a += data[i]
-        b += (l - i)*data[i]
+    a = sum(data)
+    b = sum(map(operator.mul, range(l, 0, -1), data))
 
     return (b << 16) | a, a, b
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Policies that decide which prepared queue rows the mediator dispatches
+first.
+
+The mediator gathers a window of candidate rows (the oldest and the smallest
+settled rows that are not in flight) and asks its policy to order them; the
+first rows for distinct paths go to the ready shepherds.
+
+  FifoPolicy: oldest first, the mediator's original behavior.
+  ShortestJobFirstPolicy: smallest file first, so that a small edit does not
+    wait behind a bulk upload. A row's effective size halves every
+    aging_half_life seconds it waits, so large files still get their turn.
+  FairSharePolicy: round-robins between groups of paths (e.g., watched
+    directories), favoring the group with the fewest rows in flight, and
+    orders rows within a group with another policy.
+
+Usage:
+  policy = FairSharePolicy(ShortestJobFirstPolicy(), group_key=group_of)
+  ordered = policy.order(candidates, time.time(), in_flight_paths)
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import os
+from collections import namedtuple
+
+# A row of the queue table as seen by the dispatcher. size is the source's
+# size in bytes when its latest event was written (0 if it was gone).
+QueuedRow = namedtuple('QueuedRow', ['rowid', 'timestamp', 'state',
+                                     'event_type', 'src_path', 'dest_path',
+                                     'size'])
+
+_DEFAULT_AGING_HALF_LIFE_SECONDS = 60.
+
+
+class SchedulingPolicy(object):
+  def order(self, rows, now, in_flight_paths):
+    """Orders candidate rows, most urgent first.
+
+    Args:
+      rows: List of QueuedRow.
+      now: Current time, to judge how long rows have waited.
+      in_flight_paths: src_paths of the rows currently being worked on.
+
+    Returns:
+      The rows in dispatch order.
+    """
+    raise NotImplementedError
+
+
+class FifoPolicy(SchedulingPolicy):
+  def order(self, rows, now, in_flight_paths):
+    return sorted(rows, key=lambda row: (row.timestamp, row.rowid))
+
+
+class ShortestJobFirstPolicy(SchedulingPolicy):
+  def __init__(self, aging_half_life=_DEFAULT_AGING_HALF_LIFE_SECONDS):
+    """
+    Args:
+      aging_half_life: Seconds of waiting after which a row is treated as half
+        as big. A file 2**n times larger than a fresh one goes first after
+        waiting n half lives. None turns aging off.
+    """
+    self.aging_half_life = aging_half_life
+
+
+  def effective_size(self, row, now):
+    size = max(row.size or 0, 0)
+    if not self.aging_half_life:
+      return size
+    waited = max(now - row.timestamp, 0)
+    return size / 2. ** (waited / self.aging_half_life)
+
+
+  def order(self, rows, now, in_flight_paths):
+    return sorted(rows, key=lambda row: (self.effective_size(row, now),
+                                         row.timestamp, row.rowid))
+
+
+class FairSharePolicy(SchedulingPolicy):
+  def __init__(self, policy=None, group_key=os.path.dirname):
+    """
+    Args:
+      policy: Orders rows within each group. Defaults to
+        ShortestJobFirstPolicy.
+      group_key: Maps a src_path to its group, e.g., the watched directory or
+        sharing group it belongs to. Defaults to the parent directory.
+    """
+    self.policy = policy or ShortestJobFirstPolicy()
+    self.group_key = group_key
+
+
+  def order(self, rows, now, in_flight_paths):
+    # Group -> [(rank, row)], in the inner policy's order.
+    groups = dict()
+    for rank, row in enumerate(self.policy.order(rows, now, in_flight_paths)):
+      groups.setdefault(self.group_key(row.src_path), list()).append(
+        (rank, row))
+
+    shares = dict((group, 0) for group in groups)
+    for src_path in in_flight_paths:
+      group = self.group_key(src_path)
+      if group in shares:
+        shares[group] += 1
+
+    # Each turn goes to the group with the fewest rows in flight or already
+    # picked; ties go to the group whose next row ranks highest.
+    ordered = list()
+    while groups:
+      group = min(groups,
+                  key=lambda group: (shares[group], groups[group][0][0]))
+      rank, row = groups[group].pop(0)
+      ordered.append(row)
+      shares[group] += 1
+      if not groups[group]:
+        del groups[group]
+    return ordered
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Seekable blob format: a file encrypted as independently authenticated
+segments, so any byte range can be fetched and decrypted on its own.
+
+Hybrid blobs (hybrid_crypto) are one CBC stream under one MAC, so reading a
+single byte range, or checking that one part of a large file is intact,
+means downloading and decrypting the whole blob. A seekable blob is laid out
+as
+
+  magic          'LBXS'
+  version        1 byte
+  header_length  4 bytes, big-endian
+  header         gpg-encrypted (binary) version || aes_key || mac_key ||
+                 path
+  segment_size   4 bytes, big-endian
+  header_tag     HMAC-SHA256 with mac_key of everything before it
+  segments       each hybrid_crypto.encrypt_chunk() of segment_size bytes of
+                 cleartext (the last one may be shorter)
+
+A segment is sealed with its own IV and tag, under a context made of the
+header tag, its index and whether it is the last one; segments cannot be
+moved between blobs, reordered, or cut off at the end unnoticed. Every
+segment but the last has the same stored size, so where segment i starts
+follows from the header alone and a range of segments is one ranged read.
+
+Blobs are written in a single pass without knowing the cleartext's size up
+front; the number of segments follows from the stored blob's size.
+
+As in hybrid blobs, the header may carry the file's path (see
+hybrid_crypto.header_reference()); SeekableBlob.path has it.
+
+Usage:
+  with open(path, 'rb') as cleartext, open(blob_path, 'wb') as blob:
+    encrypt_stream(gpg, recipients, cleartext, blob, path=path)
+
+  blob = SeekableBlob(gpg, partial(blob_store.get_range, key),
+                      blob_store.get_size(key))
+  data = blob.read(offset, length)
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import hmac
+import struct
+from collections import namedtuple
+from hashlib import sha256
+import hybrid_crypto
+from exception import EncryptedBlobError
+from hybrid_crypto import BULK_CIPHER_SEEKABLE, DataKey, new_data_key, \
+    encrypt_chunk, decrypt_chunk, wrap_header, unwrap_header
+
+MAGIC = 'LBXS'
+_VERSION = 2
+# Whether each readable version's headers carry a path.
+_READABLE_VERSIONS = {1: False, 2: True}
+_PREAMBLE = struct.Struct('!4sBI')
+_SEGMENT_SIZE = struct.Struct('!I')
+_SEGMENT_CONTEXT = struct.Struct('!IB')
+
+DEFAULT_SEGMENT_SIZE = 1 << 20
+# Size of each of a DataKey's keys.
+_DATA_KEY_SIZE = 32
+_BLOCK_SIZE = 16
+_IV_SIZE = 16
+_TAG_SIZE = sha256().digest_size
+
+# What _open_header() learns from a blob: size is the header's stored size.
+_Header = namedtuple('_Header', ['data_key', 'segment_size', 'tag', 'size',
+                                 'path'])
+
+
+def _check_available():
+  if hybrid_crypto.M2Crypto is None:
+    raise ValueError('The %s bulk cipher needs M2Crypto.' %
+                     BULK_CIPHER_SEEKABLE)
+
+
+def is_seekable(prefix):
+  """Whether a blob starting with prefix (at least len(MAGIC) bytes) is in
+  this format."""
+  return prefix[:len(MAGIC)] == MAGIC
+
+
+def stored_segment_size(length):
+  """Bytes that a segment of length cleartext bytes takes up in a blob."""
+  return _IV_SIZE + (length // _BLOCK_SIZE + 1) * _BLOCK_SIZE + _TAG_SIZE
+
+
+def _segment_context(header_tag, index, last):
+  return header_tag + _SEGMENT_CONTEXT.pack(index, last)
+
+
+def _read_full(infile, size):
+  """Reads size bytes; fewer only at the end of infile."""
+  parts = list()
+  remaining = size
+  while remaining:
+    data = infile.read(remaining)
+    if not data:
+      break
+    parts.append(data)
+    remaining -= len(data)
+  return ''.join(parts)
+
+
+def encrypt_stream(gpg, recipients, infile, outfile, data_key=None,
+                   segment_size=None, path=None):
+  """Encrypts infile, from its current position to the end, into outfile.
+
+  Args:
+    gpg: gnupg.GPG (or another engine) that wraps the key header.
+    recipients: GPG recipients that can decrypt the blob.
+    infile: File-like object to read() cleartext from.
+    outfile: File-like object to write() the blob to.
+    data_key: hybrid_crypto.DataKey to use; a fresh one by default.
+    segment_size: Cleartext bytes per segment, a multiple of 16; defaults to
+      1 MB.
+    path: The file's path, to wrap along with the key.
+
+  Returns:
+    Number of bytes written.
+  """
+  _check_available()
+  segment_size = segment_size or DEFAULT_SEGMENT_SIZE
+  if segment_size % _BLOCK_SIZE:
+    raise ValueError('Segment size must be a multiple of %d.' % _BLOCK_SIZE)
+  data_key = data_key or new_data_key()
+  wrapped = wrap_header(gpg, recipients, _VERSION,
+                        data_key.key + data_key.mac_key, path)
+
+  header = _PREAMBLE.pack(MAGIC, _VERSION, len(wrapped)) + wrapped + \
+      _SEGMENT_SIZE.pack(segment_size)
+  header_tag = hmac.new(data_key.mac_key, header, digestmod=sha256).digest()
+  outfile.write(header + header_tag)
+  num_written = len(header) + _TAG_SIZE
+
+  # Read a segment ahead to know which one is the last.
+  index = 0
+  data = _read_full(infile, segment_size)
+  while True:
+    next_data = ''
+    if len(data) == segment_size:
+      next_data = _read_full(infile, segment_size)
+    last = not next_data
+    sealed = encrypt_chunk(data_key, _segment_context(header_tag, index, last),
+                           data)
+    outfile.write(sealed)
+    num_written += len(sealed)
+    if last:
+      return num_written
+    data = next_data
+    index += 1
+
+
+def _read_exactly(read, size):
+  data = read(size)
+  if len(data) != size:
+    raise EncryptedBlobError('Blob is truncated.')
+  return data
+
+
+def _open_header(gpg, read, passphrase):
+  """Unwraps and authenticates a blob's header.
+
+  Args:
+    read: Returns the next size bytes of the blob.
+  """
+  preamble = _read_exactly(read, _PREAMBLE.size)
+  magic, version, wrapped_length = _PREAMBLE.unpack(preamble)
+  if magic != MAGIC or version not in _READABLE_VERSIONS:
+    raise EncryptedBlobError('Not a version %d seekable blob.' % _VERSION)
+  rest = _read_exactly(read, wrapped_length + _SEGMENT_SIZE.size + _TAG_SIZE)
+  wrapped = rest[:wrapped_length]
+  segment_size, = _SEGMENT_SIZE.unpack(
+    rest[wrapped_length:wrapped_length + _SEGMENT_SIZE.size])
+  header_tag = rest[-_TAG_SIZE:]
+
+  header_version, secrets, path = unwrap_header(
+    gpg, wrapped, _READABLE_VERSIONS, 2 * _DATA_KEY_SIZE, passphrase)
+  if header_version != version:
+    raise EncryptedBlobError('Could not unwrap the key header.')
+  data_key = DataKey(secrets[:_DATA_KEY_SIZE], secrets[_DATA_KEY_SIZE:])
+  if not hmac.compare_digest(
+      hmac.new(data_key.mac_key, preamble + rest[:-_TAG_SIZE],
+               digestmod=sha256).digest(),
+      header_tag):
+    raise EncryptedBlobError('Blob header failed authentication.')
+  if not segment_size or segment_size % _BLOCK_SIZE:
+    raise EncryptedBlobError('Bad segment size (%d).' % segment_size)
+  return _Header(data_key, segment_size, header_tag,
+                 len(preamble) + len(rest), path or None)
+
+
+def decrypt_stream(gpg, infile, outfile, passphrase=None):
+  """Decrypts a whole blob that encrypt_stream() wrote, in order.
+
+  Each segment is authenticated before its cleartext is written, but a blob
+  cut short is only noticed at the end, so callers must discard outfile if
+  this raises.
+
+  Returns:
+    The blob's DataKey.
+
+  Raises:
+    EncryptedBlobError: The blob is not in this format, is truncated, cannot
+      be decrypted with our keys, or fails authentication.
+  """
+  _check_available()
+  header = _open_header(gpg, infile.read, passphrase)
+  full_size = stored_segment_size(header.segment_size)
+  index = 0
+  stored = _read_full(infile, full_size)
+  while True:
+    next_stored = ''
+    if len(stored) == full_size:
+      next_stored = _read_full(infile, full_size)
+    last = not next_stored
+    outfile.write(decrypt_chunk(
+        header.data_key, _segment_context(header.tag, index, last), stored))
+    if last:
+      return header.data_key
+    stored = next_stored
+    index += 1
+
+
+def _open_segment(args):
+  """Decrypts one segment; module-level so that a pool can run it."""
+  data_key, context, stored = args
+  return decrypt_chunk(data_key, context, stored)
+
+
+class SeekableBlob(object):
+  """Reads byte ranges of a stored seekable blob, fetching and authenticating
+  only the segments that hold them."""
+  def __init__(self, gpg, read_range, blob_size, passphrase=None):
+    """
+    Args:
+      read_range: Returns length bytes of the stored blob from offset, given
+        (offset, length); e.g., a ranged GET (BlobStore.get_range()).
+      blob_size: Bytes in the stored blob.
+
+    Raises:
+      EncryptedBlobError: The header is not in this format, cannot be
+        decrypted with our keys, or fails authentication.
+    """
+    _check_available()
+    self.read_range = read_range
+    self.blob_size = blob_size
+    offset = [0]
+    def read(size):
+      data = read_range(offset[0], size)
+      offset[0] += len(data)
+      return data
+    self._header = _open_header(gpg, read, passphrase)
+    # The file's path, if the header carries it.
+    self.path = self._header.path
+    self.segment_size = self._header.segment_size
+    self._stored_segment_size = stored_segment_size(self.segment_size)
+    self.num_segments = max(1, -(-(blob_size - self._header.size) //
+                                 self._stored_segment_size))
+    self._size = None
+
+
+  def _segment_offset(self, index):
+    return self._header.size + index * self._stored_segment_size
+
+
+  def size(self):
+    """Cleartext bytes; the last segment is decrypted the first time."""
+    if self._size is None:
+      last_offset = (self.num_segments - 1) * self.segment_size
+      self._size = last_offset + len(self.read(last_offset,
+                                               self.segment_size))
+    return self._size
+
+
+  def read(self, offset, length, pool=None):
+    """Returns up to length bytes of cleartext from offset (fewer past the
+    end). The segments holding them are fetched in one ranged read.
+
+    Args:
+      pool: multiprocessing.Pool to decrypt the segments on in parallel; they
+        are decrypted in this thread if None.
+
+    Raises:
+      EncryptedBlobError: A segment is truncated or fails authentication.
+    """
+    if offset < 0 or length < 0:
+      raise ValueError('Bad range (%d, %d).' % (offset, length))
+    first = offset // self.segment_size
+    if not length or first >= self.num_segments:
+      return ''
+    last = min(self.num_segments - 1,
+               (offset + length - 1) // self.segment_size)
+    start = self._segment_offset(first)
+    end = min(self.blob_size, self._segment_offset(last + 1))
+    stored = self.read_range(start, end - start)
+    if len(stored) != end - start:
+      raise EncryptedBlobError('Blob is truncated.')
+
+    segments = list()
+    for index in range(first, last + 1):
+      begin = (index - first) * self._stored_segment_size
+      context = _segment_context(self._header.tag, index,
+                                 index == self.num_segments - 1)
+      segments.append((self._header.data_key, context,
+                       stored[begin:begin + self._stored_segment_size]))
+    if pool:
+      cleartext = ''.join(pool.map(_open_segment, segments))
+    else:
+      cleartext = ''.join(map(_open_segment, segments))
+    skip = offset - first * self.segment_size
+    return cleartext[skip:skip + length]
+
+
+  def verify_segment(self, index):
+    """Fetches and authenticates segment index alone.
+
+    Raises:
+      EncryptedBlobError: It is truncated or fails authentication.
+    """
+    if not 0 <= index < self.num_segments:
+      raise ValueError('No segment %d of %d.' % (index, self.num_segments))
+    self.read(index * self.segment_size, self.segment_size)
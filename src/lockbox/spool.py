@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Write-once, read-back buffer for encrypted blobs and deltas.
+
+Most synced files are small documents, and for them writing the ciphertext to
+a temporary file, reopening it to upload it and removing it afterwards costs
+more than encrypting it. A Spool keeps what is written in memory until it
+grows past max_in_memory bytes, then moves it to a named temporary file and
+keeps writing there, so large outputs never sit in memory.
+
+In-memory spools do not survive a restart, so a checkpointed job that had one
+starts over.
+
+Usage:
+  spool = Spool()
+  spool.write(data)
+  spool.close()
+
+  if spool.in_memory():
+    blob_store.put_string(key, spool.getvalue())
+  else:
+    blob_store.put_filename(key, spool.path)
+  spool.discard()
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import os
+from io import BytesIO
+from staging import new_file
+
+_MAX_IN_MEMORY = 2 << 20
+
+
+class Spool(object):
+  def __init__(self, max_in_memory=None, directory=None):
+    """
+    Args:
+      max_in_memory: Bytes kept in memory before moving to a temporary file;
+        defaults to 2 MB.
+      directory: Where the temporary file goes; see staging.new_file().
+    """
+    self.max_in_memory = max_in_memory or _MAX_IN_MEMORY
+    self.directory = directory
+    # Path of the temporary file, once the spool has one.
+    self.path = ''
+    self.size = 0
+    self._buffer = BytesIO()
+    self._file = None
+
+
+  @staticmethod
+  def from_path(path):
+    """A closed spool for a temporary file written earlier, e.g., before a
+    restart."""
+    spool = Spool()
+    spool.path = path
+    spool.size = os.path.getsize(path) if os.path.exists(path) else 0
+    spool._buffer = None
+    return spool
+
+
+  def write(self, data):
+    self.size += len(data)
+    if self._buffer is not None and self.size > self.max_in_memory:
+      self._file = new_file(self.directory)
+      self.path = self._file.name
+      self._file.write(self._buffer.getvalue())
+      self._buffer = None
+    (self._file or self._buffer).write(data)
+
+
+  def close(self):
+    if self._file:
+      self._file.close()
+      self._file = None
+
+
+  def in_memory(self):
+    return self._buffer is not None
+
+
+  def getvalue(self):
+    if self.in_memory():
+      return self._buffer.getvalue()
+    with open(self.path, 'rb') as spool_file:
+      return spool_file.read()
+
+
+  def head(self, size):
+    """Up to the first size bytes."""
+    if self.in_memory():
+      return self._buffer.getvalue()[:size]
+    with open(self.path, 'rb') as spool_file:
+      return spool_file.read(size)
+
+
+  def open(self):
+    """A file-like object to read the contents from the start."""
+    if self.in_memory():
+      return BytesIO(self._buffer.getvalue())
+    return open(self.path, 'rb')
+
+
+  def discard(self):
+    """Frees the buffer or removes the temporary file."""
+    self.close()
+    self._buffer = None
+    if self.path and os.path.exists(self.path):
+      os.remove(self.path)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""A pool of worker threads fed from a bounded queue.
+
+Stages are chained: a job that one stage's work function finishes with is put
+on the next stage's queue. Because the queues are bounded, a stage that falls
+behind makes the stage before it block instead of letting jobs (and their temp
+files) pile up in memory, while each stage keeps as many of its own workers
+busy as it has work for.
+
+Usage:
+  upload = Stage('upload', upload_work, num_workers=4, queue_size=8)
+  encrypt = Stage('encrypt', encrypt_work, num_workers=2, queue_size=4,
+                  next_stage=upload, failure_callback=failed)
+  upload.start()
+  encrypt.start()
+
+  encrypt.put(job)
+
+  encrypt.shutdown()
+  upload.shutdown()
+
+A work function returns True to pass the job on and False if the job is done
+(e.g., nothing to upload). Exceptions are logged and handed to
+failure_callback along with the job.
+
+The pool can be resized while running (grow() and shrink()), and heal()
+replaces workers that died, returning the jobs they were holding.
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import logging
+import threading
+from Queue import Queue, Full
+from master_db_connection import close_pooled_connections
+
+# Put on a stage's queue once per worker to make the workers exit.
+_SHUTDOWN = object()
+
+
+class StageWorker(threading.Thread):
+  def __init__(self, stage):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.stage = stage
+    self.name = '%s-%s' % (stage.name, self.name)
+    # The job this worker is responsible for, if any.
+    self.job = None
+    # Set when the worker exits because it was asked to.
+    self.retired = False
+
+
+  def run(self):
+    try:
+      while True:
+        job = self.stage.queue.get()
+        if job is _SHUTDOWN:
+          break
+
+        self.job = job
+        try:
+          carry_on = self.stage.work(job)
+        except Exception, e:
+          logging.exception('Stage %s failed on (%s): %s' %
+                            (self.stage.name, job, e))
+          if self.stage.failure_callback:
+            self.stage.failure_callback(job, e)
+          self.job = None
+          continue
+
+        if carry_on and self.stage.next_stage:
+          self.stage.next_stage.put(job)
+        self.job = None
+    finally:
+      # The work may have used pooled database connections on this thread.
+      close_pooled_connections()
+    self.retired = True
+    logging.info('%s shutting down.' % self.name)
+
+
+class Stage(object):
+  def __init__(self, name, work, num_workers, queue_size, next_stage=None,
+               failure_callback=None):
+    self.name = name
+    self.work = work
+    self.num_workers = num_workers
+    self.next_stage = next_stage
+    self.failure_callback = failure_callback
+    self.queue = Queue(maxsize=queue_size)
+    self.workers = list()
+
+
+  def start(self):
+    self.workers = list()
+    num_workers, self.num_workers = self.num_workers, 0
+    self.grow(num_workers)
+
+
+  def put(self, job):
+    """Blocks while the stage's queue is full."""
+    self.queue.put(job)
+
+
+  def depth(self):
+    return self.queue.qsize()
+
+
+  def full(self):
+    return self.queue.full()
+
+
+  def size(self):
+    """Number of workers, not counting ones that have been asked to exit."""
+    return self.num_workers
+
+
+  def busy(self):
+    return len([worker for worker in self.workers if worker.job is not None])
+
+
+  def grow(self, count=1):
+    new_workers = [StageWorker(self) for _ in range(count)]
+    for worker in new_workers:
+      worker.start()
+    self.workers = self.workers + new_workers
+    self.num_workers += count
+
+
+  def shrink(self, count=1):
+    """Asks up to count workers to exit once they are free. Does nothing while
+    the queue is full, since then the workers are clearly needed."""
+    asked = 0
+    for _ in range(min(count, self.num_workers - 1)):
+      try:
+        self.queue.put_nowait(_SHUTDOWN)
+      except Full:
+        break
+      asked += 1
+    self.num_workers -= asked
+    return asked
+
+
+  def heal(self):
+    """Drops retired workers and replaces the ones that died.
+
+    Returns:
+      Jobs that the dead workers were holding.
+    """
+    orphaned_jobs = list()
+    live_workers = list()
+    dead = 0
+    for worker in self.workers:
+      if worker.is_alive():
+        live_workers.append(worker)
+      elif not worker.retired:
+        logging.error('%s died; replacing it.' % worker.name)
+        dead += 1
+        if worker.job is not None:
+          orphaned_jobs.append(worker.job)
+    self.workers = live_workers
+    if dead:
+      self.num_workers -= dead
+      self.grow(dead)
+    return orphaned_jobs
+
+
+  def shutdown(self):
+    """Lets the workers finish what is already queued, then stops them."""
+    for _ in self.workers:
+      self.queue.put(_SHUTDOWN)
+    for worker in self.workers:
+      worker.join()
+    self.workers = list()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Staging area for the intermediate files that jobs write before uploading.
+
+Encrypted blobs, deltas and chunks that do not fit in memory (see spool) are
+written to temporary files until they are uploaded. Left in the system's
+temporary directory, a long backlog can fill it, and files from a run that
+crashed are never removed. A StagingArea instead keeps them all in one
+directory (which may be on a tmpfs, e.g., under /dev/shm), caps the bytes
+that jobs may have staged at once, and on startup removes the files that no
+checkpointed job still needs.
+
+Jobs reserve an estimate of what they will stage before writing anything and
+release it when they finish; reserve() blocks while the quota is used up, so
+the encrypt stage waits for uploads to catch up instead of filling the disk.
+
+Usage:
+  staging = StagingArea('/dev/shm/lockbox', quota=1 << 30)
+  staging.sweep(keep=paths_of_checkpointed_jobs)
+
+  reserved = staging.reserve(os.path.getsize(path))
+  with new_file(staging.directory) as staged_file:
+    ...
+  staging.release(reserved)
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import logging
+import os
+import threading
+from tempfile import NamedTemporaryFile
+
+# Staged files are named so that sweep() only ever touches ours.
+PREFIX = 'lockbox-'
+
+_DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.lockbox',
+                                  'staging')
+
+
+def new_file(directory=None):
+  """A named temporary file, kept after it is closed, in directory (the
+  system's temporary directory by default)."""
+  return NamedTemporaryFile(delete=False, dir=directory, prefix=PREFIX)
+
+
+class StagingArea(object):
+  def __init__(self, directory=None, quota=None):
+    """
+    Args:
+      directory: Where staged files go; created if need be. Defaults to
+        ~/.lockbox/staging.
+      quota: Bytes that jobs may have reserved at once; unlimited if None.
+    """
+    self.directory = directory or _DEFAULT_DIRECTORY
+    if not os.path.exists(self.directory):
+      os.makedirs(self.directory)
+    self.quota = quota
+    self.reserved = 0
+    self._room = threading.Condition()
+
+
+  def reserve(self, size, block=True):
+    """Reserves size bytes, blocking while they do not fit under the quota.
+
+    A reservation bigger than the whole quota is let through once nothing
+    else is reserved, so that a large file is slow rather than stuck.
+
+    Args:
+      block: Whether to wait for room; if False, the bytes are reserved
+        regardless (e.g., for files already on disk after a restart).
+
+    Returns:
+      size, to hand back to release().
+    """
+    with self._room:
+      if block and self.quota is not None:
+        if self._over_quota(size):
+          logging.info('Staging area is full (%d of %d bytes); waiting to '
+                       'stage %d bytes.' % (self.reserved, self.quota, size))
+        while self._over_quota(size):
+          self._room.wait()
+      self.reserved += size
+    return size
+
+
+  def _over_quota(self, size):
+    return self.reserved > 0 and self.reserved + size > self.quota
+
+
+  def release(self, size):
+    with self._room:
+      self.reserved -= size
+      self._room.notify_all()
+
+
+  def sweep(self, keep=()):
+    """Removes staged files that are not in keep, e.g., left behind by a run
+    that crashed.
+
+    Returns:
+      Number of files removed.
+    """
+    keep = set(os.path.realpath(path) for path in keep)
+    removed = 0
+    for name in os.listdir(self.directory):
+      path = os.path.realpath(os.path.join(self.directory, name))
+      if not name.startswith(PREFIX) or path in keep:
+        continue
+      try:
+        os.remove(path)
+        removed += 1
+      except OSError, e:
+        logging.error('Could not remove staged file (%s): %s' % (path, e))
+    if removed:
+      logging.info('Removed %d orphaned staged file(s) from (%s).' %
+                   (removed, self.directory))
+    return removed
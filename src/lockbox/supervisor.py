@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Keeps the shepherds and the pipeline stages alive and sized to the machine.
+
+Every interval the supervisor
+
+  * replaces shepherds and stage workers that died, putting the rows they held
+    back in the mediator's queue, and
+  * grows or shrinks each pool by one worker, within its bounds.
+
+A pool grows when work is waiting for it and every worker is busy, unless more
+workers would not help: the CPU-bound stages hold back once the process is
+using most of the CPUs, and the upload stage holds back when the last extra
+uploader did not raise throughput. A pool shrinks after sitting partly idle
+with nothing queued for a few intervals in a row.
+
+Usage:
+  supervisor = PoolSupervisor(mediator)
+  supervisor.start()
+  ...
+  supervisor.stop()
+  supervisor.join()
+"""
+
+__author__ = 'tierney@cs.nyu.edu (Matt Tierney)'
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from local_file_shepherd import SHEPHERD_STATE_READY
+
+_NUM_CPUS = multiprocessing.cpu_count()
+
+_INTERVAL_SECONDS = 2
+
+# (min, max) workers per pool.
+DEFAULT_POOL_BOUNDS = {
+  'shepherd': (1, 2 * _NUM_CPUS),
+  'signature': (1, _NUM_CPUS),
+  'encrypt': (1, _NUM_CPUS),
+  'upload': (1, 16),
+  'commit': (1, 4),
+  }
+
+_CPU_BOUND_STAGES = ['signature', 'encrypt']
+# Fraction of all CPUs above which CPU-bound pools stop growing.
+_HIGH_CPU_UTILIZATION = 0.85
+# An extra uploader must raise throughput by this factor to be worth keeping
+# the upload pool growing.
+_MIN_UPLOAD_GAIN = 1.05
+_IDLE_INTERVALS_BEFORE_SHRINK = 3
+
+
+class CpuMeter(object):
+  """CPU utilization of this process and its (reaped) children, e.g., gpg,
+  as a fraction of all CPUs since the previous call."""
+  def __init__(self):
+    self._last = self._sample()
+
+
+  @staticmethod
+  def _sample():
+    times = os.times()
+    return sum(times[:4]), time.time()
+
+
+  def utilization(self):
+    cpu_seconds, wall_seconds = self._sample()
+    last_cpu_seconds, last_wall_seconds = self._last
+    self._last = (cpu_seconds, wall_seconds)
+    elapsed = wall_seconds - last_wall_seconds
+    if elapsed <= 0:
+      return 0.
+    return (cpu_seconds - last_cpu_seconds) / (elapsed * _NUM_CPUS)
+
+
+class PoolSupervisor(threading.Thread):
+  def __init__(self, mediator, pool_bounds=None, interval=_INTERVAL_SECONDS):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.mediator = mediator
+    self.pool_bounds = dict(DEFAULT_POOL_BOUNDS)
+    self.pool_bounds.update(pool_bounds or dict())
+    self.interval = interval
+
+    self._stop = threading.Event()
+    self._cpu_meter = CpuMeter()
+    self._idle_intervals = dict((name, 0) for name in self.pool_bounds)
+    self._last_uploaded_bytes = 0
+    self._last_check = time.time()
+    # Upload throughput measured just before the upload pool last grew.
+    self._upload_rate_before_grow = None
+
+
+  def stop(self):
+    self._stop.set()
+
+
+  def run(self):
+    while not self._stop.is_set():
+      self._stop.wait(self.interval)
+      if self._stop.is_set():
+        break
+      try:
+        self.check()
+      except Exception, e:
+        logging.exception('Supervisor check failed: %s' % e)
+    logging.info('PoolSupervisor shutting down.')
+
+
+  def check(self):
+    self.mediator.heal_shepherds()
+    self.mediator.pipeline.heal()
+    self._autoscale()
+
+
+  def _upload_rate(self):
+    now = time.time()
+    uploaded_bytes = self.mediator.pipeline.uploaded_bytes
+    elapsed = max(now - self._last_check, 1e-6)
+    rate = (uploaded_bytes - self._last_uploaded_bytes) / elapsed
+    self._last_uploaded_bytes = uploaded_bytes
+    self._last_check = now
+    return rate
+
+
+  def _autoscale(self):
+    cpu_utilization = self._cpu_meter.utilization()
+    upload_rate = self._upload_rate()
+    logging.debug('Autoscale: cpu %.2f, upload %.0f B/s.' %
+                  (cpu_utilization, upload_rate))
+
+    for stage in self.mediator.pipeline.stages:
+      backed_up = stage.depth() > 0 and stage.busy() >= stage.size()
+      idle = stage.depth() == 0 and stage.busy() < stage.size()
+      if self._should_grow(stage.name, stage.size(), backed_up,
+                           cpu_utilization, upload_rate):
+        logging.info('Growing %s pool to %d.' % (stage.name, stage.size() + 1))
+        if stage.name == 'upload':
+          self._upload_rate_before_grow = upload_rate
+        stage.grow()
+      elif self._should_shrink(stage.name, stage.size(), idle):
+        logging.info('Shrinking %s pool to %d.' %
+                     (stage.name, stage.size() - 1))
+        stage.shrink()
+
+    self._autoscale_shepherds()
+
+
+  def _autoscale_shepherds(self):
+    shepherds = self.mediator.shepherds
+    num_ready = len([shepherd for shepherd in shepherds
+                     if shepherd.get_state() == SHEPHERD_STATE_READY])
+    backlog = self.mediator.backlog()
+    # More shepherds only help if the pipeline can take what they produce.
+    backed_up = backlog > 0 and num_ready == 0 and \
+        not self.mediator.pipeline.signature.full()
+    idle = backlog == 0 and num_ready > 0
+    if self._should_grow('shepherd', len(shepherds), backed_up):
+      logging.info('Growing shepherd pool to %d.' % (len(shepherds) + 1))
+      self.mediator.add_shepherds()
+    elif self._should_shrink('shepherd', len(shepherds), idle):
+      if self.mediator.retire_shepherd():
+        logging.info('Shrank shepherd pool to %d.' %
+                     len(self.mediator.shepherds))
+
+
+  def _should_grow(self, name, size, backed_up, cpu_utilization=0.,
+                   upload_rate=0.):
+    minimum, maximum = self.pool_bounds[name]
+    if size < minimum:
+      return True
+    if not backed_up or size >= maximum:
+      return False
+    if name in _CPU_BOUND_STAGES and cpu_utilization >= _HIGH_CPU_UTILIZATION:
+      return False
+    if name == 'upload' and self._upload_rate_before_grow is not None and \
+          upload_rate < self._upload_rate_before_grow * _MIN_UPLOAD_GAIN:
+      # The last uploader we added did not pay off; the uplink is saturated.
+      return False
+    return True
+
+
+  def _should_shrink(self, name, size, idle):
+    minimum, maximum = self.pool_bounds[name]
+    if size > maximum:
+      return True
+    if not idle or size <= minimum:
+      self._idle_intervals[name] = 0
+      return False
+    self._idle_intervals[name] += 1
+    if self._idle_intervals[name] < _IDLE_INTERVALS_BEFORE_SHRINK:
+      return False
+    self._idle_intervals[name] = 0
+    if name == 'upload':
+      self._upload_rate_before_grow = None
+    return True
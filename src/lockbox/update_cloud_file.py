@@ -42,6 +42,8 @@ class UpdateCloudFile(object):
     # S3: hash_of_encrypted_blob -> path_to_encrypted_blob.
     self.hash_of_encrypted_blob = file_update_crypto.hash_of_encrypted_blob
     self.path_to_encrypted_blob = file_update_crypto.path_to_encrypted_blob
+    # Small blobs are only in memory (see spool); None for restored ones.
+    self.encrypted_blob = file_update_crypto.encrypted_blob
 
     # SDB: hash_of_raw_data_of_encrypted_blob_path ->
     #         [ (hash_of_encrypted_blob, hash_of_prev_blob) ].
@@ -57,12 +59,24 @@ class UpdateCloudFile(object):
 
 
   def update_blob(self):
+    if self.encrypted_blob is not None and self.encrypted_blob.in_memory():
+      logging.info('Encrypted blobs (%s) : (%d bytes in memory).' %
+                   (self.hash_of_encrypted_blob, self.encrypted_blob.size))
+      self.blob_store.put_string(self.hash_of_encrypted_blob,
+                                 self.encrypted_blob.getvalue())
+      return
     logging.info('Encrypted blobs (%s) : (%s).' % (self.hash_of_encrypted_blob,
                                                    self.path_to_encrypted_blob))
     self.blob_store.put_filename(self.hash_of_encrypted_blob,
                                  self.path_to_encrypted_blob)
 
 
+  def update_chunk(self, key, path):
+    """Uploads one chunk of a chunked blob (see chunked_crypto)."""
+    logging.info('Encrypted chunk (%s) : (%s).' % (key, path))
+    self.blob_store.put_filename(key, path)
+
+
   def update_storage(self):
     logging.error('-------> DEPRECATED <--------')
     # TODO(tierney): Failure rollback?
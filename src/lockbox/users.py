@@ -6,6 +6,7 @@ import sqlite3
 import os
 import time
 from gnupg import GPG
+from keyring_index import KeyringIndex
 from master_db_connection import MasterDBConnection
 
 
@@ -18,11 +19,12 @@ if not os.path.exists(_DEFAULT_DATABASE_DIRECTORY):
 class Users(object):
   def __init__(self, iam_connection, gpg,
                database_directory=_DEFAULT_DATABASE_DIRECTORY,
-               database_name=_DEFAULT_DATABASE_NAME):
+               database_name=_DEFAULT_DATABASE_NAME, keyring=None):
     assert isinstance(iam_connection, boto.iam.connection.IAMConnection)
     assert isinstance(gpg, GPG)
     self.iam_connection = iam_connection
     self.gpg = gpg
+    self.keyring = keyring or KeyringIndex(gpg)
     self.database_directory = database_directory
     self.database_name = database_name
     self.database_path = os.path.join(self.database_directory,
@@ -75,7 +77,7 @@ class Users(object):
     # user_name.
     for uids, date, expires, fingerprint, keyid in important_keys_values:
       if 'Matt Tierney' in " ".join(uids):
-        if expires < time.time():
+        if expires is not None and expires < time.time():
           logging.warning('Not including expired key (%s).' % fingerprint)
           continue
         return fingerprint
@@ -86,10 +88,9 @@ class Users(object):
   def create_user(self, user_name):
     # Expect to receive a list of (user_name, fingerprint) tuples.
 
-    all_keys = self.gpg.list_keys()
     important_keys_values = [
-      (key['uids'], key['date'], key['expires'], key['fingerprint'],
-       key['keyid']) for key in all_keys]
+      (key.uids, key.date, key.expires, key.fingerprint, key.keyid)
+      for key in self.keyring.keys()]
 
     fingerprint = self._choose_fingerprint(important_keys_values)
     if not fingerprint:
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import tempfile
+import unittest
+from StringIO import StringIO
+import lockbox.chunked_crypto
+import lockbox.file_update_crypto
+import lockbox.hybrid_crypto
+from lockbox.chunked_crypto import ChunkedEncryptor, decrypt_chunked
+from lockbox.compression import CODEC_ZLIB
+from lockbox.exception import EncryptedBlobError, FileChangedError
+from lockbox.file_update_crypto import FileUpdateCrypto
+from lockbox.hybrid_crypto import BULK_CIPHER_AES, read_path
+
+
+class FakeResult(object):
+  def __init__(self, data):
+    self.data = data
+
+  def __nonzero__(self):
+    return True
+
+
+class FakeGPG(object):
+  """Wraps by reversing."""
+  def encrypt(self, data, recipients, always_trust=False, armor=True):
+    return FakeResult(data[::-1])
+
+  def decrypt(self, data, always_trust=False, passphrase=None):
+    return FakeResult(data[::-1])
+
+
+class FakeAsyncResult(object):
+  def __init__(self, pool, index):
+    self.pool = pool
+    self.index = index
+
+  def ready(self):
+    return self.pool.encrypt_at_once
+
+  def wait(self):
+    self.pool.log.append(('wait', self.index))
+
+  def get(self):
+    self.pool.log.append(('get', self.index))
+    return 'chunk-%d' % self.index
+
+
+class FakePool(object):
+  """Records what is queued and waited for. Chunks are encrypted as soon as
+  they are queued if encrypt_at_once, else only once waited for."""
+  def __init__(self, encrypt_at_once=False):
+    self.encrypt_at_once = encrypt_at_once
+    self.log = list()
+
+  def apply_async(self, function, args):
+    index = len([entry for entry in self.log if entry[0] == 'queue'])
+    self.log.append(('queue', index))
+    return FakeAsyncResult(self, index)
+
+
+class FakeSigGenerator(object):
+  def update(self, data):
+    pass
+
+  def getsig(self):
+    return 'signature'
+
+
+@unittest.skipIf(lockbox.hybrid_crypto.M2Crypto is None,
+                 'M2Crypto is not installed')
+class ChunkedEncryptorTestCase(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.pool = multiprocessing.Pool(2)
+
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.pool.terminate()
+
+
+  def setUp(self):
+    self.gpg = FakeGPG()
+    self.data = os.urandom(50000) + 'compressible ' * 10000
+    fd, self.path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as fh:
+      fh.write(self.data)
+
+
+  def tearDown(self):
+    os.remove(self.path)
+
+
+  def feed(self, encryptor):
+    with open(self.path, 'rb') as fh:
+      while True:
+        # Pieces that straddle chunk boundaries.
+        data = fh.read(10000)
+        if not data:
+          break
+        encryptor.update(data)
+    encryptor.finish()
+
+
+  def encrypt(self, codec=''):
+    """Returns the manifest and the chunks by key."""
+    encryptor = ChunkedEncryptor(self.gpg, ['recipient'], self.path, codec,
+                                 chunk_size=16384, pool=self.pool)
+    manifest = StringIO()
+    encryptor.write_manifest(manifest)
+    self.feed(encryptor)
+    chunks = dict()
+    for index in range(encryptor.num_chunks):
+      path = encryptor.wait(index)
+      with open(path, 'rb') as chunk_file:
+        chunks[encryptor.chunk_key(index)] = chunk_file.read()
+      os.remove(path)
+    self.assertEqual(max(1, -(-len(self.data) // 16384)), len(chunks))
+    return manifest.getvalue(), chunks
+
+
+  def decrypt(self, manifest, chunks):
+    cleartext = StringIO()
+    decrypt_chunked(self.gpg, StringIO(manifest), chunks.__getitem__,
+                    cleartext)
+    return cleartext.getvalue()
+
+
+  def test_round_trip(self):
+    self.assertEqual(self.data, self.decrypt(*self.encrypt()))
+
+
+  def test_manifest_header_has_path(self):
+    manifest, _ = self.encrypt()
+    self.assertEqual(self.path, read_path(self.gpg, StringIO(manifest)))
+
+
+  def test_round_trip_compressed(self):
+    manifest, chunks = self.encrypt(CODEC_ZLIB)
+    self.assertTrue(sum(map(len, chunks.values())) < len(self.data))
+    self.assertEqual(self.data, self.decrypt(manifest, chunks))
+
+
+  def test_swapped_chunks_fail(self):
+    manifest, chunks = self.encrypt()
+    keys = sorted(chunks)
+    chunks[keys[0]], chunks[keys[1]] = chunks[keys[1]], chunks[keys[0]]
+    self.assertRaises(EncryptedBlobError, self.decrypt, manifest, chunks)
+
+
+  def test_chunk_from_other_version_fails(self):
+    manifest, chunks = self.encrypt()
+    other_manifest, other_chunks = self.encrypt()
+    for key, other_key in zip(sorted(chunks), sorted(other_chunks)):
+      chunks[key] = other_chunks[other_key]
+    self.assertRaises(EncryptedBlobError, self.decrypt, manifest, chunks)
+
+
+  def test_discard_removes_pending_chunks(self):
+    encryptor = ChunkedEncryptor(self.gpg, ['recipient'], self.path,
+                                 chunk_size=16384, pool=self.pool)
+    self.feed(encryptor)
+    paths = [encryptor.wait(index) for index in range(encryptor.num_chunks)]
+    encryptor.discard()
+    self.assertFalse([path for path in paths if os.path.exists(path)])
+
+
+  def test_file_changed_size(self):
+    encryptor = ChunkedEncryptor(self.gpg, ['recipient'], self.path,
+                                 chunk_size=16384, pool=self.pool)
+    with open(self.path, 'ab') as fh:
+      fh.write('more')
+    self.assertRaises(FileChangedError, self.feed, encryptor)
+    encryptor.discard()
+
+
+  def test_empty_file(self):
+    with open(self.path, 'wb'):
+      pass
+    self.data = ''
+    manifest, chunks = self.encrypt()
+    self.assertEqual('', self.decrypt(manifest, chunks))
+
+
+  def test_bounds_chunks_in_flight(self):
+    pool = FakePool()
+    encryptor = ChunkedEncryptor(self.gpg, ['recipient'], self.path,
+                                 chunk_size=1024, pool=pool, max_in_flight=3)
+    self.feed(encryptor)
+    num_chunks = -(-len(self.data) // 1024)
+    expected = list()
+    for index in range(num_chunks):
+      if index >= 3:
+        expected.append(('wait', index - 3))
+      expected.append(('queue', index))
+    self.assertEqual(expected, pool.log)
+
+
+  def hand_out(self, pool):
+    encryptor = ChunkedEncryptor(
+      self.gpg, ['recipient'], self.path, chunk_size=1024, pool=pool,
+      max_in_flight=3,
+      on_encrypted=lambda index, path: pool.log.append(('upload', path)))
+    self.feed(encryptor)
+    return -(-len(self.data) // 1024)
+
+
+  def test_hands_out_chunks_as_they_are_encrypted(self):
+    pool = FakePool(encrypt_at_once=True)
+    num_chunks = self.hand_out(pool)
+    expected = list()
+    for index in range(num_chunks):
+      expected.extend([('queue', index), ('get', index),
+                       ('upload', 'chunk-%d' % index)])
+    self.assertEqual(expected, pool.log)
+
+
+  def test_bounds_chunks_not_handed_out(self):
+    pool = FakePool()
+    num_chunks = self.hand_out(pool)
+    expected = list()
+    for index in range(num_chunks):
+      if index >= 3:
+        expected.extend([('get', index - 3),
+                         ('upload', 'chunk-%d' % (index - 3))])
+      expected.append(('queue', index))
+    for index in range(num_chunks - 3, num_chunks):
+      expected.extend([('get', index), ('upload', 'chunk-%d' % index)])
+    self.assertEqual(expected, pool.log)
+
+
+class SharedPoolTestCase(unittest.TestCase):
+  def test_needs_start_pool(self):
+    pool = lockbox.chunked_crypto._pool
+    lockbox.chunked_crypto._pool = None
+    try:
+      self.assertRaises(ValueError, lockbox.chunked_crypto.shared_pool)
+    finally:
+      lockbox.chunked_crypto._pool = pool
+
+
+@unittest.skipIf(lockbox.hybrid_crypto.M2Crypto is None,
+                 'M2Crypto is not installed')
+class FileUpdateCryptoChunkedTestCase(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    lockbox.chunked_crypto.start_pool(2)
+
+
+  @classmethod
+  def tearDownClass(cls):
+    lockbox.chunked_crypto._pool.terminate()
+    lockbox.chunked_crypto._pool = None
+
+
+  def setUp(self):
+    self.data = os.urandom(100000)
+    fd, self.path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as fh:
+      fh.write(self.data)
+    self.threshold = lockbox.file_update_crypto.CHUNKED_THRESHOLD
+    self.chunk_size = lockbox.chunked_crypto._CHUNK_SIZE
+    self.sig_generator = lockbox.file_update_crypto.SigGenerator
+    self.read_size = lockbox.file_update_crypto._READ_SIZE
+    lockbox.file_update_crypto.CHUNKED_THRESHOLD = 50000
+    lockbox.file_update_crypto._READ_SIZE = 10000
+    lockbox.chunked_crypto._CHUNK_SIZE = 32768
+    lockbox.file_update_crypto.SigGenerator = FakeSigGenerator
+    self.crypto = FileUpdateCrypto(FakeGPG(), self.path, ['recipient'],
+                                   BULK_CIPHER_AES)
+
+
+  def tearDown(self):
+    lockbox.file_update_crypto.CHUNKED_THRESHOLD = self.threshold
+    lockbox.chunked_crypto._CHUNK_SIZE = self.chunk_size
+    lockbox.file_update_crypto.SigGenerator = self.sig_generator
+    lockbox.file_update_crypto._READ_SIZE = self.read_size
+    self.crypto.cleanup()
+    os.remove(self.path)
+
+
+  def test_chunks_upload_in_order(self):
+    self.crypto.sign_and_encrypt(with_path=False)
+    self.assertTrue(self.crypto.blob_id)
+    # Every chunk's file is known, so a checkpoint can be resumed.
+    self.assertTrue(self.crypto.resumable())
+
+    chunks = dict()
+    for index, key, path in self.crypto.encrypted_chunks():
+      self.assertEqual(len(chunks), index)
+      with open(path, 'rb') as chunk_file:
+        chunks[key] = chunk_file.read()
+      self.crypto.chunk_uploaded(index)
+      self.assertFalse(os.path.exists(path))
+    self.assertEqual(4, len(chunks))
+    self.assertTrue(self.crypto.resumable())
+    self.assertEqual([], list(self.crypto.encrypted_chunks()))
+
+    with self.crypto.encrypted_blob.open() as manifest:
+      cleartext = StringIO()
+      decrypt_chunked(FakeGPG(), manifest, chunks.__getitem__, cleartext)
+    self.assertEqual(self.data, cleartext.getvalue())
+
+
+  def test_chunks_upload_while_file_is_read(self):
+    chunks = dict()
+    read_at_upload = list()
+    def upload_chunk(index, key, path):
+      read_at_upload.append(self.crypto._chunked_encryptor._num_read)
+      with open(path, 'rb') as chunk_file:
+        chunks[key] = chunk_file.read()
+      self.crypto.chunk_uploaded(index)
+    max_in_flight = lockbox.chunked_crypto._MAX_IN_FLIGHT
+    lockbox.chunked_crypto._MAX_IN_FLIGHT = 1
+    try:
+      self.crypto.sign_and_encrypt(with_path=False, upload_chunk=upload_chunk)
+    finally:
+      lockbox.chunked_crypto._MAX_IN_FLIGHT = max_in_flight
+    self.assertEqual(4, len(chunks))
+    # The first chunk went out before the file was read in full.
+    self.assertTrue(read_at_upload[0] < len(self.data))
+    self.assertEqual(['', '', '', ''], self.crypto.chunk_paths)
+    self.assertTrue(self.crypto.resumable())
+
+    with self.crypto.encrypted_blob.open() as manifest:
+      cleartext = StringIO()
+      decrypt_chunked(FakeGPG(), manifest, chunks.__getitem__, cleartext)
+    self.assertEqual(self.data, cleartext.getvalue())
+
+
+  def test_small_file_is_not_chunked(self):
+    lockbox.file_update_crypto.CHUNKED_THRESHOLD = len(self.data) + 1
+    self.crypto.sign_and_encrypt(with_path=False)
+    self.assertEqual('', self.crypto.blob_id)
+    self.assertEqual([], list(self.crypto.encrypted_chunks()))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+from StringIO import StringIO
+from lockbox.compression import CompressingReader, choose_codec, \
+    decompress_stream, is_compressed, sample_entropy, CODECS, CODEC_STORE, \
+    CODEC_ZLIB, CODEC_BZ2
+
+
+class SampleEntropyTestCase(unittest.TestCase):
+  def test_bounds(self):
+    self.assertEqual(0., sample_entropy(''))
+    self.assertEqual(0., sample_entropy('a' * 1000))
+    self.assertAlmostEqual(8., sample_entropy(''.join(map(chr, range(256)))))
+
+
+class ChooseCodecTestCase(unittest.TestCase):
+  def setUp(self):
+    self.paths = list()
+
+
+  def tearDown(self):
+    for path in self.paths:
+      os.remove(path)
+
+
+  def write(self, data, suffix=''):
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, 'wb') as fh:
+      fh.write(data)
+    self.paths.append(path)
+    return path
+
+
+  def test_random_data_is_stored(self):
+    self.assertEqual(CODEC_STORE, choose_codec(self.write(os.urandom(100000))))
+
+
+  def test_compressed_extension_is_stored_unread(self):
+    self.assertEqual(CODEC_STORE, choose_codec(self.write('a' * 1000, '.JPG')))
+
+
+  def test_text_gets_bz2(self):
+    log = ''.join('2012-03-04 12:00:%02d INFO request %d ok\n' % (i % 60, i)
+                  for i in range(5000))
+    self.assertEqual(CODEC_BZ2, choose_codec(self.write(log)))
+
+
+  def test_mixed_data_gets_zlib(self):
+    data = ''.join(os.urandom(24) + 'x' * 8 for _ in range(5000))
+    self.assertEqual(CODEC_ZLIB, choose_codec(self.write(data)))
+
+
+class CompressingReaderTestCase(unittest.TestCase):
+  def round_trip(self, data, codec, read_size):
+    reader = CompressingReader(StringIO(data), codec)
+    compressed = list()
+    while True:
+      chunk = reader.read(read_size)
+      if not chunk:
+        break
+      compressed.append(chunk)
+    compressed = ''.join(compressed)
+    self.assertTrue(is_compressed(compressed))
+
+    cleartext = StringIO()
+    self.assertEqual(codec, decompress_stream(StringIO(compressed), cleartext))
+    self.assertEqual(data, cleartext.getvalue())
+    return compressed
+
+
+  def test_round_trips(self):
+    data = 'lockbox ' * 300000 + os.urandom(1000)
+    for codec in CODECS:
+      for read_size in [1024, -1]:
+        self.round_trip(data, codec, read_size)
+
+
+  def test_empty(self):
+    for codec in CODECS:
+      self.round_trip('', codec, 1024)
+
+
+  def test_compresses(self):
+    data = 'lockbox ' * 300000
+    self.assertTrue(len(self.round_trip(data, CODEC_ZLIB, 1024)) <
+                    len(data) / 100)
+
+
+  def test_not_compressed(self):
+    self.assertRaises(ValueError, decompress_stream, StringIO('x' * 100),
+                      StringIO())
+
+
+if __name__ == '__main__':
+  unittest.main()
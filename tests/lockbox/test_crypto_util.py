@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import hashlib
+import mmap
+import os
+import tempfile
+import unittest
+import lockbox.crypto_util
+from StringIO import StringIO
+from lockbox.crypto_util import hash_file, hash_filename, hash_string, \
+    HashingWriter
+
+
+class HashFileTestCase(unittest.TestCase):
+  def setUp(self):
+    # A few chunks plus a partial one.
+    self.data = os.urandom(3 * lockbox.crypto_util._HASH_CHUNK_SIZE + 12345)
+    self.expected = hashlib.sha1(self.data).hexdigest()
+    fd, self.path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as fh:
+      fh.write(self.data)
+
+
+  def tearDown(self):
+    os.remove(self.path)
+
+
+  def test_hash_file(self):
+    with open(self.path, 'rb') as fh:
+      self.assertEqual(self.expected, hash_file(fh))
+
+
+  def test_hash_file_from_current_position(self):
+    with open(self.path, 'rb') as fh:
+      fh.seek(100)
+      self.assertEqual(hashlib.sha1(self.data[100:]).hexdigest(),
+                       hash_file(fh))
+
+
+  def test_hash_filename_read_and_mmap_agree(self):
+    self.assertEqual(self.expected, hash_filename(self.path, use_mmap=False))
+    self.assertEqual(self.expected, hash_filename(self.path, use_mmap=True))
+
+
+  def test_hash_mmap_across_windows(self):
+    window_size = lockbox.crypto_util._MMAP_WINDOW_SIZE
+    lockbox.crypto_util._MMAP_WINDOW_SIZE = 2 * mmap.ALLOCATIONGRANULARITY
+    try:
+      self.assertEqual(self.expected, hash_filename(self.path, use_mmap=True))
+    finally:
+      lockbox.crypto_util._MMAP_WINDOW_SIZE = window_size
+
+
+  def test_hash_filename_empty_file(self):
+    with open(self.path, 'wb'):
+      pass
+    self.assertEqual(hash_string(''), hash_filename(self.path, use_mmap=True))
+
+
+  def test_hash_filename_missing_file(self):
+    self.assertFalse(hash_filename(self.path + '.missing'))
+
+
+class HashingWriterTestCase(unittest.TestCase):
+  def test_writes_through_and_hashes(self):
+    out = StringIO()
+    writer = HashingWriter(out)
+    writer.write('hello ')
+    writer.write('world')
+    self.assertEqual('hello world', out.getvalue())
+    self.assertEqual(hash_string('hello world'), writer.hexdigest())
+
+
+if __name__ == '__main__':
+  unittest.main()
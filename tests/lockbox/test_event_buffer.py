@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import threading
+import unittest
+from lockbox.event_buffer import EventBuffer
+
+
+class EventBufferTestCase(unittest.TestCase):
+  def setUp(self):
+    self.batches = list()
+    self.written = threading.Event()
+
+
+  def _write_events(self, items):
+    self.batches.append(items)
+    self.written.set()
+
+
+  def test_flush_writes_in_order(self):
+    event_buffer = EventBuffer(self._write_events)
+    for i in range(5):
+      event_buffer.put(i)
+    self.assertEqual(5, event_buffer.flush())
+    self.assertEqual([[0, 1, 2, 3, 4]], self.batches)
+    self.assertEqual(0, event_buffer.flush())
+
+
+  def test_flush_count_triggers_write(self):
+    event_buffer = EventBuffer(self._write_events, flush_count=3,
+                               flush_interval=60)
+    event_buffer.start()
+    for i in range(3):
+      event_buffer.put(i)
+    self.assertTrue(self.written.wait(5))
+    event_buffer.stop()
+    event_buffer.join()
+    self.assertEqual([0, 1, 2], sum(self.batches, []))
+
+
+  def test_flush_interval_triggers_write(self):
+    event_buffer = EventBuffer(self._write_events, flush_count=100,
+                               flush_interval=0.01)
+    event_buffer.start()
+    event_buffer.put('only')
+    self.assertTrue(self.written.wait(5))
+    event_buffer.stop()
+    event_buffer.join()
+    self.assertEqual([['only']], self.batches)
+
+
+  def test_stop_flushes_remaining(self):
+    event_buffer = EventBuffer(self._write_events, flush_count=100,
+                               flush_interval=60)
+    event_buffer.start()
+    event_buffer.put('pending')
+    event_buffer.stop()
+    event_buffer.join()
+    self.assertEqual([['pending']], self.batches)
+
+
+  def test_failed_write_keeps_items(self):
+    failures = [IOError('database is locked')]
+    def write_events(items):
+      if failures:
+        raise failures.pop()
+      self._write_events(items)
+
+    event_buffer = EventBuffer(write_events)
+    event_buffer.put(0)
+    event_buffer.put(1)
+    self.assertRaises(IOError, event_buffer.flush)
+    self.assertEqual(2, event_buffer.pending())
+    event_buffer.put(2)
+    self.assertEqual(3, event_buffer.flush())
+    self.assertEqual([[0, 1, 2]], self.batches)
+
+
+  def test_worker_retries_failed_write(self):
+    failures = [IOError('database is locked'), IOError('database is locked')]
+    def write_events(items):
+      if failures:
+        raise failures.pop()
+      self._write_events(items)
+
+    event_buffer = EventBuffer(write_events, flush_count=1,
+                               flush_interval=60)
+    event_buffer.start()
+    event_buffer.put('retried')
+    self.assertTrue(self.written.wait(5))
+    event_buffer.stop()
+    event_buffer.join()
+    self.assertEqual([['retried']], self.batches)
+    self.assertEqual(0, event_buffer.pending())
+
+
+if __name__ == '__main__':
+  unittest.main()
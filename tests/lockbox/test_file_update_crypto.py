@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import tempfile
+import unittest
+from StringIO import StringIO
+import lockbox.file_update_crypto
+import lockbox.hybrid_crypto
+import lockbox.spool
+from lockbox.compression import COMPRESSION_ADAPTIVE, CODEC_STORE, \
+    CODEC_BZ2, decompress_stream
+from lockbox.file_update_crypto import FileUpdateCrypto
+from lockbox.hybrid_crypto import BULK_CIPHER_AES, BULK_CIPHER_SEEKABLE, \
+    is_hybrid, header_reference, read_path
+from lockbox.seekable_crypto import is_seekable
+
+
+class FakeGPG(object):
+  """Encrypts by reversing each chunk it reads, writing to output_stream."""
+  def __init__(self):
+    self.num_encrypts = 0
+
+  def encrypt_file(self, cleartext_file, recipients, always_trust=False,
+                   armor=True, output_stream=None):
+    while True:
+      data = cleartext_file.read(1024)
+      if not data:
+        break
+      output_stream.write(data[::-1])
+
+  def encrypt(self, data, recipients, always_trust=False, armor=True):
+    self.num_encrypts += 1
+    result = FakeResult()
+    result.data = data[::-1]
+    return result
+
+  def decrypt(self, data, always_trust=False, passphrase=None):
+    return self.encrypt(data, None)
+
+
+class FakeResult(object):
+  data = ''
+
+  def __nonzero__(self):
+    return True
+
+
+class FakeSigGenerator(object):
+  """Signs with the SHA1 of the data."""
+  def __init__(self):
+    self._sha1 = hashlib.sha1()
+
+  def update(self, data):
+    self._sha1.update(data)
+
+  def getsig(self):
+    return self._sha1.hexdigest()
+
+
+class FakeDeltaFile(object):
+  """The whole new file as its own delta."""
+  def __init__(self, signature, latest_file):
+    self.latest_file = latest_file
+
+  def read(self):
+    return self.latest_file.read()
+
+
+class FileUpdateCryptoTestCase(unittest.TestCase):
+  def setUp(self):
+    self.data = os.urandom(100000)
+    fd, self.path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as fh:
+      fh.write(self.data)
+    self.sig_generator = lockbox.file_update_crypto.SigGenerator
+    lockbox.file_update_crypto.SigGenerator = FakeSigGenerator
+    self.crypto = FileUpdateCrypto(FakeGPG(), self.path, ['recipient'])
+    self.max_in_memory = lockbox.spool._MAX_IN_MEMORY
+
+
+  def tearDown(self):
+    lockbox.file_update_crypto.SigGenerator = self.sig_generator
+    self.crypto.cleanup()
+    os.remove(self.path)
+
+
+  def test_sign_and_encrypt(self):
+    self.crypto.sign_and_encrypt()
+
+    encrypted = self.crypto.encrypted_blob.getvalue()
+    self.assertEqual(len(self.data), len(encrypted))
+    self.assertEqual(hashlib.sha1(encrypted).hexdigest(),
+                     self.crypto.hash_of_encrypted_blob)
+    self.assertEqual(hashlib.sha1(self.data).hexdigest(),
+                     self.crypto.ascii_signature.decode('base64'))
+    self.assertEqual(self.path[::-1],
+                     self.crypto.raw_data_of_encrypted_blob_path)
+
+
+  def test_checkpoint_round_trip(self):
+    self.crypto.sign_and_encrypt()
+    restored = FileUpdateCrypto.restore(FakeGPG(), self.crypto.checkpoint())
+    for attribute in ['hash_of_encrypted_blob', 'path_to_encrypted_blob',
+                      'raw_data_of_encrypted_blob_path', 'ascii_signature',
+                      'hash_of_raw_data_of_encrypted_blob_path']:
+      self.assertEqual(getattr(self.crypto, attribute),
+                       getattr(restored, attribute))
+    # The blob was only in memory.
+    self.assertTrue(self.crypto.encrypted_blob.in_memory())
+    self.assertFalse(restored.resumable())
+
+
+  def test_large_blob_is_spooled_to_disk(self):
+    lockbox.spool._MAX_IN_MEMORY = len(self.data) // 2
+    try:
+      self.crypto.sign_and_encrypt()
+    finally:
+      lockbox.spool._MAX_IN_MEMORY = self.max_in_memory
+    self.assertFalse(self.crypto.encrypted_blob.in_memory())
+    with open(self.crypto.path_to_encrypted_blob, 'rb') as blob:
+      encrypted = blob.read()
+    self.assertEqual(hashlib.sha1(encrypted).hexdigest(),
+                     self.crypto.hash_of_encrypted_blob)
+    self.assertEqual(len(encrypted), self.crypto.encrypted_blob_size())
+
+    restored = FileUpdateCrypto.restore(FakeGPG(), self.crypto.checkpoint())
+    self.assertTrue(restored.resumable())
+    self.assertEqual(encrypted, restored.encrypted_blob.getvalue())
+
+
+  def test_delta_is_encrypted_from_memory(self):
+    delta_file = lockbox.file_update_crypto.DeltaFile
+    lockbox.file_update_crypto.DeltaFile = FakeDeltaFile
+    try:
+      delta = self.crypto.compute_cleartext_delta('', self.path)
+    finally:
+      lockbox.file_update_crypto.DeltaFile = delta_file
+    self.assertEqual(self.data, delta.getvalue().decode('base64'))
+    self.assertTrue(delta.in_memory())
+    self.assertEqual('', self.crypto.delta_file_path)
+    self.crypto.encrypt_delta_file()
+    encrypted = self.crypto.encrypted_blob.getvalue()
+    # FakeGPG reverses each chunk of up to 1024 bytes it reads.
+    self.assertEqual(delta.getvalue(),
+                     ''.join(encrypted[i:i + 1024][::-1]
+                             for i in range(0, len(encrypted), 1024)))
+
+
+  @unittest.skipIf(lockbox.hybrid_crypto.M2Crypto is None,
+                   'M2Crypto is not installed')
+  def test_sign_and_encrypt_with_aes(self):
+    gpg = FakeGPG()
+    crypto = FileUpdateCrypto(gpg, self.path, ['recipient'], BULK_CIPHER_AES)
+    try:
+      crypto.sign_and_encrypt()
+      encrypted = crypto.encrypted_blob.getvalue()
+      self.assertTrue(is_hybrid(encrypted))
+      # The path is wrapped with the data key, in the one gpg call.
+      self.assertEqual(1, gpg.num_encrypts)
+      self.assertTrue(crypto.path_in_header())
+      self.assertEqual(header_reference(crypto.hash_of_encrypted_blob),
+                       crypto.hash_of_raw_data_of_encrypted_blob_path)
+      self.assertEqual(self.path, read_path(gpg, StringIO(encrypted)))
+      self.assertEqual(hashlib.sha1(encrypted).hexdigest(),
+                       crypto.hash_of_encrypted_blob)
+      self.assertEqual(hashlib.sha1(self.data).hexdigest(),
+                       crypto.hash_of_cleartext)
+      restored = FileUpdateCrypto.restore(FakeGPG(), crypto.checkpoint())
+      self.assertEqual(BULK_CIPHER_AES, restored.bulk_cipher)
+      self.assertTrue(restored.path_in_header())
+    finally:
+      crypto.cleanup()
+
+
+  @unittest.skipIf(lockbox.hybrid_crypto.M2Crypto is None,
+                   'M2Crypto is not installed')
+  def test_seekable_blobs_are_not_compressed(self):
+    crypto = FileUpdateCrypto(FakeGPG(), self.path, ['recipient'],
+                              BULK_CIPHER_SEEKABLE, COMPRESSION_ADAPTIVE)
+    try:
+      crypto.sign_and_encrypt()
+      self.assertEqual('', crypto.codec)
+      self.assertTrue(is_seekable(crypto.encrypted_blob.getvalue()))
+    finally:
+      crypto.cleanup()
+
+
+  def test_adaptive_compression(self):
+    text = 'a line of a log file\n' * 10000
+    with open(self.path, 'wb') as fh:
+      fh.write(text)
+    crypto = FileUpdateCrypto(FakeGPG(), self.path, ['recipient'],
+                              compression=COMPRESSION_ADAPTIVE)
+    try:
+      crypto.sign_and_encrypt()
+      self.assertEqual(CODEC_BZ2, crypto.codec)
+      self.assertEqual(hashlib.sha1(text).hexdigest(),
+                       crypto.hash_of_cleartext)
+      encrypted = crypto.encrypted_blob.getvalue()
+      self.assertTrue(len(encrypted) < len(text) / 10)
+      # FakeGPG reverses each chunk of up to 1024 bytes it reads.
+      compressed = ''.join(encrypted[i:i + 1024][::-1]
+                           for i in range(0, len(encrypted), 1024))
+      cleartext = StringIO()
+      self.assertEqual(CODEC_BZ2,
+                       decompress_stream(StringIO(compressed), cleartext))
+      self.assertEqual(text, cleartext.getvalue())
+      restored = FileUpdateCrypto.restore(FakeGPG(), crypto.checkpoint())
+      self.assertEqual(COMPRESSION_ADAPTIVE, restored.compression)
+      self.assertEqual(CODEC_BZ2, restored.codec)
+    finally:
+      crypto.cleanup()
+
+
+  def test_adaptive_compression_stores_random_data(self):
+    crypto = FileUpdateCrypto(FakeGPG(), self.path, ['recipient'],
+                              compression=COMPRESSION_ADAPTIVE)
+    try:
+      crypto.sign_and_encrypt()
+      self.assertEqual(CODEC_STORE, crypto.codec)
+    finally:
+      crypto.cleanup()
+
+
+  def test_cleanup_removes_temp_files(self):
+    lockbox.spool._MAX_IN_MEMORY = 1024
+    try:
+      self.crypto.sign_and_encrypt()
+    finally:
+      lockbox.spool._MAX_IN_MEMORY = self.max_in_memory
+    temp_files = self.crypto.temp_files()
+    self.assertTrue(temp_files)
+    self.crypto.cleanup()
+    self.assertFalse([path for path in temp_files if os.path.exists(path)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+import lockbox.gnupg
+from lockbox.gnupg import GPG
+
+
+class Sink(object):
+  def __init__(self):
+    self.parts = list()
+
+  def write(self, data):
+    self.parts.append(data)
+
+
+class GPGIOTestCase(unittest.TestCase):
+  """Runs GPG against shell scripts that stand in for gpg, to check how data
+  moves through the pipes."""
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    # Bigger than a pipe's buffer, so that gpg blocks on stdout unless it is
+    # drained while the input is still being written.
+    self.cleartext = os.urandom(3 << 20)
+
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+
+  def gpg(self, script):
+    binary = os.path.join(self.directory, 'gpg')
+    with open(binary, 'w') as fh:
+      fh.write('#!/bin/sh\ncase "$*" in *--version*) exit 0;; esac\n' +
+               script)
+    os.chmod(binary, 0755)
+    return GPG(gpgbinary=binary)
+
+
+  def test_passes_data_through(self):
+    gpg = self.gpg('exec cat\n')
+    result = gpg.encrypt(self.cleartext, 'recipient')
+    self.assertEqual(self.cleartext, result.data)
+
+
+  def test_output_stream(self):
+    gpg = self.gpg('exec cat\n')
+    sink = Sink()
+    result = gpg.encrypt_file(StringIO(self.cleartext), 'recipient',
+                              output_stream=sink)
+    self.assertEqual(self.cleartext, ''.join(sink.parts))
+    self.assertEqual('', result.data)
+
+
+  def test_passphrase_comes_first(self):
+    gpg = self.gpg('exec cat\n')
+    result = gpg.encrypt('data', 'recipient', passphrase='secret')
+    self.assertEqual('secret\ndata', result.data)
+
+
+  def test_status_lines(self):
+    gpg = self.gpg('echo "[GNUPG:] BEGIN_ENCRYPTION 2 9" >&2\n'
+                   'echo "[GNUPG:] KEY_CONSIDERED ABCD 0" >&2\n'
+                   'cat\n'
+                   'printf "[GNUPG:] END_ENCRYPTION" >&2\n')
+    result = gpg.encrypt(self.cleartext, 'recipient')
+    self.assertTrue(result)
+    self.assertEqual('encryption ok', result.status)
+    self.assertEqual(self.cleartext, result.data)
+    self.assertEqual(3, len(result.stderr.splitlines()))
+
+
+  def test_gpg_stops_reading(self):
+    gpg = self.gpg('head -c 10\n')
+    result = gpg.encrypt(self.cleartext, 'recipient')
+    self.assertEqual(self.cleartext[:10], result.data)
+
+
+  @unittest.skipIf(not lockbox.gnupg._CAN_POLL, 'poll() is not available')
+  def test_threaded_fallback(self):
+    gpg = self.gpg('exec cat\n')
+    lockbox.gnupg._CAN_POLL = False
+    try:
+      result = gpg.encrypt(self.cleartext, 'recipient')
+    finally:
+      lockbox.gnupg._CAN_POLL = True
+    self.assertEqual(self.cleartext, result.data)
+
+
+if __name__ == '__main__':
+  unittest.main()
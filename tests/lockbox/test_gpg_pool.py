@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import threading
+import unittest
+from StringIO import StringIO
+from lockbox.exception import GpgCancelledError
+from lockbox.gpg_pool import GpgPool
+
+
+class FakeGPG(object):
+  """Records calls, holding each one until release is set."""
+  def __init__(self):
+    self.gnupghome = 'home'
+    self.release = threading.Event()
+    self.release.set()
+    self.lock = threading.Lock()
+    self.running = 0
+    self.max_running = 0
+    self.calls = list()
+
+  def _run(self, name, result):
+    with self.lock:
+      self.running += 1
+      self.max_running = max(self.max_running, self.running)
+      self.calls.append(name)
+    self.release.wait()
+    with self.lock:
+      self.running -= 1
+    return result
+
+  def encrypt(self, data, recipients, **kwargs):
+    return self._run('encrypt', data[::-1])
+
+  def encrypt_file(self, file, recipients, **kwargs):
+    return self._run('encrypt_file', file.read()[::-1])
+
+  def decrypt(self, data, **kwargs):
+    if data == 'bad':
+      raise ValueError('bad data')
+    return self._run('decrypt', data[::-1])
+
+  def verify(self, data):
+    return self._run('verify', True)
+
+
+class GpgPoolTestCase(unittest.TestCase):
+  def setUp(self):
+    self.gpg = FakeGPG()
+    self.pool = GpgPool(self.gpg, max_workers=2)
+
+
+  def tearDown(self):
+    self.gpg.release.set()
+    self.pool.shutdown()
+
+
+  def test_submit(self):
+    self.assertEqual('cba', self.pool.submit_encrypt('abc', ['r']).result(5))
+    self.assertEqual('cba', self.pool.submit_encrypt(StringIO('abc'),
+                                                     ['r']).result(5))
+    self.assertEqual('cba', self.pool.submit_decrypt('abc').result(5))
+    self.assertTrue(self.pool.submit_verify('abc').result(5))
+    self.assertEqual(['encrypt', 'encrypt_file', 'decrypt', 'verify'],
+                     self.gpg.calls)
+
+
+  def test_exception(self):
+    future = self.pool.submit_decrypt('bad')
+    self.assertTrue(isinstance(future.exception(5), ValueError))
+    self.assertRaises(ValueError, future.result)
+
+
+  def test_passes_through(self):
+    self.assertEqual('cba', self.pool.encrypt('abc', ['r']))
+    self.assertEqual('home', self.pool.gnupghome)
+    self.assertRaises(ValueError, self.pool.submit, 'gen_key_input')
+
+
+  def test_caps_concurrency(self):
+    self.gpg.release.clear()
+    futures = [self.pool.submit_encrypt('abc', ['r']) for _ in range(6)]
+    direct = threading.Thread(target=self.pool.encrypt, args=('abc', ['r']))
+    direct.start()
+    while self.pool.running() < 2:
+      self.gpg.release.wait(0.01)
+    self.assertTrue(self.pool.depth() + self.pool.waiting() >= 4)
+    self.gpg.release.set()
+    for future in futures:
+      self.assertEqual('cba', future.result(5))
+    direct.join(5)
+    self.assertEqual(7, len(self.gpg.calls))
+    self.assertEqual(2, self.gpg.max_running)
+    self.assertEqual(0, self.pool.running())
+
+
+  def test_cancel(self):
+    self.gpg.release.clear()
+    running = [self.pool.submit_encrypt('abc', ['r']) for _ in range(2)]
+    while self.pool.running() < 2:
+      self.gpg.release.wait(0.01)
+    queued = self.pool.submit_encrypt('abc', ['r'])
+    done = list()
+    queued.add_done_callback(done.append)
+    self.assertTrue(queued.cancel())
+    self.assertFalse(running[0].cancel())
+    self.assertEqual([queued], done)
+    self.assertRaises(GpgCancelledError, queued.result)
+    self.gpg.release.set()
+    self.assertEqual('cba', running[0].result(5))
+    self.assertEqual('cba', running[1].result(5))
+    self.assertEqual(2, len(self.gpg.calls))
+
+
+  def test_timeout(self):
+    self.gpg.release.clear()
+    future = self.pool.submit_encrypt('abc', ['r'])
+    self.assertRaises(RuntimeError, future.result, 0.05)
+    self.gpg.release.set()
+    self.assertEqual('cba', future.result(5))
+
+
+  def test_shutdown_cancels_pending(self):
+    self.gpg.release.clear()
+    futures = [self.pool.submit_encrypt('abc', ['r']) for _ in range(5)]
+    while self.pool.running() < 2:
+      self.gpg.release.wait(0.01)
+    threading.Timer(0.1, self.gpg.release.set).start()
+    self.pool.shutdown(cancel_pending=True)
+    self.assertEqual(['cba', 'cba'], [future.result(5)
+                                      for future in futures[:2]])
+    self.assertTrue(all(future.cancelled() for future in futures[2:]))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+import lockbox.gpgme_engine
+from lockbox.gpgme_engine import new_engine, GpgmeGPG, ENGINE_SUBPROCESS, \
+    ENGINE_GPGME
+from lockbox.staging import StagingArea
+
+
+class FakeGPG(object):
+  """Stands in for gnupg.GPG: records what it is asked to encrypt."""
+  def __init__(self):
+    self.encrypted = list()
+
+  def encrypt_file(self, file, recipients, **kwargs):
+    self.encrypted.append(file.read())
+
+  def list_keys(self):
+    return ['key']
+
+
+class FakeKeyring(object):
+  def __init__(self):
+    self.stat = (1, 2, 3, 4, 5)
+
+  def stat_key(self):
+    return self.stat
+
+
+class FakeGPGMEError(Exception):
+  pass
+
+
+class FakeKey(object):
+  can_encrypt = True
+
+
+class FakeData(object):
+  """Stands in for pyme's core.Data, reading and writing file descriptors
+  directly as gpgme does."""
+  def __init__(self, string=None, file=None):
+    self.fd = None
+    self.buffer = StringIO()
+    if file is not None:
+      self.fd = file.fileno()
+      self.kind = 'fd'
+    elif string is not None:
+      self.buffer.write(string)
+      self.buffer.seek(0)
+      self.kind = 'string'
+    else:
+      self.kind = 'memory'
+
+  def read(self, size=-1):
+    if self.fd is None:
+      return self.buffer.read(size)
+    chunks = list()
+    while True:
+      data = os.read(self.fd, 1 << 16)
+      if not data:
+        return ''.join(chunks)
+      chunks.append(data)
+
+  def write(self, data):
+    if self.fd is None:
+      self.buffer.write(data)
+    else:
+      os.write(self.fd, data)
+
+  def seek(self, offset, whence):
+    self.buffer.seek(offset, whence)
+
+
+class FakeContext(object):
+  """Encrypts by reversing the plaintext."""
+  def __init__(self, core):
+    self.core = core
+
+  def set_armor(self, armor):
+    pass
+
+  def op_keylist_all(self, pattern, secret):
+    self.core.num_keylists += 1
+    return [FakeKey()] if pattern == 'recipient' else []
+
+  def op_encrypt(self, keys, flags, plaintext, cipher):
+    self.core.plaintexts.append(plaintext.kind)
+    self.core.ciphers.append(cipher.kind)
+    if self.core.staging:
+      self.core.staged.append(self.core.staging.reserved)
+    cipher.write(plaintext.read()[::-1])
+
+
+class FakeCore(object):
+  def __init__(self):
+    self.plaintexts = list()
+    self.ciphers = list()
+    self.num_keylists = 0
+    # Bytes reserved in staging during each encryption.
+    self.staging = None
+    self.staged = list()
+    self.Data = FakeData
+
+  def check_version(self, version):
+    pass
+
+  def Context(self):
+    return FakeContext(self)
+
+
+class FakeErrors(object):
+  GPGMEError = FakeGPGMEError
+
+
+class FakeCoreTestCase(unittest.TestCase):
+  """Runs GpgmeGPG against a fake pyme core."""
+  def setUp(self):
+    self.saved = (lockbox.gpgme_engine.core,
+                  getattr(lockbox.gpgme_engine, 'errors', None),
+                  lockbox.gpgme_engine._FdData,
+                  lockbox.gpgme_engine._MAX_IN_MEMORY)
+    self.core = FakeCore()
+    lockbox.gpgme_engine.core = self.core
+    lockbox.gpgme_engine.errors = FakeErrors
+    lockbox.gpgme_engine._FdData = FakeData
+    self.gpg = FakeGPG()
+    self.keyring = FakeKeyring()
+    self.engine = GpgmeGPG(self.gpg, self.keyring)
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'a')
+    self.cleartext = os.urandom(3 * lockbox.gpgme_engine._CHUNK_SIZE + 1)
+    with open(self.path, 'wb') as fh:
+      fh.write(self.cleartext)
+
+
+  def tearDown(self):
+    (lockbox.gpgme_engine.core, lockbox.gpgme_engine.errors,
+     lockbox.gpgme_engine._FdData,
+     lockbox.gpgme_engine._MAX_IN_MEMORY) = self.saved
+    shutil.rmtree(self.directory)
+
+
+  def test_streams_file_by_descriptor(self):
+    output = StringIO()
+    with open(self.path, 'rb') as fh:
+      result = self.engine.encrypt_file(fh, ['recipient'],
+                                        output_stream=output)
+    self.assertTrue(result)
+    self.assertEqual(self.cleartext[::-1], output.getvalue())
+    self.assertEqual('', result.data)
+    self.assertEqual(['fd'], self.core.plaintexts)
+    self.assertEqual(['memory'], self.core.ciphers)
+    self.assertEqual([], self.gpg.encrypted)
+
+
+  def test_big_file_goes_through_staging(self):
+    lockbox.gpgme_engine._MAX_IN_MEMORY = 1024
+    staging = StagingArea(os.path.join(self.directory, 'staging'), quota=1)
+    self.core.staging = staging
+    self.engine = GpgmeGPG(self.gpg, self.keyring, staging)
+    output = StringIO()
+    with open(self.path, 'rb') as fh:
+      self.assertTrue(self.engine.encrypt_file(fh, ['recipient'],
+                                               output_stream=output))
+    self.assertEqual(self.cleartext[::-1], output.getvalue())
+    self.assertEqual(['fd'], self.core.ciphers)
+    self.assertEqual([len(self.cleartext)], self.core.staged)
+    self.assertEqual(0, staging.reserved)
+    self.assertEqual([], os.listdir(staging.directory))
+
+
+  def test_starts_past_what_python_read(self):
+    with open(self.path, 'rb') as fh:
+      fh.readline()
+      position = fh.tell()
+      result = self.engine.encrypt_file(fh, ['recipient'])
+    self.assertEqual(self.cleartext[position:][::-1], result.data)
+
+
+  def test_output_file(self):
+    output = os.path.join(self.directory, 'b')
+    with open(self.path, 'rb') as fh:
+      self.assertTrue(self.engine.encrypt_file(fh, ['recipient'],
+                                               output=output))
+    with open(output, 'rb') as fh:
+      self.assertEqual(self.cleartext[::-1], fh.read())
+
+
+  def test_file_without_descriptor_is_read_in_memory(self):
+    result = self.engine.encrypt_file(StringIO('hello'), ['recipient'])
+    self.assertEqual('olleh', result.data)
+    self.assertEqual(['string'], self.core.plaintexts)
+
+
+  def test_signing_goes_to_wrapped_gpg(self):
+    self.engine.encrypt_file(StringIO('hello'), ['recipient'], sign='key')
+    self.assertEqual(['hello'], self.gpg.encrypted)
+    self.assertEqual([], self.core.plaintexts)
+
+
+  def test_keys_are_looked_up_again_when_the_keyring_changes(self):
+    self.engine.encrypt('hello', 'recipient')
+    self.engine.encrypt('hello', 'recipient')
+    self.assertEqual(1, self.core.num_keylists)
+    self.keyring.stat = (1, 2, 3, 4, 6)
+    self.engine.encrypt('hello', 'recipient')
+    self.assertEqual(2, self.core.num_keylists)
+
+
+  def test_unknown_recipient(self):
+    result = self.engine.encrypt_file(StringIO('hello'), ['nobody'])
+    self.assertFalse(result)
+    self.assertEqual('encryption failed', result.status)
+
+
+  def test_encrypt(self):
+    self.assertEqual('olleh', self.engine.encrypt(u'hello',
+                                                  'recipient').data)
+
+
+class NewEngineTestCase(unittest.TestCase):
+  def test_subprocess_engine_is_the_gpg_itself(self):
+    gpg = FakeGPG()
+    self.assertTrue(new_engine(ENGINE_SUBPROCESS, gpg) is gpg)
+
+
+  def test_unknown_engine(self):
+    self.assertRaises(ValueError, new_engine, 'carrier-pigeon', FakeGPG())
+
+
+  @unittest.skipIf(lockbox.gpgme_engine.core is not None,
+                   'pyme is installed')
+  def test_gpgme_engine_needs_pyme(self):
+    self.assertRaises(ValueError, new_engine, ENGINE_GPGME, FakeGPG())
+
+
+@unittest.skipIf(lockbox.gpgme_engine.core is None, 'pyme is not installed')
+class GpgmeGPGTestCase(unittest.TestCase):
+  def test_passes_other_calls_through(self):
+    self.assertEqual(['key'], GpgmeGPG(FakeGPG()).list_keys())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from lockbox.hash_cache import HashCache, path_stat_key
+from lockbox.master_db_connection import close_pooled_connections
+
+
+class HashCacheTestCase(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.hash_cache = HashCache(os.path.join(self.directory, 'test.db'))
+    self.hash_cache.initialize()
+    self.path = os.path.join(self.directory, 'a')
+    with open(self.path, 'w') as fh:
+      fh.write('hello')
+
+
+  def tearDown(self):
+    close_pooled_connections()
+    shutil.rmtree(self.directory)
+
+
+  def test_store_and_lookup(self):
+    self.assertEqual(None, self.hash_cache.lookup(self.path))
+    key = path_stat_key(self.path)
+    self.hash_cache.store(self.path, key, 'digest')
+    entry = self.hash_cache.lookup(self.path)
+    self.assertEqual(key, entry.stat_key)
+    self.assertEqual('digest', entry.digest)
+
+
+  def test_persists(self):
+    self.hash_cache.store(self.path, path_stat_key(self.path), 'digest')
+    reopened = HashCache(self.hash_cache.database_path)
+    reopened.initialize()
+    self.assertEqual('digest', reopened.lookup(self.path).digest)
+
+
+  def test_stat_key_changes_with_mtime(self):
+    key = path_stat_key(self.path)
+    os.utime(self.path, (0, 12345))
+    self.assertNotEqual(key, path_stat_key(self.path))
+
+
+  def test_missing_file(self):
+    self.assertEqual(None, path_stat_key(self.path + '.missing'))
+    self.hash_cache.store(self.path, None, 'digest')
+    self.assertEqual(None, self.hash_cache.lookup(self.path))
+
+
+  def test_forget(self):
+    self.hash_cache.store(self.path, path_stat_key(self.path), 'digest')
+    self.hash_cache.forget(self.path)
+    self.assertEqual(None, self.hash_cache.lookup(self.path))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+from StringIO import StringIO
+import lockbox.hybrid_crypto
+from lockbox.exception import EncryptedBlobError
+from lockbox.hybrid_crypto import encrypt_stream, decrypt_stream, \
+    is_hybrid, read_path, header_reference, parse_header_reference
+
+
+class FakeResult(object):
+  def __init__(self, data, ok=True):
+    self.data = data
+    self.ok = ok
+    self.status = 'ok' if ok else 'failed'
+
+  def __nonzero__(self):
+    return self.ok
+
+
+class FakeGPG(object):
+  """Wraps by reversing; counts calls."""
+  def __init__(self):
+    self.num_encrypts = 0
+
+  def encrypt(self, data, recipients, always_trust=False, armor=True):
+    self.num_encrypts += 1
+    return FakeResult(data[::-1])
+
+  def decrypt(self, data, always_trust=False, passphrase=None):
+    return FakeResult(data[::-1])
+
+
+@unittest.skipIf(lockbox.hybrid_crypto.M2Crypto is None,
+                 'M2Crypto is not installed')
+class HybridCryptoTestCase(unittest.TestCase):
+  def setUp(self):
+    self.gpg = FakeGPG()
+    self.cleartext = os.urandom(3 * (1 << 20) + 5)
+
+
+  def encrypt(self, cleartext, path=None):
+    blob = StringIO()
+    num_written = encrypt_stream(self.gpg, ['recipient'], StringIO(cleartext),
+                                 blob, path=path)
+    self.assertEqual(len(blob.getvalue()), num_written)
+    return blob.getvalue()
+
+
+  def decrypt(self, blob):
+    cleartext = StringIO()
+    decrypt_stream(self.gpg, StringIO(blob), cleartext)
+    return cleartext.getvalue()
+
+
+  def test_round_trip(self):
+    blob = self.encrypt(self.cleartext)
+    self.assertTrue(is_hybrid(blob))
+    self.assertEqual(1, self.gpg.num_encrypts)
+    self.assertEqual(self.cleartext, self.decrypt(blob))
+
+
+  def test_empty_file(self):
+    self.assertEqual('', self.decrypt(self.encrypt('')))
+
+
+  def test_fresh_key_per_blob(self):
+    self.assertNotEqual(self.encrypt('same'), self.encrypt('same'))
+
+
+  def test_tampered_blob_fails(self):
+    blob = self.encrypt(self.cleartext)
+    for position in [5, len(blob) // 2, len(blob) - 1]:
+      tampered = blob[:position] + chr(ord(blob[position]) ^ 1) + \
+          blob[position + 1:]
+      self.assertRaises(EncryptedBlobError, self.decrypt, tampered)
+
+
+  def test_truncated_blob_fails(self):
+    blob = self.encrypt(self.cleartext)
+    for length in [3, 20, len(blob) - 1]:
+      self.assertRaises(EncryptedBlobError, self.decrypt, blob[:length])
+
+
+  def test_path_in_header(self):
+    blob = self.encrypt(self.cleartext, u'/home/\xe9t\xe9.txt')
+    self.assertEqual(1, self.gpg.num_encrypts)
+    self.assertEqual(u'/home/\xe9t\xe9.txt', read_path(self.gpg,
+                                                      StringIO(blob)))
+    self.assertEqual(self.cleartext, self.decrypt(blob))
+    self.assertEqual(None, read_path(self.gpg,
+                                     StringIO(self.encrypt('delta'))))
+
+
+  def test_reads_version_1_blobs(self):
+    # Version 1 headers are the keys alone.
+    lockbox.hybrid_crypto._VERSION = 1
+    try:
+      blob = self.encrypt(self.cleartext)
+    finally:
+      lockbox.hybrid_crypto._VERSION = 2
+    self.assertEqual(self.cleartext, self.decrypt(blob))
+    self.assertEqual(None, read_path(self.gpg, StringIO(blob)))
+
+
+  def test_header_reference(self):
+    self.assertEqual('abc', parse_header_reference(header_reference('abc')))
+    self.assertEqual(None, parse_header_reference('manifest:abc'))
+
+
+  def test_not_hybrid(self):
+    self.assertFalse(is_hybrid('\x85\x01\x0c'))
+    self.assertRaises(EncryptedBlobError, self.decrypt, 'x' * 100)
+
+
+if __name__ == '__main__':
+  unittest.main()
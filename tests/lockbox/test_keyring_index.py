@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from lockbox.keyring_index import KeyringIndex
+
+
+class FakeGPG(object):
+  def __init__(self, gnupghome):
+    self.gnupghome = gnupghome
+    self.keyring = None
+    self.num_lists = 0
+    self.keys = [
+      {'keyid': 'AAAA', 'fingerprint': 'F' * 40, 'date': '1300000000',
+       'expires': '', 'uids': ['Matt Tierney <tierney@cs.nyu.edu>']},
+      {'keyid': 'BBBB', 'fingerprint': 'E' * 40, 'date': '1300000000',
+       'expires': '1300000001', 'uids': ['Old Key <old@example.com>']},
+      ]
+
+  def list_keys(self, secret=False):
+    self.num_lists += 1
+    return self.keys
+
+
+class KeyringIndexTestCase(unittest.TestCase):
+  def setUp(self):
+    self.gnupghome = tempfile.mkdtemp()
+    self.pubring = os.path.join(self.gnupghome, 'pubring.gpg')
+    with open(self.pubring, 'wb') as pubring:
+      pubring.write('keys')
+    self.gpg = FakeGPG(self.gnupghome)
+    self.keyring = KeyringIndex(self.gpg)
+
+
+  def tearDown(self):
+    shutil.rmtree(self.gnupghome)
+
+
+  def test_finds_pubring(self):
+    self.assertEqual(self.pubring, self.keyring.pubring_path)
+
+
+  def test_lookup_and_search(self):
+    key = self.keyring.lookup('matt tierney <TIERNEY@cs.nyu.edu>')
+    self.assertEqual('AAAA', key.keyid)
+    self.assertEqual(None, key.expires)
+    self.assertEqual([key], self.keyring.search('Tierney'))
+    self.assertEqual(None, self.keyring.lookup('Old Key <old@example.com>'))
+    self.assertEqual([], self.keyring.search('old'))
+    self.assertEqual(['BBBB'], [key.keyid for key in self.keyring.search(
+          'old', include_expired=True)])
+    self.assertEqual({'Matt Tierney <tierney@cs.nyu.edu>': 'AAAA',
+                      'Old Key <old@example.com>': 'BBBB'},
+                     self.keyring.uid_to_keyid())
+    self.assertEqual(1, self.gpg.num_lists)
+
+
+  def test_refreshes_when_keyring_changes(self):
+    self.assertEqual(None, self.keyring.lookup('New Key'))
+    self.gpg.keys = self.gpg.keys + [
+      {'keyid': 'CCCC', 'fingerprint': 'D' * 40, 'date': '1300000000',
+       'expires': str(int(time.time()) + 3600), 'uids': ['New Key']}]
+    self.assertEqual(None, self.keyring.lookup('New Key'))
+    with open(self.pubring, 'ab') as pubring:
+      pubring.write('more keys')
+    self.assertEqual('CCCC', self.keyring.lookup('New Key').keyid)
+    self.assertEqual(2, self.gpg.num_lists)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from lockbox.crypto_util import hash_string
+from lockbox.hash_cache import HashCache, path_stat_key
+import lockbox.local_file_shepherd
+from lockbox.keyring_index import KeyringIndex
+from lockbox.local_file_shepherd import LocalFileShepherd, ShepherdJob, \
+    ShepherdPipeline, SHEPHERD_STATE_READY, SHEPHERD_STATE_SHUTDOWN, \
+    STAGE_SIGNATURE, STAGE_ENCRYPT
+from lockbox.master_db_connection import close_pooled_connections
+from lockbox.staging import StagingArea
+
+
+class FakeMediator(object):
+  def __init__(self, hash_cache=None):
+    self.hash_cache = hash_cache
+    self.woken = threading.Event()
+
+  def checkpoint(self, status_id, stage, outputs):
+    pass
+
+  def wake(self):
+    self.woken.set()
+
+
+class FakePipeline(object):
+  def __init__(self):
+    self.jobs = list()
+    self.skipped = list()
+    self.put_at = None
+    self.received = threading.Event()
+
+  def skip(self, job):
+    self.skipped.append(job)
+    self.received.set()
+
+  def put(self, job):
+    self.put_at = time.time()
+    self.jobs.append(job)
+    self.received.set()
+
+  def fail(self, job, error):
+    self.put(job)
+
+
+class ScanlessShepherd(LocalFileShepherd):
+  def _get_crypto_info(self, job):
+    job.crypto = FakeCrypto()
+
+  def _lookup_previous(self, job):
+    pass
+
+
+class FakeDelta(object):
+  size = 0
+
+
+class FakeCrypto(object):
+  def __init__(self, gate=None):
+    self.gate = gate
+    # (index, key, path) of the chunks sign_and_encrypt() uploads.
+    self.chunks = list()
+    self.hash_of_encrypted_blob = 'blob'
+    self.ascii_signature = 'signature'
+
+  def checkpoint(self):
+    return dict()
+
+  def compute_cleartext_delta(self, signature, path):
+    return FakeDelta()
+
+  def sign_and_encrypt(self, with_path=True, upload_chunk=None):
+    if self.gate:
+      self.gate.wait()
+    for chunk in self.chunks:
+      upload_chunk(*chunk)
+
+  def encrypt_delta_file(self):
+    pass
+
+  def path_in_header(self):
+    return True
+
+  def cleanup(self):
+    pass
+
+
+class FakePipelineMediator(FakeMediator):
+  def __init__(self):
+    FakeMediator.__init__(self)
+    self.done_paths = list()
+    self.all_done = threading.Event()
+
+  def update(self, status_id, state):
+    pass
+
+  def done(self, src_path, status_id):
+    self.done_paths.append(src_path)
+    if len(self.done_paths) == 3:
+      self.all_done.set()
+
+
+class FakeKeyringGPG(object):
+  def __init__(self, keys):
+    self.keys = keys
+
+  def list_keys(self):
+    return self.keys
+
+
+class FakeMetadataStore(object):
+  def local_view_of_previous(self, hash_of_path):
+    return 'previous'
+
+  def lookup_signature(self, hash_of_blob):
+    return 'signature'
+
+  def set_signature(self, hash_of_blob, signature):
+    pass
+
+
+class UploadlessPipeline(ShepherdPipeline):
+  def _upload(self, job):
+    return True
+
+  def _commit(self, job):
+    self._finish(job, 'completed')
+
+
+class ChunkRecordingPipeline(ShepherdPipeline):
+  def _upload_chunk(self, job, index, key, path):
+    self.uploaded_chunks.append((job, index, key, path))
+
+
+class LocalFileShepherdTestCase(unittest.TestCase):
+  def setUp(self):
+    self.mediator = FakeMediator()
+    self.pipeline = FakePipeline()
+    self.shepherd = ScanlessShepherd(self.mediator, self.pipeline, None, None)
+    self.shepherd.daemon = True
+    self.shepherd.start()
+
+
+  def tearDown(self):
+    self.shepherd.shutdown()
+    self.shepherd.join(1)
+
+
+  def test_hand_off_starts_work_immediately(self):
+    assigned_at = time.time()
+    self.assertTrue(self.shepherd.assign(1, assigned_at, 'prepare', 'modified',
+                                         '/tmp/a', ''))
+    self.assertTrue(self.pipeline.received.wait(1))
+    self.assertTrue(self.pipeline.put_at - assigned_at < 0.1)
+    self.assertEqual('/tmp/a', self.pipeline.jobs[0].src_path)
+    self.assertEqual(1, self.pipeline.jobs[0].status_id)
+
+    self.assertTrue(self.mediator.woken.wait(1))
+    self.assertEqual(SHEPHERD_STATE_READY, self.shepherd.get_state())
+    self.assertEqual(None, self.shepherd.claimed())
+
+
+  def test_refuses_work_while_busy(self):
+    self.shepherd.state = 'busy'
+    self.assertFalse(self.shepherd.assign(1, 0, 'prepare', 'modified',
+                                          '/tmp/a', ''))
+    self.assertFalse(self.shepherd.retire())
+
+
+  def test_retire_stops_idle_shepherd(self):
+    self.assertTrue(self.shepherd.retire())
+    self.shepherd.join(1)
+    self.assertFalse(self.shepherd.is_alive())
+    self.assertEqual(SHEPHERD_STATE_SHUTDOWN, self.shepherd.get_state())
+    self.assertFalse(self.shepherd.assign(1, 0, 'prepare', 'modified',
+                                          '/tmp/a', ''))
+
+
+  def test_exiting_shepherd_closes_connections(self):
+    closed = list()
+    saved_close = lockbox.local_file_shepherd.close_pooled_connections
+    lockbox.local_file_shepherd.close_pooled_connections = \
+        lambda: closed.append(threading.current_thread())
+    try:
+      self.assertTrue(self.shepherd.retire())
+      self.shepherd.join(1)
+    finally:
+      lockbox.local_file_shepherd.close_pooled_connections = saved_close
+    self.assertEqual([self.shepherd], closed)
+
+
+  def test_shutdown_finishes_assigned_task(self):
+    self.assertTrue(self.shepherd.assign(1, 0, 'prepare', 'modified',
+                                         '/tmp/a', ''))
+    self.shepherd.shutdown()
+    self.shepherd.join(1)
+    self.assertFalse(self.shepherd.is_alive())
+    self.assertEqual(1, len(self.pipeline.jobs))
+
+
+class UnchangedFileTestCase(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.hash_cache = HashCache(os.path.join(self.directory, 'test.db'))
+    self.hash_cache.initialize()
+    self.path = os.path.join(self.directory, 'a')
+    with open(self.path, 'w') as fh:
+      fh.write('hello')
+    self.hash_cache.store(self.path, path_stat_key(self.path),
+                          hash_string('hello'))
+
+    self.pipeline = FakePipeline()
+    self.shepherd = ScanlessShepherd(FakeMediator(self.hash_cache),
+                                     self.pipeline, None, None)
+    self.shepherd.daemon = True
+    self.shepherd.start()
+
+
+  def tearDown(self):
+    self.shepherd.shutdown()
+    self.shepherd.join(1)
+    close_pooled_connections()
+    shutil.rmtree(self.directory)
+
+
+  def _scan(self, event_type='modified', dest_path=''):
+    self.pipeline.received.clear()
+    self.assertTrue(self.shepherd.assign(1, 0, 'prepare', event_type,
+                                         self.path, dest_path))
+    self.assertTrue(self.pipeline.received.wait(1))
+
+
+  def test_same_stat_is_skipped(self):
+    self._scan()
+    self.assertEqual(1, len(self.pipeline.skipped))
+    self.assertEqual([], self.pipeline.jobs)
+
+
+  def test_touched_file_with_same_bytes_is_skipped(self):
+    os.utime(self.path, (0, 12345))
+    self._scan()
+    self.assertEqual(1, len(self.pipeline.skipped))
+    self.assertEqual(path_stat_key(self.path),
+                     self.hash_cache.lookup(self.path).stat_key)
+
+
+  def test_changed_bytes_are_synced(self):
+    with open(self.path, 'w') as fh:
+      fh.write('goodbye')
+    self._scan()
+    self.assertEqual([], self.pipeline.skipped)
+    self.assertEqual(1, len(self.pipeline.jobs))
+
+
+  def test_deleted_file_is_forgotten(self):
+    # Re-created with the same bytes, size and mtime, it is synced again.
+    stat = os.stat(self.path)
+    os.remove(self.path)
+    self._scan('deleted')
+    self.assertEqual(None, self.hash_cache.lookup(self.path))
+
+    with open(self.path, 'w') as fh:
+      fh.write('hello')
+    os.utime(self.path, (stat.st_atime, stat.st_mtime))
+    self._scan('created')
+    self.assertEqual([], self.pipeline.skipped)
+
+
+  def test_moved_file_is_forgotten(self):
+    dest_path = os.path.join(self.directory, 'b')
+    self.hash_cache.store(dest_path, (0, 0, 0, 0, 0), 'overwritten')
+    os.rename(self.path, dest_path)
+    self._scan('moved', dest_path)
+    self.assertEqual(None, self.hash_cache.lookup(self.path))
+    self.assertEqual(None, self.hash_cache.lookup(dest_path))
+
+
+class PipelineStagingTestCase(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.mediator = FakePipelineMediator()
+    # Smaller than two files: a modification (its delta and its blob) has the
+    # area to itself.
+    self.staging = StagingArea(os.path.join(self.directory, 'staging'),
+                               quota=150)
+    self.pipeline = UploadlessPipeline(
+      self.mediator, None, None, FakeMetadataStore(),
+      pool_sizes={STAGE_SIGNATURE: 2, STAGE_ENCRYPT: 1}, staging=self.staging)
+    self.pipeline.start()
+
+
+  def tearDown(self):
+    # Stage workers are daemons; a deadlocked pipeline is left behind rather
+    # than hanging the suite.
+    if self.mediator.all_done.is_set():
+      self.pipeline.shutdown()
+    shutil.rmtree(self.directory)
+
+
+  def job(self, status_id, event_type, gate=None):
+    path = os.path.join(self.directory, str(status_id))
+    with open(path, 'w') as fh:
+      fh.write('x' * 100)
+    job = ShepherdJob(status_id, 0, event_type, path, '')
+    job.crypto = FakeCrypto(gate)
+    return job
+
+
+  def test_mixed_jobs_over_quota_finish(self):
+    # The first new file holds the only encrypt worker until the modification
+    # and the second new file are queued behind it.
+    gate = threading.Event()
+    jobs = [self.job(1, 'created', gate), self.job(2, 'modified'),
+            self.job(3, 'created')]
+    putter = threading.Thread(target=map, args=(self.pipeline.put, jobs))
+    putter.daemon = True
+    putter.start()
+    time.sleep(0.1)
+    # The modification waits for room before entering the pipeline.
+    self.assertEqual(100, self.staging.reserved)
+    gate.set()
+    self.assertTrue(self.mediator.all_done.wait(5))
+    self.assertEqual([job.src_path for job in jobs], self.mediator.done_paths)
+    self.assertEqual(0, self.staging.reserved)
+
+
+class EncryptStageTestCase(unittest.TestCase):
+  def test_chunks_are_uploaded_as_they_are_encrypted(self):
+    pipeline = ChunkRecordingPipeline(FakePipelineMediator(), None, None,
+                                      FakeMetadataStore())
+    pipeline.uploaded_chunks = list()
+    job = ShepherdJob(1, 0, 'created', '/tmp/a', '')
+    job.crypto = FakeCrypto()
+    job.crypto.chunks = [(0, 'id.0', '/tmp/0'), (1, 'id.1', '/tmp/1')]
+    job.updater = 'made while encrypting'
+    self.assertTrue(pipeline._encrypt(job))
+    self.assertEqual([(job, 0, 'id.0', '/tmp/0'), (job, 1, 'id.1', '/tmp/1')],
+                     pipeline.uploaded_chunks)
+    self.assertEqual(None, job.updater)
+
+
+class LookupRecipientsTestCase(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.pubring = os.path.join(self.directory, 'pubring.gpg')
+    with open(self.pubring, 'wb') as pubring:
+      pubring.write('keys')
+    self.mediator = FakeMediator()
+    self.shepherd = LocalFileShepherd(self.mediator, None, None, None)
+
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+
+  def keyring(self, uids):
+    return KeyringIndex(FakeKeyringGPG(
+        [{'keyid': str(index), 'fingerprint': str(index) * 40,
+          'date': '1300000000', 'expires': '', 'uids': [uid]}
+         for index, uid in enumerate(uids)]), self.pubring)
+
+
+  def test_exact_uid(self):
+    self.mediator.keyring = self.keyring([
+        'Matt Tierney <matt@example.com>',
+        'Not Matt Tierney <tierney@example.com>',
+        'Matt Tierney <tierney@cs.nyu.edu>'])
+    self.assertEqual(['2' * 40], self.shepherd._lookup_recipients())
+
+
+  def test_no_key_with_uid(self):
+    self.mediator.keyring = self.keyring(['Matt Tierney <matt@example.com>'])
+    self.assertEqual(['"Matt Tierney <tierney@cs.nyu.edu>"'],
+                     self.shepherd._lookup_recipients())
+
+
+if __name__ == '__main__':
+  unittest.main()
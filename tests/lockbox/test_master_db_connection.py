@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from lockbox.master_db_connection import MasterDBConnection, \
+    close_pooled_connections, SYNCHRONOUS_FULL
+
+
+class MasterDBConnectionTestCase(unittest.TestCase):
+  def setUp(self):
+    self.database_directory = tempfile.mkdtemp()
+    self.database_path = os.path.join(self.database_directory, 'test.db')
+    with MasterDBConnection(self.database_path) as cursor:
+      cursor.execute('CREATE TABLE items(name text)')
+
+
+  def tearDown(self):
+    close_pooled_connections()
+    shutil.rmtree(self.database_directory)
+
+
+  def test_reuses_connection(self):
+    with MasterDBConnection(self.database_path) as cursor:
+      first = cursor.connection
+    with MasterDBConnection(self.database_path) as cursor:
+      self.assertTrue(cursor.connection is first)
+
+
+  def test_wal_journal(self):
+    with MasterDBConnection(self.database_path) as cursor:
+      journal_mode = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+    self.assertEqual('wal', journal_mode.lower())
+
+
+  def test_synchronous_level(self):
+    with MasterDBConnection(self.database_path,
+                            synchronous=SYNCHRONOUS_FULL) as cursor:
+      # FULL is 2.
+      self.assertEqual(2, cursor.execute('PRAGMA synchronous').fetchone()[0])
+
+
+  def test_nested_blocks_use_separate_connections(self):
+    with MasterDBConnection(self.database_path) as outer:
+      outer.execute('INSERT INTO items(name) VALUES ("outer")')
+      with MasterDBConnection(self.database_path) as inner:
+        self.assertFalse(inner.connection is outer.connection)
+
+
+  def test_rollback_on_error(self):
+    try:
+      with MasterDBConnection(self.database_path) as cursor:
+        cursor.execute('INSERT INTO items(name) VALUES ("lost")')
+        raise ValueError
+    except ValueError:
+      pass
+    with MasterDBConnection(self.database_path) as cursor:
+      count = cursor.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+    self.assertEqual(0, count)
+
+
+if __name__ == '__main__':
+  unittest.main()
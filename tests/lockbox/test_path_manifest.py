@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import unittest
+from binascii import a2b_base64
+from lockbox.crypto_util import hash_string
+from lockbox.path_manifest import PathPublisher, lookup_manifest, \
+    parse_path_reference, manifest_reference
+
+
+class FakeResult(object):
+  def __init__(self, data, ok=True):
+    self.data = data
+    self.ok = ok
+    self.status = 'ok' if ok else 'failed'
+
+  def __nonzero__(self):
+    return self.ok
+
+
+class FakeGPG(object):
+  """Encrypts by reversing; records each call's recipients."""
+  def __init__(self, ok=True):
+    self.ok = ok
+    self.recipients = list()
+
+  def encrypt(self, data, recipients, always_trust=False, armor=True):
+    self.recipients.append(recipients)
+    return FakeResult(data[::-1], self.ok)
+
+
+class FakeBlobStore(object):
+  def __init__(self):
+    self.blobs = dict()
+
+  def put_string(self, key, string):
+    self.blobs[key] = string
+
+
+class FakeCrypto(object):
+  def __init__(self, file_path, recipients):
+    self.file_path = file_path
+    self.hash_of_file_path = hash_string(file_path)
+    self.recipients = recipients
+
+
+class FakeJob(object):
+  def __init__(self, file_path, recipients=('recipient',)):
+    self.crypto = FakeCrypto(file_path, list(recipients))
+
+
+class PathPublisherTestCase(unittest.TestCase):
+  def setUp(self):
+    self.gpg = FakeGPG()
+    self.blob_store = FakeBlobStore()
+    self.published = list()
+    self.failed = list()
+    self.publisher = PathPublisher(
+      self.gpg, self.blob_store,
+      lambda job, reference: self.published.append((job, reference)),
+      lambda job, error: self.failed.append(job))
+
+
+  def manifest(self, reference):
+    manifest_key = parse_path_reference(reference)
+    return a2b_base64(self.blob_store.blobs[manifest_key])[::-1]
+
+
+  def test_one_manifest_per_batch(self):
+    jobs = [FakeJob('/a/%d' % i) for i in range(5)]
+    for job in jobs:
+      self.publisher.put(job)
+    self.assertEqual(5, self.publisher.flush())
+
+    self.assertEqual(1, len(self.gpg.recipients))
+    self.assertEqual(1, len(self.blob_store.blobs))
+    self.assertEqual(jobs, [job for job, reference in self.published])
+    for job, reference in self.published:
+      self.assertEqual(job.crypto.file_path,
+                       lookup_manifest(self.manifest(reference),
+                                       job.crypto.hash_of_file_path))
+
+
+  def test_manifest_per_recipients(self):
+    self.publisher.put(FakeJob('/a', ['alice']))
+    self.publisher.put(FakeJob('/b', ['bob']))
+    self.publisher.put(FakeJob('/c', ['alice']))
+    self.publisher.flush()
+
+    self.assertEqual(2, len(self.blob_store.blobs))
+    self.assertEqual(sorted([['alice'], ['bob']]), sorted(self.gpg.recipients))
+    references = dict((job.crypto.file_path, reference)
+                      for job, reference in self.published)
+    self.assertEqual(references['/a'], references['/c'])
+    self.assertNotEqual(references['/a'], references['/b'])
+    self.assertEqual(None, lookup_manifest(self.manifest(references['/b']),
+                                           hash_string('/a')))
+
+
+  def test_failed_encryption_fails_jobs(self):
+    self.gpg.ok = False
+    job = FakeJob('/a')
+    self.publisher.put(job)
+    self.publisher.flush()
+    self.assertEqual([job], self.failed)
+    self.assertEqual([], self.published)
+    self.assertEqual({}, self.blob_store.blobs)
+
+
+  def test_failed_callback_fails_only_its_job(self):
+    jobs = [FakeJob('/a/%d' % i) for i in range(3)]
+    def published(job, reference):
+      if job is jobs[1]:
+        raise IOError('database is locked')
+      self.published.append((job, reference))
+    self.publisher.published_callback = published
+    for job in jobs:
+      self.publisher.put(job)
+    self.assertEqual(3, self.publisher.flush())
+    self.assertEqual([jobs[0], jobs[2]],
+                     [job for job, reference in self.published])
+    self.assertEqual([jobs[1]], self.failed)
+
+
+  def test_background_flush(self):
+    self.publisher = PathPublisher(
+      self.gpg, self.blob_store,
+      lambda job, reference: self.published.append((job, reference)),
+      lambda job, error: self.failed.append(job), flush_count=2)
+    self.publisher.start()
+    self.publisher.put(FakeJob('/a'))
+    self.publisher.put(FakeJob('/b'))
+    self.publisher.put(FakeJob('/c'))
+    self.publisher.stop()
+    self.publisher.join()
+    self.assertEqual(3, len(self.published))
+
+
+class PathReferenceTestCase(unittest.TestCase):
+  def test_parse(self):
+    self.assertEqual('abc', parse_path_reference(manifest_reference('abc')))
+    self.assertEqual(None, parse_path_reference(hash_string('path blob')))
+
+
+if __name__ == '__main__':
+  unittest.main()
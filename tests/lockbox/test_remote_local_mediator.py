@@ -2,14 +2,72 @@
 
 import boto
 import os
+import shutil
 import tempfile
 import time
 import unittest
+from lockbox.local_file_shepherd import SHEPHERD_STATE_READY, \
+    SHEPHERD_STATE_SHUTDOWN, ShepherdJob, STAGE_SCAN, STAGE_ENCRYPT
+from lockbox.file_update_crypto import FileUpdateCrypto
+from lockbox.master_db_connection import MasterDBConnection
 from lockbox.remote_local_mediator import RemoteLocalMediator
+from lockbox.scheduling import ShortestJobFirstPolicy
+from lockbox.staging import StagingArea, new_file
 
 import lockbox.file_change_status
 from lockbox.file_change_status import FileChangeStatus
-from watchdog.events import FileMovedEvent
+from lockbox.file_change_status import coalesce_event_types
+from watchdog.events import FileMovedEvent, FileModifiedEvent, \
+    FileCreatedEvent, FileDeletedEvent, EVENT_TYPE_CREATED, \
+    EVENT_TYPE_MODIFIED, EVENT_TYPE_DELETED, EVENT_TYPE_MOVED
+
+
+class FakeShepherd(object):
+  def __init__(self):
+    self.state = SHEPHERD_STATE_READY
+    self.ident = id(self)
+    self.assigned = list()
+    self.status_ids = list()
+
+  def get_state(self):
+    return self.state
+
+  def assign(self, status_id, timestamp, state, event_type, src_path,
+             dest_path):
+    if self.state != SHEPHERD_STATE_READY:
+      return False
+    self.assigned.append(src_path)
+    self.status_ids.append(status_id)
+    self.state = 'busy'
+    return True
+
+  def retire(self):
+    if self.state != SHEPHERD_STATE_READY:
+      return False
+    self.state = SHEPHERD_STATE_SHUTDOWN
+    return True
+
+
+class FakePipeline(object):
+  def __init__(self):
+    self.resumed = list()
+
+  def resume(self, job, completed_stage):
+    self.resumed.append((job.src_path, completed_stage))
+
+
+class StagingPipeline(FakePipeline):
+  """Stages a new file for each job it resumes, as its stages would."""
+  def __init__(self, staging_dir):
+    FakePipeline.__init__(self)
+    self.staging_dir = staging_dir
+    self.staged = list()
+
+  def resume(self, job, completed_stage):
+    FakePipeline.resume(self, job, completed_stage)
+    with new_file(self.staging_dir) as staged:
+      self.staged.append(staged.name)
+
 
 class RemoteLocalMediatorTestCase(unittest.TestCase):
   def setUp(self):
@@ -40,5 +98,329 @@ class RemoteLocalMediatorTestCase(unittest.TestCase):
       self.assertIsInstance(file_change_status, FileChangeStatus)
 
 
+class RemoteLocalMediatorDispatchTestCase(unittest.TestCase):
+  def setUp(self):
+    self.database_directory = tempfile.mkdtemp()
+    self.mediator = RemoteLocalMediator(None, None, None,
+                                        self.database_directory, 'test.db',
+                                        settle_window=0)
+    self.mediator._initialize_queue()
+    self.mediator.shepherds = [FakeShepherd(), FakeShepherd()]
+
+
+  def tearDown(self):
+    shutil.rmtree(self.database_directory)
+
+
+  def test_flush_signals_dispatcher(self):
+    self.mediator._work_available.clear()
+    self.assertTrue(self.mediator.enqueue(FileModifiedEvent('/tmp/a')))
+    self.assertEqual([], self.mediator._list_queue())
+    self.assertEqual(1, self.mediator.flush())
+    self.assertEqual(1, len(self.mediator._list_queue()))
+    self.assertTrue(self.mediator._work_available.is_set())
+
+
+  def test_dispatch_fills_every_ready_shepherd(self):
+    for src_path in ['/tmp/a', '/tmp/a', '/tmp/b', '/tmp/c']:
+      self.mediator.enqueue(FileModifiedEvent(src_path))
+    self.mediator.flush()
+
+    self.assertEqual(2, self.mediator._dispatch())
+    self.assertEqual(['/tmp/a'], self.mediator.shepherds[0].assigned)
+    self.assertEqual(['/tmp/b'], self.mediator.shepherds[1].assigned)
+    self.assertEqual(0, self.mediator._dispatch())
+
+
+  def test_done_releases_file_and_signals(self):
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual(1, self.mediator._dispatch())
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual(0, self.mediator._dispatch())
+
+    shepherd = self.mediator.shepherds[0]
+    shepherd.state = SHEPHERD_STATE_READY
+    self.mediator._work_available.clear()
+    self.mediator.done('/tmp/a', shepherd.status_ids[0])
+    self.assertTrue(self.mediator._work_available.is_set())
+    self.assertEqual(1, self.mediator._dispatch())
+
+
+  def test_dispatch_leases_path(self):
+    self.mediator.enqueue(FileMovedEvent('/tmp/a', '/tmp/b'))
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual(1, self.mediator._dispatch())
+    leases = self.mediator._list_leases()
+    self.assertEqual(1, len(leases))
+    self.assertEqual('/tmp/a', leases[0]['src_path'])
+    self.assertEqual(0, self.mediator._dispatch())
+
+
+  def test_dispatch_handles_quoted_paths(self):
+    src_path = '/tmp/say "hello" it\'s me'
+    self.mediator.enqueue(FileModifiedEvent(src_path))
+    self.mediator.flush()
+    self.assertEqual(1, self.mediator._dispatch())
+    self.mediator.done(src_path, self.mediator.shepherds[0].status_ids[0])
+    self.assertEqual([], self.mediator._list_leases())
+
+
+  def test_requeue_releases_row(self):
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual(1, self.mediator._dispatch())
+    self.assertEqual(0, self.mediator.backlog())
+    status_id = self.mediator.shepherds[0].status_ids[0]
+    self.mediator.requeue(status_id, '/tmp/a')
+    self.assertEqual([], self.mediator._list_leases())
+    self.assertEqual(1, self.mediator.backlog())
+    self.assertEqual(1, self.mediator._dispatch())
+
+
+  def test_initialize_queue_drops_stale_leases(self):
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual(1, self.mediator._dispatch())
+    self.mediator._initialize_queue()
+    self.assertEqual([], self.mediator._list_leases())
+
+
+  def test_coalesce_burst_into_one_row(self):
+    self.mediator.enqueue(FileCreatedEvent('/tmp/a'))
+    for _ in range(10):
+      self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    queue = self.mediator._list_queue()
+    self.assertEqual(1, len(queue))
+    self.assertEqual(EVENT_TYPE_CREATED, queue[0]['event_type'])
+
+
+  def test_coalesce_create_then_delete_drops_row(self):
+    self.mediator.enqueue(FileCreatedEvent('/tmp/a'))
+    self.mediator.enqueue(FileDeletedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual([], self.mediator._list_queue())
+
+
+  def test_does_not_coalesce_into_assigned_row(self):
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual(1, self.mediator._dispatch())
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual(2, len(self.mediator._list_queue()))
+
+
+  def test_dispatch_requeues_rows_refused_by_retired_shepherd(self):
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    ready_shepherds = self.mediator._ready_shepherds
+    def retire_after_picking():
+      shepherds = ready_shepherds()
+      for shepherd in shepherds:
+        shepherd.retire()
+      return shepherds
+    self.mediator._ready_shepherds = retire_after_picking
+    self.assertEqual(1, self.mediator._dispatch())
+    self.assertEqual([], self.mediator._list_leases())
+    self.assertEqual(1, self.mediator.backlog())
+
+
+  def test_dispatch_prefers_small_files(self):
+    big_path = os.path.join(self.database_directory, 'big')
+    small_path = os.path.join(self.database_directory, 'small')
+    with open(big_path, 'w') as big:
+      big.write('x' * (1 << 20))
+    with open(small_path, 'w') as small:
+      small.write('x')
+    self.mediator.shepherds = [FakeShepherd()]
+    self.mediator.enqueue(FileModifiedEvent(big_path))
+    self.mediator.enqueue(FileModifiedEvent(small_path))
+    self.mediator.flush()
+    self.assertEqual(1, self.mediator._dispatch())
+    self.assertEqual([small_path], self.mediator.shepherds[0].assigned)
+
+
+  def test_rows_for_one_file_run_in_order(self):
+    # A newer, smaller row for a file must not overtake its older row, even
+    # under shortest job first.
+    self.mediator.scheduling_policy = ShortestJobFirstPolicy()
+    self.mediator.shepherds = [FakeShepherd()]
+    now = time.time() - 1
+    with MasterDBConnection(self.mediator.database_path) as cursor:
+      for event_type, src_path, size in [
+          (EVENT_TYPE_CREATED, '/tmp/a', 1 << 20),
+          (EVENT_TYPE_MODIFIED, '/tmp/a', 1),
+          (EVENT_TYPE_MODIFIED, '/tmp/b', 100)]:
+        cursor.execute('INSERT INTO queue(timestamp, state, event_type, '
+                       'src_path, dest_path, size) '
+                       'VALUES (?, "prepare", ?, ?, "", ?)',
+                       (now, event_type, src_path, size))
+    rowids = [row['id'] for row in self.mediator._list_queue()]
+
+    self.assertEqual(1, self.mediator._dispatch())
+    self.assertEqual(['/tmp/b'], self.mediator.shepherds[0].assigned)
+    self.mediator.shepherds = [FakeShepherd()]
+    self.assertEqual(1, self.mediator._dispatch())
+    self.assertEqual([rowids[0]], self.mediator.shepherds[0].status_ids)
+
+    # Only once the created row is done does the modified one go.
+    self.mediator.done('/tmp/a', rowids[0])
+    self.mediator.shepherds = [FakeShepherd()]
+    self.assertEqual(1, self.mediator._dispatch())
+    self.assertEqual([rowids[1]], self.mediator.shepherds[0].status_ids)
+
+
+  def test_fair_share_between_watched_directories(self):
+    self.mediator.directories = ['/bulk', '/docs']
+    for src_path in ['/bulk/1', '/bulk/2', '/docs/a']:
+      self.mediator.enqueue(FileModifiedEvent(src_path))
+    self.mediator.flush()
+    self.assertEqual(2, self.mediator._dispatch())
+    self.assertEqual(['/bulk/1'], self.mediator.shepherds[0].assigned)
+    self.assertEqual(['/docs/a'], self.mediator.shepherds[1].assigned)
+
+
+  def test_settle_window_holds_recent_rows(self):
+    self.mediator.settle_window = 60
+    self.mediator.enqueue(FileModifiedEvent('/tmp/a'))
+    self.mediator.flush()
+    self.assertEqual(0, self.mediator._dispatch())
+    self.assertTrue(0 < self.mediator._dispatch_timeout() <= 60)
+
+
+class RemoteLocalMediatorResumeTestCase(unittest.TestCase):
+  def setUp(self):
+    self.database_directory = tempfile.mkdtemp()
+    self.mediator = RemoteLocalMediator(None, None, None,
+                                        self.database_directory, 'test.db',
+                                        settle_window=0)
+    self.mediator._initialize_queue()
+    self.mediator.shepherds = [FakeShepherd()]
+    self.mediator.pipeline = FakePipeline()
+
+    self.src_path = os.path.join(self.database_directory, 'a')
+    with open(self.src_path, 'w') as src:
+      src.write('hello')
+    self.mediator.enqueue(FileModifiedEvent(self.src_path))
+    self.mediator.flush()
+    self.assertEqual(1, self.mediator._dispatch())
+    self.status_id = self.mediator.shepherds[0].status_ids[0]
+
+
+  def tearDown(self):
+    shutil.rmtree(self.database_directory)
+
+
+  def _checkpoint(self, stage, crypto=None):
+    job = ShepherdJob(self.status_id, time.time(), EVENT_TYPE_MODIFIED,
+                      self.src_path, None)
+    job.record_source()
+    job.crypto = crypto or FileUpdateCrypto(None, self.src_path, ['recipient'])
+    self.mediator.checkpoint(self.status_id, stage, job.checkpoint())
+
+
+  def _restart(self):
+    self.mediator._initialize_queue()
+    return self.mediator._resume()
+
+
+  def test_resumes_after_checkpointed_stage(self):
+    self._checkpoint(STAGE_ENCRYPT)
+    self.assertEqual(1, self._restart())
+    self.assertEqual([(self.src_path, STAGE_ENCRYPT)],
+                     self.mediator.pipeline.resumed)
+    leases = self.mediator._list_leases()
+    self.assertEqual(1, len(leases))
+    self.assertEqual(self.status_id, leases[0]['queue_id'])
+    self.assertEqual(0, self.mediator.backlog())
+
+
+  def test_sweeps_staged_files_no_row_needs(self):
+    staging_dir = os.path.join(self.database_directory, 'staging')
+    self.mediator.staging = StagingArea(staging_dir)
+    crypto = FileUpdateCrypto(None, self.src_path, ['recipient'])
+    with new_file(staging_dir) as blob:
+      crypto.path_to_encrypted_blob = blob.name
+    with new_file(staging_dir) as orphan:
+      pass
+    self._checkpoint(STAGE_ENCRYPT, crypto)
+
+    self.assertEqual(1, self._restart())
+    self.assertTrue(os.path.exists(crypto.path_to_encrypted_blob))
+    self.assertFalse(os.path.exists(orphan.name))
+
+
+  def test_sweep_spares_files_of_resumed_jobs(self):
+    staging_dir = os.path.join(self.database_directory, 'staging')
+    self.mediator.staging = StagingArea(staging_dir)
+    self.mediator.pipeline = StagingPipeline(staging_dir)
+    self._checkpoint(STAGE_ENCRYPT)
+
+    self.assertEqual(1, self._restart())
+    self.assertEqual(1, len(self.mediator.pipeline.staged))
+    self.assertTrue(os.path.exists(self.mediator.pipeline.staged[0]))
+
+
+  def test_restarts_rows_without_checkpoint(self):
+    self.assertEqual(0, self._restart())
+    self.assertEqual([], self.mediator.pipeline.resumed)
+    self.assertEqual(1, self.mediator.backlog())
+
+
+  def test_restarts_rows_whose_source_changed(self):
+    self._checkpoint(STAGE_SCAN)
+    with open(self.src_path, 'a') as src:
+      src.write(' world')
+    self.assertEqual(0, self._restart())
+    self.assertEqual(1, self.mediator.backlog())
+    self.assertEqual(0, self._restart())
+
+
+  def test_done_forgets_checkpoint(self):
+    self._checkpoint(STAGE_ENCRYPT)
+    self.mediator.update(self.status_id, 'completed')
+    self.mediator.done(self.src_path, self.status_id)
+    self.assertEqual(0, self._restart())
+    self.assertEqual(0, self.mediator.backlog())
+
+
+  def test_requeue_forgets_checkpoint(self):
+    self._checkpoint(STAGE_ENCRYPT)
+    self.mediator.requeue(self.status_id, self.src_path)
+    self.mediator.shepherds[0].state = SHEPHERD_STATE_READY
+    self.assertEqual(1, self.mediator._dispatch())
+    self.assertEqual(0, self._restart())
+    self.assertEqual(1, self.mediator.backlog())
+
+
+class CoalesceEventTypesTestCase(unittest.TestCase):
+  def test_created_absorbs_modified(self):
+    self.assertEqual(EVENT_TYPE_CREATED,
+                     coalesce_event_types(EVENT_TYPE_CREATED,
+                                          EVENT_TYPE_MODIFIED))
+
+
+  def test_created_then_deleted_cancels(self):
+    self.assertEqual(None, coalesce_event_types(EVENT_TYPE_CREATED,
+                                                EVENT_TYPE_DELETED))
+
+
+  def test_deleted_then_created_is_modified(self):
+    self.assertEqual(EVENT_TYPE_MODIFIED,
+                     coalesce_event_types(EVENT_TYPE_DELETED,
+                                          EVENT_TYPE_CREATED))
+
+
+  def test_moves_are_not_merged(self):
+    self.assertFalse(coalesce_event_types(EVENT_TYPE_MOVED,
+                                          EVENT_TYPE_MODIFIED))
+    self.assertFalse(coalesce_event_types(EVENT_TYPE_MODIFIED,
+                                          EVENT_TYPE_MOVED))
+
+
 if __name__=='__main__':
   unittest.main()
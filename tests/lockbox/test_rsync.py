@@ -59,5 +59,40 @@ class RSyncTestCase(unittest.TestCase):
       print "not assuming bytes means str"
       assert str(patcheddata, 'ascii') == hostdata
 
+  def delta(self, old, new, blocksize):
+    from StringIO import StringIO
+    delta = rsyncdelta(StringIO(new), blockchecksums(StringIO(old), blocksize),
+                       blocksize)
+    patched = StringIO()
+    patchstream(StringIO(old), patched, delta)
+    self.assertEqual(new, patched.getvalue())
+    return delta
+
+  def test_reordered_blocks(self):
+    blocks = [chr(65 + i) * 16 for i in range(8)]
+    new = ''.join(reversed(blocks))
+    self.assertEqual([16, 7, 6, 5, 4, 3, 2, 1, 0],
+                     self.delta(''.join(blocks), new, 16))
+
+  def test_same_weak_checksum(self):
+    # Blocks with the same weak checksum but different contents.
+    first, second = '\x01\x00\x00\x01', '\x00\x01\x01\x00'
+    self.assertEqual([4, 1, 0], self.delta(first + second,
+                                           second + first, 4))
+    self.assertEqual([4, 1, 1], self.delta(first + second,
+                                           second + second, 4))
+
+  def test_repeated_blocks_in_order(self):
+    old = 'x' * 16 * 4
+    self.assertEqual([16, 0, 1, 2, 3], self.delta(old, old, 16))
+
+  def test_inserted_data(self):
+    old = ''.join(chr(random.randint(0, 255)) for _ in range(1 << 14))
+    new = old[:5000] + 'inserted' + old[5000:]
+    delta = self.delta(old, new, 1024)
+    # Only the block holding the insertion is sent as data.
+    self.assertEqual(range(4) + range(5, 16), [element for element in delta[1:]
+                                 if isinstance(element, int)])
+
 if __name__ == '__main__':
   unittest.main()
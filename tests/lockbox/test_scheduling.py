@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import unittest
+from lockbox.scheduling import QueuedRow, FifoPolicy, ShortestJobFirstPolicy, \
+    FairSharePolicy
+
+_NOW = 1000.
+
+
+def row(rowid, src_path, size, waited=0.):
+  return QueuedRow(rowid, _NOW - waited, 'prepare', 'modified', src_path, '',
+                   size)
+
+
+def paths(rows):
+  return [row.src_path for row in rows]
+
+
+class FifoPolicyTestCase(unittest.TestCase):
+  def test_oldest_first(self):
+    rows = [row(1, '/a', 10, waited=1), row(2, '/b', 1, waited=5)]
+    self.assertEqual(['/b', '/a'], paths(FifoPolicy().order(rows, _NOW, [])))
+
+
+class ShortestJobFirstPolicyTestCase(unittest.TestCase):
+  def test_smallest_first(self):
+    rows = [row(1, '/vm.img', 20 << 30, waited=10), row(2, '/doc', 4096)]
+    self.assertEqual(['/doc', '/vm.img'],
+                     paths(ShortestJobFirstPolicy().order(rows, _NOW, [])))
+
+
+  def test_ties_go_to_oldest(self):
+    rows = [row(1, '/a', 0, waited=1), row(2, '/b', 0, waited=2)]
+    self.assertEqual(['/b', '/a'],
+                     paths(ShortestJobFirstPolicy().order(rows, _NOW, [])))
+
+
+  def test_aging_lets_large_files_through(self):
+    # 2**10 times larger, but waited 11 half lives.
+    rows = [row(1, '/big', 1 << 20, waited=11 * 60), row(2, '/small', 1 << 10)]
+    policy = ShortestJobFirstPolicy(aging_half_life=60)
+    self.assertEqual(['/big', '/small'], paths(policy.order(rows, _NOW, [])))
+    policy = ShortestJobFirstPolicy(aging_half_life=None)
+    self.assertEqual(['/small', '/big'], paths(policy.order(rows, _NOW, [])))
+
+
+class FairSharePolicyTestCase(unittest.TestCase):
+  def test_alternates_between_groups(self):
+    rows = [row(1, '/bulk/1', 1), row(2, '/bulk/2', 2), row(3, '/bulk/3', 3),
+            row(4, '/docs/a', 100), row(5, '/docs/b', 200)]
+    self.assertEqual(['/bulk/1', '/docs/a', '/bulk/2', '/docs/b', '/bulk/3'],
+                     paths(FairSharePolicy().order(rows, _NOW, [])))
+
+
+  def test_favors_groups_with_less_in_flight(self):
+    rows = [row(1, '/bulk/1', 1), row(2, '/docs/a', 100)]
+    in_flight = ['/bulk/0', '/bulk/00']
+    self.assertEqual(['/docs/a', '/bulk/1'],
+                     paths(FairSharePolicy().order(rows, _NOW, in_flight)))
+
+
+  def test_group_key(self):
+    rows = [row(1, '/home/a/x/1', 1), row(2, '/home/a/y/2', 2),
+            row(3, '/home/b/3', 3)]
+    policy = FairSharePolicy(FifoPolicy(),
+                             group_key=lambda path: path.split('/')[2])
+    self.assertEqual(['/home/a/x/1', '/home/b/3', '/home/a/y/2'],
+                     paths(policy.order(rows, _NOW, [])))
+
+
+if __name__ == '__main__':
+  unittest.main()
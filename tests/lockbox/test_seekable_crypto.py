@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import unittest
+from StringIO import StringIO
+import lockbox.hybrid_crypto
+from lockbox.exception import EncryptedBlobError
+from lockbox.seekable_crypto import SeekableBlob, encrypt_stream, \
+    decrypt_stream, is_seekable, stored_segment_size
+
+
+class FakeResult(object):
+  def __init__(self, data, ok=True):
+    self.data = data
+    self.ok = ok
+    self.status = 'ok' if ok else 'failed'
+
+  def __nonzero__(self):
+    return self.ok
+
+
+class FakeGPG(object):
+  """Wraps by reversing."""
+  def encrypt(self, data, recipients, always_trust=False, armor=True):
+    return FakeResult(data[::-1])
+
+  def decrypt(self, data, always_trust=False, passphrase=None):
+    return FakeResult(data[::-1])
+
+
+_SEGMENT_SIZE = 64
+
+
+@unittest.skipIf(lockbox.hybrid_crypto.M2Crypto is None,
+                 'M2Crypto is not installed')
+class SeekableCryptoTestCase(unittest.TestCase):
+  def setUp(self):
+    self.gpg = FakeGPG()
+    self.cleartext = os.urandom(10 * _SEGMENT_SIZE + 5)
+    self.num_reads = 0
+
+
+  def encrypt(self, cleartext):
+    blob = StringIO()
+    num_written = encrypt_stream(self.gpg, ['recipient'], StringIO(cleartext),
+                                 blob, segment_size=_SEGMENT_SIZE)
+    self.assertEqual(len(blob.getvalue()), num_written)
+    return blob.getvalue()
+
+
+  def decrypt(self, blob):
+    cleartext = StringIO()
+    decrypt_stream(self.gpg, StringIO(blob), cleartext)
+    return cleartext.getvalue()
+
+
+  def open(self, blob):
+    def read_range(offset, length):
+      self.num_reads += 1
+      return blob[offset:offset + length]
+    return SeekableBlob(self.gpg, read_range, len(blob))
+
+
+  def encrypt_segments(self, num_segments):
+    """Returns the cleartext, the blob and where its first segment starts."""
+    cleartext = os.urandom(num_segments * _SEGMENT_SIZE)
+    stored = self.encrypt(cleartext)
+    return cleartext, stored, \
+        len(stored) - num_segments * stored_segment_size(_SEGMENT_SIZE)
+
+
+  def test_round_trip(self):
+    for cleartext in ['', 'short', os.urandom(3 * _SEGMENT_SIZE),
+                      self.cleartext]:
+      blob = self.encrypt(cleartext)
+      self.assertTrue(is_seekable(blob))
+      self.assertEqual(cleartext, self.decrypt(blob))
+      self.assertEqual(len(cleartext), self.open(blob).size())
+
+
+  def test_ranged_reads(self):
+    blob = self.open(self.encrypt(self.cleartext))
+    self.assertEqual(11, blob.num_segments)
+    for offset, length in [(0, 1), (63, 2), (100, 300), (640, 100),
+                           (0, len(self.cleartext)), (700, 10), (5, 0)]:
+      self.num_reads = 0
+      self.assertEqual(self.cleartext[offset:offset + length],
+                       blob.read(offset, length))
+      self.assertTrue(self.num_reads <= 1)
+
+
+  def test_parallel_reads(self):
+    pool = multiprocessing.Pool(2)
+    try:
+      blob = self.open(self.encrypt(self.cleartext))
+      self.assertEqual(self.cleartext[10:600], blob.read(10, 590, pool))
+    finally:
+      pool.terminate()
+
+
+  def test_tampered_segment_fails_alone(self):
+    cleartext, stored, start = self.encrypt_segments(8)
+    position = start + 5 * stored_segment_size(_SEGMENT_SIZE) + 40
+    tampered = stored[:position] + chr(ord(stored[position]) ^ 1) + \
+        stored[position + 1:]
+    self.assertRaises(EncryptedBlobError, self.decrypt, tampered)
+    blob = self.open(tampered)
+    self.assertEqual(cleartext[:5 * _SEGMENT_SIZE],
+                     blob.read(0, 5 * _SEGMENT_SIZE))
+    blob.verify_segment(4)
+    self.assertRaises(EncryptedBlobError, blob.verify_segment, 5)
+
+
+  def test_tampered_header_fails(self):
+    stored = self.encrypt(self.cleartext)
+    tampered = stored[:5] + chr(ord(stored[5]) ^ 1) + stored[6:]
+    self.assertRaises(EncryptedBlobError, self.open, tampered)
+
+
+  def test_reordered_segments_fail(self):
+    cleartext, stored, start = self.encrypt_segments(4)
+    size = stored_segment_size(_SEGMENT_SIZE)
+    swapped = stored[:start] + stored[start + size:start + 2 * size] + \
+        stored[start:start + size] + stored[start + 2 * size:]
+    self.assertRaises(EncryptedBlobError, self.decrypt, swapped)
+    self.assertRaises(EncryptedBlobError, self.open(swapped).read, 0, 10)
+
+
+  def test_truncated_at_segment_boundary_fails(self):
+    cleartext, stored, start = self.encrypt_segments(4)
+    truncated = stored[:-stored_segment_size(_SEGMENT_SIZE)]
+    self.assertRaises(EncryptedBlobError, self.decrypt, truncated)
+    self.assertRaises(EncryptedBlobError, self.open(truncated).size)
+
+
+  def test_path_in_header(self):
+    stored = StringIO()
+    encrypt_stream(self.gpg, ['recipient'], StringIO(self.cleartext), stored,
+                   segment_size=_SEGMENT_SIZE, path='/a/b')
+    self.assertEqual('/a/b', self.open(stored.getvalue()).path)
+    self.assertEqual(self.cleartext, self.decrypt(stored.getvalue()))
+    self.assertEqual(None, self.open(self.encrypt(self.cleartext)).path)
+
+
+  def test_not_seekable(self):
+    self.assertFalse(is_seekable('LBXH'))
+    self.assertRaises(EncryptedBlobError, self.decrypt, 'x' * 100)
+
+
+if __name__ == '__main__':
+  unittest.main()
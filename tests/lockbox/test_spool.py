@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+from lockbox.spool import Spool
+
+
+class SpoolTestCase(unittest.TestCase):
+  def test_small_output_stays_in_memory(self):
+    spool = Spool(max_in_memory=10)
+    spool.write('abc')
+    spool.write('defg')
+    spool.close()
+    self.assertTrue(spool.in_memory())
+    self.assertEqual('', spool.path)
+    self.assertEqual(7, spool.size)
+    self.assertEqual('abcdefg', spool.getvalue())
+    self.assertEqual('abc', spool.head(3))
+    self.assertEqual('abcdefg', spool.open().read())
+    spool.discard()
+
+
+  def test_large_output_moves_to_disk(self):
+    spool = Spool(max_in_memory=10)
+    spool.write('abcdefgh')
+    spool.write('ijklmnop')
+    spool.close()
+    self.assertFalse(spool.in_memory())
+    self.assertTrue(os.path.exists(spool.path))
+    with open(spool.path, 'rb') as spool_file:
+      self.assertEqual('abcdefghijklmnop', spool_file.read())
+    self.assertEqual(16, spool.size)
+    self.assertEqual('abcd', spool.head(4))
+    with spool.open() as spool_file:
+      self.assertEqual('abcdefghijklmnop', spool_file.read())
+
+    restored = Spool.from_path(spool.path)
+    self.assertEqual(16, restored.size)
+    self.assertEqual('abcdefghijklmnop', restored.getvalue())
+    spool.discard()
+    self.assertFalse(os.path.exists(spool.path))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import threading
+import unittest
+import lockbox.stage
+from lockbox.stage import Stage
+
+
+class StageTestCase(unittest.TestCase):
+  def setUp(self):
+    self.finished = list()
+    self.failed = list()
+    # Threads that closed their pooled database connections.
+    self.closed = list()
+    self.saved_close = lockbox.stage.close_pooled_connections
+    lockbox.stage.close_pooled_connections = lambda: self.closed.append(
+      threading.current_thread())
+
+
+  def tearDown(self):
+    lockbox.stage.close_pooled_connections = self.saved_close
+
+
+  def _double(self, job):
+    job['value'] *= 2
+    return True
+
+
+  def _collect(self, job):
+    self.finished.append(job['value'])
+    return True
+
+
+  def _explode(self, job):
+    raise ValueError('boom')
+
+
+  def _record_failure(self, job, error):
+    self.failed.append((job['value'], error))
+
+
+  def test_jobs_flow_to_next_stage(self):
+    collect = Stage('collect', self._collect, 1, 2)
+    double = Stage('double', self._double, 3, 2, next_stage=collect)
+    collect.start()
+    double.start()
+    for value in range(10):
+      double.put({'value': value})
+    double.shutdown()
+    collect.shutdown()
+    self.assertEqual(sorted(value * 2 for value in range(10)),
+                     sorted(self.finished))
+
+
+  def test_false_stops_job(self):
+    collect = Stage('collect', self._collect, 1, 2)
+    drop = Stage('drop', lambda job: False, 1, 2, next_stage=collect)
+    collect.start()
+    drop.start()
+    drop.put({'value': 1})
+    drop.shutdown()
+    collect.shutdown()
+    self.assertEqual([], self.finished)
+
+
+  def test_exception_calls_failure_callback(self):
+    explode = Stage('explode', self._explode, 1, 2,
+                    failure_callback=self._record_failure)
+    explode.start()
+    explode.put({'value': 7})
+    explode.shutdown()
+    self.assertEqual(1, len(self.failed))
+    self.assertEqual(7, self.failed[0][0])
+    self.assertTrue(isinstance(self.failed[0][1], ValueError))
+
+
+  def test_put_blocks_when_full(self):
+    release = threading.Event()
+    blocked = Stage('blocked', lambda job: release.wait(), 1, 1)
+    blocked.start()
+    blocked.put({'value': 1})  # Taken by the worker.
+    blocked.put({'value': 2})  # Fills the queue.
+    producer = threading.Thread(target=blocked.put, args=({'value': 3},))
+    producer.start()
+    producer.join(0.1)
+    self.assertTrue(producer.is_alive())
+    release.set()
+    producer.join()
+    blocked.shutdown()
+
+
+  def test_grow_and_shrink(self):
+    collect = Stage('collect', self._collect, 1, 4)
+    collect.start()
+    collect.grow(2)
+    self.assertEqual(3, collect.size())
+    self.assertEqual(2, collect.shrink(5))
+    self.assertEqual(1, collect.size())
+    collect.put({'value': 1})
+    collect.shutdown()
+    self.assertEqual([1], self.finished)
+
+
+  def test_heal_replaces_dead_worker(self):
+    def die(job):
+      raise SystemExit
+    dying = Stage('dying', die, 1, 2)
+    dying.start()
+    dying.put({'value': 3})
+    dying.workers[0].join(5)
+    orphaned_jobs = dying.heal()
+    self.assertEqual([{'value': 3}], orphaned_jobs)
+    self.assertEqual(1, dying.size())
+    self.assertTrue(dying.workers[0].is_alive())
+    dying.work = self._collect
+    dying.put({'value': 4})
+    dying.shutdown()
+    self.assertEqual([4], self.finished)
+
+
+  def test_exiting_workers_close_connections(self):
+    def die(job):
+      raise SystemExit
+    dying = Stage('dying', die, 1, 2)
+    dying.start()
+    dead = dying.workers[0]
+    dying.put({'value': 1})
+    dead.join(5)
+    self.assertEqual([dead], self.closed)
+    dying.heal()
+    retired = dying.workers[0]
+    dying.shutdown()
+    self.assertEqual([dead, retired], self.closed)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from lockbox.staging import StagingArea, new_file
+
+
+class StagingAreaTestCase(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.staging = StagingArea(os.path.join(self.directory, 'staging'),
+                               quota=100)
+
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+
+  def test_reserve_blocks_until_released(self):
+    self.assertEqual(80, self.staging.reserve(80))
+    reserved = threading.Event()
+    def reserve():
+      self.staging.reserve(40)
+      reserved.set()
+    thread = threading.Thread(target=reserve)
+    thread.daemon = True
+    thread.start()
+    self.assertFalse(reserved.wait(0.2))
+    self.staging.release(80)
+    self.assertTrue(reserved.wait(1))
+    self.assertEqual(40, self.staging.reserved)
+
+
+  def test_oversized_reservation_waits_for_an_empty_area(self):
+    self.staging.reserve(10)
+    self.staging.release(10)
+    self.assertEqual(500, self.staging.reserve(500))
+    self.staging.reserve(5, block=False)
+    self.assertEqual(505, self.staging.reserved)
+
+
+  def test_sweep_keeps_what_is_still_needed(self):
+    with new_file(self.staging.directory) as kept:
+      pass
+    with new_file(self.staging.directory) as orphan:
+      pass
+    other = os.path.join(self.staging.directory, 'not-ours')
+    open(other, 'w').close()
+
+    self.assertEqual(1, self.staging.sweep(keep=[kept.name]))
+    self.assertTrue(os.path.exists(kept.name))
+    self.assertFalse(os.path.exists(orphan.name))
+    self.assertTrue(os.path.exists(other))
+
+
+if __name__ == '__main__':
+  unittest.main()
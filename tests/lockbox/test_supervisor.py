@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import unittest
+from lockbox.supervisor import PoolSupervisor
+
+
+class FakeMediator(object):
+  pipeline = None
+
+
+class PoolSupervisorTestCase(unittest.TestCase):
+  def setUp(self):
+    self.supervisor = PoolSupervisor(FakeMediator(), {
+        'encrypt': (1, 4), 'upload': (1, 8), 'shepherd': (2, 4)})
+
+
+  def test_grows_backed_up_pool(self):
+    self.assertTrue(self.supervisor._should_grow('encrypt', 2, True, 0.2))
+    self.assertFalse(self.supervisor._should_grow('encrypt', 2, False, 0.2))
+
+
+  def test_respects_bounds(self):
+    self.assertFalse(self.supervisor._should_grow('encrypt', 4, True, 0.2))
+    self.assertTrue(self.supervisor._should_grow('shepherd', 1, False))
+    self.assertTrue(self.supervisor._should_shrink('encrypt', 5, False))
+
+
+  def test_cpu_bound_stage_holds_when_cpus_busy(self):
+    self.assertFalse(self.supervisor._should_grow('encrypt', 2, True, 0.95))
+    self.assertTrue(self.supervisor._should_grow('upload', 2, True, 0.95))
+
+
+  def test_upload_holds_without_throughput_gain(self):
+    self.supervisor._upload_rate_before_grow = 1000.
+    self.assertFalse(
+      self.supervisor._should_grow('upload', 2, True, upload_rate=1010.))
+    self.assertTrue(
+      self.supervisor._should_grow('upload', 2, True, upload_rate=2000.))
+
+
+  def test_shrinks_after_idle_intervals(self):
+    self.assertFalse(self.supervisor._should_shrink('encrypt', 3, True))
+    self.assertFalse(self.supervisor._should_shrink('encrypt', 3, True))
+    self.assertTrue(self.supervisor._should_shrink('encrypt', 3, True))
+    self.assertFalse(self.supervisor._should_shrink('encrypt', 1, True))
+
+
+  def test_busy_interval_resets_idle_count(self):
+    self.supervisor._should_shrink('encrypt', 3, True)
+    self.supervisor._should_shrink('encrypt', 3, True)
+    self.supervisor._should_shrink('encrypt', 3, False)
+    self.assertFalse(self.supervisor._should_shrink('encrypt', 3, True))
+
+
+if __name__ == '__main__':
+  unittest.main()